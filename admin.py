@@ -14,7 +14,10 @@
 
 __author__ = 'rew@google.com (Becky Willrich)'
 
+import os
+
 import base_handler
+import cache
 import domains
 import model
 import perms
@@ -229,3 +232,14 @@ class AdminMap(base_handler.BaseHandler):
     if self.request.get('wipe'):
       map_object.Wipe()
     self.redirect(map_id)
+
+
+class CacheStats(base_handler.BaseHandler):
+  """Reports the cache statistics for the app instance serving the request."""
+
+  def Get(self):
+    """Writes out the hit/miss counters and latencies for all caches as JSON."""
+    perms.AssertAccess(perms.Role.ADMIN)
+    stats = cache.GetStats()
+    stats['instance_id'] = os.environ.get('INSTANCE_ID', '')
+    self.WriteJson(stats)
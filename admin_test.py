@@ -11,10 +11,12 @@
 
 __author__ = 'rew@google.com (Becky Willrich)'
 
+import json
 import time
 import urllib
 
 import admin
+import cache
 import domains
 import model
 import perms
@@ -334,5 +336,22 @@ class AdminMapTest(test_utils.BaseTest):
       self.DoPost('/.admin/' + map_id, 'wipe=1&xsrf_token=XSRF', 403)
 
 
+class CacheStatsTest(test_utils.BaseTest):
+  """Tests the cache statistics handler."""
+
+  def testGet(self):
+    c = cache.Cache('admin_test', 60)
+    c.Get('x', lambda: 1)  # a miss
+    c.Get('x')  # a local hit
+    with test_utils.Login('unprivileged'):
+      self.DoGet('/.cache_stats', 403)
+    with test_utils.RootLogin():
+      response = self.DoGet('/.cache_stats')
+    stats = json.loads(response.body)['caches']['admin_test']
+    self.assertEquals(1, stats['misses'])
+    self.assertEquals(1, stats['local_hits'])
+    self.assertEquals(1, stats['make_value_calls'])
+
+
 if __name__ == '__main__':
   test_utils.main()
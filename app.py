@@ -91,6 +91,7 @@ app = webapp2.WSGIApplication([
 
             Route('/.admin', 'admin.Admin'),
             Route('/.admin/<map_id>', 'admin.AdminMap'),
+            Route('/.cache_stats', 'admin.CacheStats'),
             Route('/.card/<map_id>.<topic_id>', 'card.CardByIdAndTopic'),
             Route('/.card/<label>', 'card.CardByLabel'),
             Route('/.card/<label>/<topic_id>', 'card.CardByLabelAndTopic'),
@@ -132,7 +133,10 @@ app = webapp2.WSGIApplication([
                   'metadata_fetch.MetadataFetchLogCleaner'),
             Route('/.wms/cleanup', 'wmscache.tileworker.CleanupOldWorkers'),
             Route('/.wms/tileworker', 'wmscache.tileworker.StartWorker'),
+            Route('/.card_cache_refresh', 'card.CacheRefresh'),
             Route('/.crowd_report_cleanup', 'crowd_report_tasks.Cleanup'),
+            Route('/.crowd_report_summary_update',
+                  'crowd_report_tasks.UpdateSummary'),
 
         ])
     ]),
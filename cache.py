@@ -25,55 +25,430 @@ To avoid key collisions, don't use memcache directly; use this module.
 
 __author__ = 'kpy@google.com (Ka-Ping Yee)'
 
+import bisect
+import collections
+import hashlib
+import heapq
 import json
 import logging
 import pickle
 import random
 import threading
 import time
+import zlib
 
 from google.appengine.api import memcache
 
-LOCAL_CACHE = {}  # key => (expiration, value_pickle)
-SWEEP_LOCK = threading.Lock()  # lock held while sweeping LOCAL_CACHE
-SWEEP_INTERVAL_SECONDS = 60
-
-next_sweep_time = 0
+# Total size (in bytes of keys and value pickles) of all the items kept in
+# the local RAM cache of one app instance.  Each Cache can also be given its
+# own smaller budget with the local_max_bytes argument.
+LOCAL_CACHE_MAX_BYTES = 32 * 1024 * 1024
 
 # Sleep time between failing to grab a make_value lock and checking key
-# existence in the cache / retrying to get a lock again.
+# existence in the cache / retrying to get a lock again.  The interval doubles
+# after each attempt, up to MAX_RETRY_INTERVAL_SEC.
 RETRY_INTERVAL_SEC = 0.05
+MAX_RETRY_INTERVAL_SEC = 1.0
 
+# Memcache rejects items larger than 1 MB, so values that are still larger
+# than this after encoding are split into chunks stored under separate keys.
+CHUNK_BYTES = 900 * 1024
 
-def Reset():
-  """Reset the state of this module.  For use in tests only."""
-  global next_sweep_time
-  LOCAL_CACHE.clear()
-  next_sweep_time = 0
+# Tag generation numbers (see InvalidateTag) are kept in the local RAM cache
+# for this long, independent of the ULL of the caches that use them, so that
+# lookups in tagged caches with tiny ULLs don't each cost a memcache call.
+# This bounds how much later than the ULL an invalidation can take effect.
+TAG_GENERATION_LOCAL_TTL_SECONDS = 1
+
+# Memcache is shared by all the versions of the app that are serving at once
+# (e.g. during a rolling deploy or a rollback), and older versions can't read
+# the values that Codec produces, so cache values are stored under keys that
+# start with this prefix.  Any change to the stored values that older code
+# can't read must also change the prefix, so that app instances running
+# different code never look at each other's values.
+MEMCACHE_KEY_PREFIX = 'cache.v2:'
+
+# The first byte of every value stored in memcache identifies its format.
+PICKLE_FORMAT = '\x01'  # followed by a pickle
+ZLIB_PICKLE_FORMAT = '\x02'  # followed by a zlib-compressed pickle
+CHUNKED_FORMAT = '\x03'  # followed by '<number of chunks>:<SHA-1 of value>'
+
+
+class Codec(object):
+  """Converts cache values to and from the strings stored in memcache.
+
+  Values are pickled, and the pickles are kept in the local RAM cache.  Before
+  going to memcache, each pickle is packed into an envelope that starts with a
+  version byte and may be compressed.  Subclasses can override any of these
+  steps to store values differently.
+  """
+
+  def __init__(self, protocol=pickle.HIGHEST_PROTOCOL,
+               compress_threshold=16 * 1024, compress_level=6):
+    """Sets up a codec.
+
+    Args:
+      protocol: The pickle protocol to use.
+      compress_threshold: Pickles of at least this many bytes are compressed
+          with zlib before they are stored in memcache.  None disables
+          compression (e.g. for values that are already compressed).
+      compress_level: The zlib compression level, from 1 to 9.
+    """
+    self.protocol = protocol
+    self.compress_threshold = compress_threshold
+    self.compress_level = compress_level
+
+  def Dumps(self, value):
+    """Serializes a value to a string."""
+    return pickle.dumps(value, self.protocol)
+
+  def Loads(self, value_pickle):
+    """Deserializes a string produced by Dumps()."""
+    return pickle.loads(value_pickle)
+
+  def Pack(self, value_pickle):
+    """Wraps a string produced by Dumps() in a versioned envelope."""
+    if (self.compress_threshold is not None and
+        len(value_pickle) >= self.compress_threshold):
+      compressed = zlib.compress(value_pickle, self.compress_level)
+      if len(compressed) < len(value_pickle):
+        return ZLIB_PICKLE_FORMAT + compressed
+    return PICKLE_FORMAT + value_pickle
+
+  def Unpack(self, data):
+    """Unwraps an envelope produced by Pack().
+
+    Args:
+      data: A string produced by Pack().
+    Returns:
+      The string that was given to Pack(), or None if the envelope has a
+      format that this version of the code doesn't understand.
+    """
+    version = data[:1]
+    if version == PICKLE_FORMAT:
+      return data[1:]
+    if version == ZLIB_PICKLE_FORMAT:
+      return zlib.decompress(buffer(data, 1))
+    return None  # an unknown format; treat it as a cache miss
+
+
+DEFAULT_CODEC = Codec()
+
+
+class LocalCache(object):
+  """A size-bounded, thread-safe RAM cache with LRU eviction.
+
+  Items are evicted least-recently-used first whenever the total size of the
+  cache, or the total size of the items belonging to one cache name, exceeds
+  its budget.  Expired items are removed in order of expiration using a heap,
+  so expiry costs O(log n) per item instead of a sweep over the whole cache.
+  """
+
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.quotas = {}  # cache name => maximum number of bytes for that name
+    self.lock = threading.Lock()
+    self.Clear()
+
+  def Clear(self):
+    """Removes all items from the cache and resets the counters."""
+    with self.lock:
+      # key_json => (expiration, value, name, size), in LRU order
+      self.items = collections.OrderedDict()
+      # name => OrderedDict of the key_jsons for that name, in LRU order
+      self.keys_by_name = {}
+      self.expiry_heap = []  # (expiration, key_json), possibly outdated
+      self.resident_bytes = 0
+      self.bytes_by_name = {}
+      self.evictions = 0
+      self.expirations = 0
+
+  def SetQuota(self, name, max_bytes):
+    """Sets the maximum total size of the items for a given cache name."""
+    with self.lock:
+      self.quotas[name] = max_bytes
+
+  def Get(self, key_json):
+    """Gets an item, marking it as recently used.
+
+    Args:
+      key_json: The fully qualified key, as produced by Cache.KeyToJson.
+    Returns:
+      An (expiration, value) pair, or (0, None) if the key is absent.
+    """
+    with self.lock:
+      item = self.items.pop(key_json, None)
+      if not item:
+        return 0, None
+      self.items[key_json] = item
+      keys = self.keys_by_name[item[2]]
+      del keys[key_json]
+      keys[key_json] = None
+      return item[:2]
+
+  def Set(self, name, key_json, expiration, value, size=None):
+    """Stores an item, evicting other items as needed to stay within budget.
+
+    Args:
+      name: The name of the Cache that the item belongs to.
+      key_json: The fully qualified key, as produced by Cache.KeyToJson.
+      expiration: The time (in seconds since the epoch) when the item expires.
+          Items that are already expired are not stored.
+      value: The value to store; usually a pickle, but it can be any object.
+      size: The approximate size of the item in bytes.  Optional; defaults
+          to the total length of key_json and value, which must be a string.
+    """
+    now = time.time()
+    if size is None:
+      size = len(key_json) + len(value)
+    quota = self.quotas.get(name, self.max_bytes)
+    with self.lock:
+      self._Remove(key_json)
+      self._RemoveExpired(now)
+      if expiration <= now or size > min(quota, self.max_bytes):
+        return
+      self.items[key_json] = (expiration, value, name, size)
+      self.keys_by_name.setdefault(
+          name, collections.OrderedDict())[key_json] = None
+      heapq.heappush(self.expiry_heap, (expiration, key_json))
+      self.resident_bytes += size
+      self.bytes_by_name[name] = self.bytes_by_name.get(name, 0) + size
+
+      # Evict least recently used items until we're within budget.
+      while self.bytes_by_name[name] > quota:
+        self._Remove(next(iter(self.keys_by_name[name])))
+        self.evictions += 1
+      while self.resident_bytes > self.max_bytes:
+        self._Remove(next(iter(self.items)))
+        self.evictions += 1
+
+      # Outdated heap entries accumulate when items are replaced or evicted;
+      # rebuild the heap if they start to dominate.
+      if len(self.expiry_heap) > 2 * len(self.items) + 100:
+        self.expiry_heap = [(item[0], k) for k, item in self.items.iteritems()]
+        heapq.heapify(self.expiry_heap)
+
+  def Pop(self, key_json):
+    """Removes an item from the cache, if present."""
+    with self.lock:
+      self._Remove(key_json)
+
+  def GetStats(self):
+    """Gets a dictionary of counters describing the state of the cache."""
+    with self.lock:
+      return {
+          'items': len(self.items),
+          'resident_bytes': self.resident_bytes,
+          'max_bytes': self.max_bytes,
+          'bytes_by_name': dict(self.bytes_by_name),
+          'evictions': self.evictions,
+          'expirations': self.expirations
+      }
+
+  def _Remove(self, key_json):
+    """Removes an item.  The caller must hold self.lock."""
+    item = self.items.pop(key_json, None)
+    if item:
+      _, _, name, size = item
+      self.resident_bytes -= size
+      self.bytes_by_name[name] -= size
+      del self.keys_by_name[name][key_json]
+      if not self.keys_by_name[name]:
+        del self.keys_by_name[name]
+        del self.bytes_by_name[name]
+
+  def _RemoveExpired(self, now):
+    """Removes all expired items.  The caller must hold self.lock."""
+    while self.expiry_heap and self.expiry_heap[0][0] <= now:
+      expiration, key_json = heapq.heappop(self.expiry_heap)
+      item = self.items.get(key_json)
+      if item and item[0] == expiration:  # skip outdated heap entries
+        self._Remove(key_json)
+        self.expirations += 1
+
+
+LOCAL_CACHE = LocalCache(LOCAL_CACHE_MAX_BYTES)
+
+# Upper bounds of the buckets in latency histograms, in milliseconds.
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+class LatencyHistogram(object):
+  """Counts of durations, grouped into the buckets in LATENCY_BUCKETS_MS."""
+
+  def __init__(self):
+    self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)  # last one is overflow
+    self.total_ms = 0
 
+  def Add(self, seconds):
+    """Records one duration, given in seconds."""
+    ms = seconds * 1000
+    self.counts[bisect.bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+    self.total_ms += ms
 
-def _SetLocalCache(key_json, expiration, value_pickle):
-  """Sets an item in the local RAM cache; also sweeps the cache if it's due."""
+  def ToDict(self):
+    """Gets a JSON-serializable summary of the histogram."""
+    count = sum(self.counts)
+    labels = ['<=%d' % bound for bound in LATENCY_BUCKETS_MS] + [
+        '>%d' % LATENCY_BUCKETS_MS[-1]]
+    return {
+        'count': count,
+        'mean_ms': count and round(self.total_ms / count, 3),
+        'buckets_ms': dict(zip(labels, self.counts))
+    }
+
+
+class CacheStats(object):
+  """Counters and latency histograms for all the Caches with a given name.
+
+  The counters are updated without locking, to keep the hot path cheap; under
+  concurrency they may occasionally undercount, which is fine for tuning.
+  """
+
+  def __init__(self):
+    self.Clear()
+
+  def Clear(self):
+    """Resets all the counters and histograms."""
+    self.local_hits = 0  # values served from the local RAM cache
+    self.memcache_hits = 0  # fresh values served from memcache
+    self.misses = 0  # memcache lookups that found no value
+    self.stale_serves = 0  # values served past their cooling time
+    self.lock_failures = 0  # failed attempts to get a make_value lock
+    self.coalesced_waits = 0  # waits for a value being made by another thread
+    self.make_value_calls = 0
+    self.make_value_errors = 0
+    self.memcache_latency = LatencyHistogram()
+    self.make_value_latency = LatencyHistogram()
+
+  def ToDict(self):
+    """Gets a JSON-serializable summary of the statistics."""
+    lookups = self.local_hits + self.memcache_hits + self.misses
+    return {
+        'local_hits': self.local_hits,
+        'memcache_hits': self.memcache_hits,
+        'misses': self.misses,
+        'hit_rate': lookups and round(
+            float(self.local_hits + self.memcache_hits) / lookups, 4),
+        'stale_serves': self.stale_serves,
+        'lock_failures': self.lock_failures,
+        'coalesced_waits': self.coalesced_waits,
+        'make_value_calls': self.make_value_calls,
+        'make_value_errors': self.make_value_errors,
+        'memcache_latency': self.memcache_latency.ToDict(),
+        'make_value_latency': self.make_value_latency.ToDict()
+    }
+
+
+STATS = {}  # cache name => CacheStats
+
+
+def GetStats():
+  """Gets the statistics for all caches in this app instance, as a dict."""
+  return {
+      'local_cache': LOCAL_CACHE.GetStats(),
+      'caches': {name: stats.ToDict() for name, stats in STATS.iteritems()}
+  }
+
+
+class _Flight(object):
+  """The state of a thread's attempt to get a value missing from memcache."""
+
+  def __init__(self):
+    self.done = threading.Event()  # set when the attempt is finished
+    self.value_pickle = None  # the resulting value, if the attempt succeeded
+    self.error = None  # the exception raised, if the attempt failed
+
+
+# Attempts in progress to get values missing from memcache, keyed by key_json.
+FLIGHTS = {}
+FLIGHTS_LOCK = threading.Lock()
+
+
+def _GetTagKeyJson(tag):
+  """Gets the memcache key for the generation number of a tag."""
+  return json.dumps(['cache.tag', tag], sort_keys=True)
+
+
+def _NewTagGeneration():
+  """Picks a generation number for a tag that has none in memcache."""
+  # If a tag's generation number is evicted from memcache, its replacement
+  # must not match any generation still in use, or entries invalidated before
+  # the eviction would come back.  Generations normally grow by 1 per
+  # invalidation, so starting from the current time in ms ensures this.
+  return int(time.time() * 1000)
+
+
+def GetTagGenerations(tag_key_jsons):
+  """Gets the current generation numbers of some tags.
+
+  The generation numbers are kept in the local RAM cache for
+  TAG_GENERATION_LOCAL_TTL_SECONDS, so that lookups in tagged caches don't
+  each need an extra memcache call.  This means an InvalidateTag() in another
+  app instance can take that long to be noticed here, on top of the ULL of
+  the cache whose entries it invalidates.
+
+  Args:
+    tag_key_jsons: A collection of memcache keys from _GetTagKeyJson().
+  Returns:
+    A dictionary mapping each of the given keys to its generation number.
+  """
   now = time.time()
-  if expiration > now:
-    LOCAL_CACHE[key_json] = (expiration, value_pickle)
-    # SWEEP_LOCK is not held here, so the item can be prematurely deleted by a
-    # concurrent sweep.  That's okay: this affects efficiency, not correctness,
-    # and not having to lock on every write is probably a bigger win.
-
-  global next_sweep_time
-  if now >= next_sweep_time:
-    # Only one thread can advance next_sweep_time; that thread does the sweep.
-    next_sweep_time_snapshot = next_sweep_time
-    with SWEEP_LOCK:
-      if next_sweep_time == next_sweep_time_snapshot:
-        # This thread got the lock first; proceed to sweep the cache.
-        next_sweep_time = now + SWEEP_INTERVAL_SECONDS
-        for key_json, (expiration, unused_value_pickle) in LOCAL_CACHE.items():
-          if expiration < now:
-            # Use pop() instead of del because the item can be concurrently
-            # removed by Cache.Delete(), which doesn't hold SWEEP_LOCK.
-            LOCAL_CACHE.pop(key_json, None)
+  generations = {}
+  missing = []
+  for key_json in tag_key_jsons:
+    expiration, generation = LOCAL_CACHE.Get(key_json)
+    if now < expiration:
+      generations[key_json] = generation
+    else:
+      missing.append(key_json)
+  if not missing:
+    return generations
+
+  found = memcache.get_multi(missing)
+  new = {key_json: _NewTagGeneration()
+         for key_json in missing if key_json not in found}
+  if new:
+    # Another request may add a generation at the same time; theirs wins.
+    not_added = memcache.add_multi(new)
+    found.update(new)
+    if not_added:
+      found.update(memcache.get_multi(not_added))
+  for key_json in missing:
+    generations[key_json] = found[key_json]
+    LOCAL_CACHE.Set('cache.tag', key_json,
+                    now + TAG_GENERATION_LOCAL_TTL_SECONDS,
+                    found[key_json], len(key_json) + 8)
+  return generations
+
+
+def InvalidateTag(tag):
+  """Invalidates all cache entries with a given tag or a tag extending it.
+
+  For example, InvalidateTag(['map', 'abc']) invalidates entries tagged
+  ['map', 'abc'] or ['map', 'abc', 'xyz'] in all caches, and
+  InvalidateTag(['map']) invalidates entries for all maps.  This takes a
+  single memcache operation, however many entries have the tag.  As with
+  Cache.Delete(), other app instances can keep serving the old entries from
+  their local RAM caches for up to the ULL of each cache, plus up to
+  TAG_GENERATION_LOCAL_TTL_SECONDS (see GetTagGenerations).
+
+  Args:
+    tag: A list of JSON-serializable values.
+  """
+  key_json = _GetTagKeyJson(tag)
+  LOCAL_CACHE.Pop(key_json)
+  if memcache.incr(key_json) is None:
+    if not memcache.add(key_json, _NewTagGeneration()):
+      memcache.incr(key_json)  # someone else just added it
+
+
+def Reset():
+  """Reset the state of this module.  For use in tests only."""
+  LOCAL_CACHE.Clear()
+  FLIGHTS.clear()
+  for stats in STATS.values():
+    stats.Clear()
 
 
 class Cache(object):
@@ -118,7 +493,8 @@ class Cache(object):
       >>> c.Get({3: 4, 1: 2})
       (5+6j)
 
-  Mutable values are safe to cache; mutating them won't affect the cache:
+  Mutable values are safe to cache; mutating them won't affect the cache
+  (unless the cache was created with immutable=True; see below):
 
       >>> x = [2, 3, 4]
       >>> c.Set('x', x)
@@ -131,12 +507,27 @@ class Cache(object):
       >>> c.Get('x')
       [2, 3, 4]
 
+  Entries can also be invalidated in groups.  A cache created with a tags
+  function gives each entry a list of tags, and InvalidateTag() invalidates
+  every entry whose tags include the given tag or extend it:
+
+      >>> c = cache.Cache('foo', 60, tags=lambda key: [['map', key[0]]])
+      >>> c.Set(['abc', 1], 5)
+      >>> c.Set(['abc', 2], 6)
+      >>> cache.InvalidateTag(['map', 'abc'])
+      >>> c.Get(['abc', 1])  # returns None
+
   Cache instances have two parameters: TTL (time to live) and ULL (update
   latency limit).  The TTL controls when items expire; the ULL controls
   when updates to items become visible in all app instances.  You must
   specify a TTL; the ULL is optional and defaults to be the same as the
   TTL.  Setting the ULL to zero disables use of the local RAM cache.
 
+  The local RAM cache of each app instance is limited in size; when it's
+  full, the least recently used items are evicted.  Caches that hold large
+  values can be given a smaller budget of their own with local_max_bytes,
+  so that they don't crowd out everything else.
+
   For example, cache.Cache('foo', 60, 5) configures a 60-second TTL and a
   5-second ULL.  After Set() is called on a particular key, that key will
   stay populated for 60 seconds.  Each app instance that calls Get() for
@@ -146,6 +537,16 @@ class Cache(object):
   Get() can give a stale value for up to 5 seconds after another app
   instance has updated a key with Set() or Delete().
 
+  A cache created with immutable=True keeps unpickled values in the local
+  RAM cache and hands the same object to every caller, so local hits cost
+  only a dictionary lookup.  This is worthwhile for large values that are
+  read often, but every caller must then treat the values as read-only:
+
+      >>> c = cache.Cache('foo', 60, 30, immutable=True)
+      >>> c.Set('x', [2, 3, 4])
+      >>> c.Get('x') is c.Get('x')
+      True
+
   You can use a cache in two ways:
 
     - Promptly updated: if you're caching data that is maintained in your
@@ -162,11 +563,12 @@ class Cache(object):
       updates sooner than the TTL expires.
   """
   # Values are pickled for caching to ensure immutability.  This has the side
-  # benefit that None is cached as the string 'N.', which makes it easy to
+  # benefit that None is cached as a non-empty string, which makes it easy to
   # distinguish a cached value of None from a cache miss.
 
   def __init__(self, name, ttl, ull=None, get_timeout=None,
-               make_rate_limit=None):
+               make_rate_limit=None, local_max_bytes=None, immutable=False,
+               codec=None, schedule_refresh=None, tags=None):
     """A two-level cache (local RAM and memcache).
 
     Args:
@@ -189,6 +591,30 @@ class Cache(object):
           succeed. There will be multiple attempts to grab the make_value lock
           during this time.
       make_rate_limit: Maximum number of calls allowed to make_value per second.
+      local_max_bytes: Maximum total size (in bytes) of the items that this
+          cache keeps in the local RAM cache of each app instance.  Optional;
+          by default, items are limited only by LOCAL_CACHE_MAX_BYTES.
+      immutable: If True, the local RAM cache keeps unpickled values and
+          returns the same object to every caller, which saves the cost of
+          unpickling on each local cache hit.  Callers must never mutate
+          the values they get from an immutable cache.  (Memcache still
+          stores pickles, so other app instances are unaffected.)
+      codec: A Codec that determines how values are serialized and stored
+          in memcache.  Optional; defaults to DEFAULT_CODEC.
+      schedule_refresh: A function that takes a cache key and arranges for
+          Refresh() to be called for that key outside the current request,
+          e.g. by adding a task to a task queue.  If given, when Get() or
+          GetMulti() finds a value past its cooling time, it returns the
+          stale value right away and calls schedule_refresh (while holding
+          the make_value lock) instead of make_value, so that slow
+          make_value functions, such as fetches from external servers, don't
+          add to the latency of any user request.
+      tags: A function that takes a cache key and returns a list of tags for
+          its entry, for use with InvalidateTag().  Each tag is a non-empty
+          list of JSON-serializable values.  Optional; by default, entries
+          have no tags.  Each lookup in a cache with tags also looks up the
+          current generation numbers of the tags, which are kept in the
+          local RAM cache for TAG_GENERATION_LOCAL_TTL_SECONDS.
 
     Raises:
       ValueError: ull > ttl is not allowed.
@@ -204,17 +630,48 @@ class Cache(object):
     self.ttl = ttl
     self.ull = ttl if ull is None else ull
     # Add some jitter to the ULL, so that different instances don't try
-    # to rewarm memcache entries at the same time
-    self.ull = random.randint(self.ull // 2, self.ull // 1)
+    # to rewarm memcache entries at the same time.  (The ULL can be a
+    # fraction of a second, so the jitter must not round it down to zero.)
+    self.ull = random.uniform(self.ull / 2.0, self.ull)
     self.make_rate_limit = make_rate_limit or 1
     self.get_timeout = get_timeout or 10
     # Pick a value for ttc less than tll, so that there is enough time
     # to attempt and rewarm the entities with make_value.
     self.ttc = 0.85 * self.ttl
+    self.immutable = immutable
+    self.codec = codec or DEFAULT_CODEC
+    self.schedule_refresh = schedule_refresh
+    self.tags = tags
+    self.stats = STATS.setdefault(name, CacheStats())
+    if local_max_bytes is not None:
+      LOCAL_CACHE.SetQuota(name, local_max_bytes)
 
   def KeyToJson(self, key):
     """Converts a cache key to a canonical fully qualified string."""
-    return json.dumps([self.name, key], sort_keys=True)
+    return MEMCACHE_KEY_PREFIX + json.dumps([self.name, key], sort_keys=True)
+
+  def _GetKeyJsons(self, keys):
+    """Converts cache keys to the fully qualified strings they are stored under.
+
+    In a cache with tags, these strings contain the current generation number
+    of every prefix of every tag of the key, so that InvalidateTag() makes the
+    entries stored under older generations unreachable.
+
+    Args:
+      keys: A list of cache keys.
+    Returns:
+      The corresponding list of fully qualified strings.
+    """
+    if not self.tags:
+      return [self.KeyToJson(key) for key in keys]
+    tag_key_jsons = [[_GetTagKeyJson(tag[:i])
+                      for tag in self.tags(key) for i in range(1, len(tag) + 1)]
+                     for key in keys]
+    generations = GetTagGenerations(set(sum(tag_key_jsons, [])))
+    return [MEMCACHE_KEY_PREFIX +
+            json.dumps([self.name, key, [generations[k] for k in key_tags]],
+                       sort_keys=True)
+            for key, key_tags in zip(keys, tag_key_jsons)]
 
   def Get(self, key, make_value=None):
     """Gets a key's value, using make_value() if it's not in the cache.
@@ -229,50 +686,396 @@ class Cache(object):
     Raises:
       RuntimeError: If there is a timeout on retries to make_value
     """
-    key_json = self.KeyToJson(key)
+    key_json, = self._GetKeyJsons([key])
+    now = time.time()
 
-    deadline = time.time() + self.get_timeout
+    # Look for the key in the local cache.
+    expiration, local_value = LOCAL_CACHE.Get(key_json)
+    if now < expiration:
+      self.stats.local_hits += 1
+      return self._LoadLocalValue(local_value)
 
-    while True:
-      now = time.time()
+    # Key not found in the local cache, so look for the key in memcache
+    expiration, value_pickle = self._MemcacheGet(key_json)
+    if not value_pickle:
+      self.stats.misses += 1
+      if make_value:
+        return self._WaitForNewValue(key, key_json, make_value)
+      return None
 
-      # Look for the key in the local cache.
-      expiration, value_pickle = LOCAL_CACHE.get(key_json, (0, None))
-      if now < expiration:
-        return pickle.loads(value_pickle)
-
-      # Key not found in the local cache, so look for the key in memcache
-      expiration, value_pickle = memcache.get(key_json) or (0, None)
-      if (make_value and
-          (not value_pickle or now >= self.GetCoolingTime(expiration))):
-        # Need to generate a new value using make_value. If we have a stale
-        # value, ignore make_value errors
-        expiration, value_pickle = (
-            self.TryUpdatingValueInMemcache(
-                key, key_json, make_value, expiration, value_pickle)
-            or (expiration, value_pickle))
-        if not value_pickle and time.time() + RETRY_INTERVAL_SEC < deadline:
-          # Wait and then retry
-          time.sleep(RETRY_INTERVAL_SEC)
-          continue
-        elif not value_pickle:
+    if make_value and now >= self.GetCoolingTime(expiration):
+      # Need to generate a new value using make_value.  We have a stale
+      # value, so ignore make_value errors
+      updated = self.TryUpdatingValueInMemcache(
+          key, key_json, make_value, expiration, value_pickle,
+          in_background=bool(self.schedule_refresh))
+      if updated:
+        expiration, value_pickle = updated
+      else:
+        self.stats.stale_serves += 1
+    else:
+      self.stats.memcache_hits += 1
+
+    # Store the value in the local cache, then return it
+    return self._SetLocalCacheForMemcacheValue(
+        key_json, now, expiration, value_pickle)
+
+  def _WaitForNewValue(self, key, key_json, make_value):
+    """Gets a value that is missing from memcache, making it if necessary.
+
+    Within this app instance, only one thread at a time does this for a given
+    key; other threads that need the same key wait for it to finish and share
+    its result, instead of all polling memcache.  That thread calls make_value
+    if it can acquire the make_value lock; otherwise, it polls memcache with
+    exponential backoff until another app instance has stored a value.
+
+    Args:
+      key: The cache key.
+      key_json: JSON for the key.
+      make_value: A function to produce the value.
+    Returns:
+      The new value.
+    Raises:
+      RuntimeError: If no value appeared before the get_timeout expired.
+    """
+    with FLIGHTS_LOCK:
+      flight = FLIGHTS.get(key_json)
+      in_progress = flight is not None
+      if not in_progress:
+        flight = FLIGHTS[key_json] = _Flight()
+
+    if in_progress:
+      # Another thread in this instance is already getting the value.
+      self.stats.coalesced_waits += 1
+      flight.done.wait(self.get_timeout)
+      if flight.error:
+        raise flight.error  # pylint:disable=raising-bad-type
+      if not flight.value_pickle:
+        raise RuntimeError('Timed out on make_value in cache %s' % self.name)
+      return self.codec.Loads(flight.value_pickle)
+
+    try:
+      deadline = time.time() + self.get_timeout
+      interval = RETRY_INTERVAL_SEC
+      while True:
+        expiration, value_pickle = self.TryUpdatingValueInMemcache(
+            key, key_json, make_value, 0, None) or (0, None)
+        if value_pickle:
+          break
+        # Another app instance is making the value; wait and check again.
+        # The random jitter keeps waiting instances from polling in lockstep.
+        delay = random.uniform(interval / 2, interval)
+        if time.time() + delay >= deadline:
           raise RuntimeError('Timed out on make_value in cache %s' % self.name)
+        time.sleep(delay)
+        interval = min(interval * 2, MAX_RETRY_INTERVAL_SEC)
+        expiration, value_pickle = self._MemcacheGet(key_json)
+        if value_pickle:
+          break
+      flight.value_pickle = value_pickle
+      return self._SetLocalCacheForMemcacheValue(
+          key_json, time.time(), expiration, value_pickle)
+    except Exception as e:
+      flight.error = e
+      raise
+    finally:
+      with FLIGHTS_LOCK:
+        FLIGHTS.pop(key_json, None)
+      flight.done.set()
+
+  def GetMulti(self, keys, make_values=None):
+    """Gets the values of several keys, using at most one memcache round trip.
+
+    Keys found in the local cache are served from there; all the remaining
+    keys are looked up with a single memcache.get_multi() call.  Keys that
+    are missing or past their cooling time are handled as in Get(): the ones
+    whose make_value locks we acquire are made together by one call to
+    make_values(), and the others fall back to their stale values or to Get().
+
+    Args:
+      keys: A list of cache keys.  Each can be any JSON-serializable value.
+      make_values: An optional function that takes a list of keys and
+          returns a list of their values, in the same order.  The values
+          must be picklable.
+    Returns:
+      A list of values corresponding to the given keys.  Each value is the
+      cached value, or the newly made value if it wasn't already cached, or
+      None if it wasn't cached and make_values was not provided.
+    Raises:
+      RuntimeError: If there is a timeout on retries to make a value.
+    """
+    now = time.time()
+    key_jsons = self._GetKeyJsons(keys)
+    results = [None] * len(keys)
+
+    # Look for the keys in the local cache.
+    misses = []  # indexes of keys not found in the local cache
+    for i, key_json in enumerate(key_jsons):
+      expiration, local_value = LOCAL_CACHE.Get(key_json)
+      if now < expiration:
+        self.stats.local_hits += 1
+        results[i] = self._LoadLocalValue(local_value)
+      else:
+        misses.append(i)
+
+    # Look for all the remaining keys in memcache at once.
+    found = {}
+    if misses:
+      found = self._MemcacheGetMulti([key_jsons[i] for i in misses])
+    to_make = []  # (index, expiration, value_pickle) for keys needing values
+    for i in misses:
+      expiration, value_pickle = found.get(key_jsons[i]) or (0, None)
+      if not value_pickle:
+        self.stats.misses += 1
+      if make_values and (
+          not value_pickle or now >= self.GetCoolingTime(expiration)):
+        to_make.append((i, expiration, value_pickle))
+      elif value_pickle:
+        self.stats.memcache_hits += 1
+        results[i] = self._SetLocalCacheForMemcacheValue(
+            key_jsons[i], now, expiration, value_pickle)
+
+    if to_make:
+      unmade = self._UpdateValuesInMemcache(
+          keys, key_jsons, make_values, to_make, results)
+      for i in unmade:
+        # We couldn't make this value in bulk; wait for it the usual way.
+        results[i] = self.Get(
+            keys[i], lambda key=keys[i]: make_values([key])[0])
+    return results
+
+  def _UpdateValuesInMemcache(self, keys, key_jsons, make_values, to_make,
+                              results):
+    """Makes and stores the values for GetMulti() in one batch.
 
+    Args:
+      keys: The list of all keys passed to GetMulti().
+      key_jsons: The corresponding list of JSON keys.
+      make_values: The function to produce a list of values for a list of keys.
+      to_make: A list of (index, expiration, value_pickle) triples for the
+          keys that are missing from memcache or past their cooling time.
+      results: The list of values for GetMulti() to return.  Updated in
+          place with the values that are made, or with the stale values from
+          memcache for keys whose locks couldn't be acquired.
+    Returns:
+      A list of the indexes of keys for which no value could be obtained.
+    """
+    now = time.time()
+    locked = []  # (index, expiration, value_pickle) for keys we hold locks on
+    unmade = []
+    for i, expiration, value_pickle in to_make:
+      if self.AcquireMakeValueLock(keys[i]):
+        locked.append((i, expiration, value_pickle))
+      elif value_pickle:
+        # Someone else is rewarming this entry; serve the stale value.
+        self.stats.stale_serves += 1
+        results[i] = self._SetLocalCacheForMemcacheValue(
+            key_jsons[i], now, expiration, value_pickle)
+      else:
+        unmade.append(i)
+    if not locked:
+      return unmade
+
+    # Push the cooling time of stale entries further into the future, as in
+    # TryUpdatingValueInMemcache.
+    for i, expiration, value_pickle in locked:
       if value_pickle:
-        # Set expiration in the local cache such that entities expire by
-        # cooling_time to trigger an attempt to rewarm the cached value
-        local_cache_exp = (
-            min(now + self.ull, self.GetCoolingTime(expiration), expiration))
-        # Store the value in the local cache, then return it
-        _SetLocalCache(key_json, local_cache_exp, value_pickle)
-        return pickle.loads(value_pickle)
-      return None
+        self._MemcacheSetMulti(
+            {key_jsons[i]: (expiration + self.ttc * 0.1, value_pickle)},
+            expiration)
+
+    locked_keys = [keys[i] for i, _, _ in locked]
+    locked_key_jsons = [key_jsons[i] for i, _, _ in locked]
+    all_stale = all(value_pickle for _, _, value_pickle in locked)
+    if all_stale and self.schedule_refresh:
+      # Serve the stale values now and make the new ones outside the request.
+      for key in locked_keys:
+        self._ScheduleRefresh(key)
+      for i, _, value_pickle in locked:
+        self.stats.stale_serves += 1
+        results[i] = self.codec.Loads(value_pickle)
+      return unmade
+
+    try:
+      expiration, value_pickles = self._MakeValuesInMemcache(
+          make_values, locked_keys, locked_key_jsons)
+    except Exception:  # pylint:disable=broad-except
+      if all_stale:
+        # There are stale values we can return, so just log a warning for now
+        logging.warning('Error on make_values for %d keys in %s. Ignoring the '
+                        'error.', len(locked), self.name, exc_info=True)
+        for i, _, value_pickle in locked:
+          self.stats.stale_serves += 1
+          results[i] = self.codec.Loads(value_pickle)
+        return unmade
+      raise
+
+    now = time.time()
+    for (i, _, _), value_pickle in zip(locked, value_pickles):
+      results[i] = self._SetLocalCacheForMemcacheValue(
+          key_jsons[i], now, expiration, value_pickle)
+    return unmade
+
+  def _MakeValuesInMemcache(self, make_values, keys, key_jsons):
+    """Calls make_values and stores the new values in memcache.
+
+    Args:
+      make_values: The function to produce a list of values for a list of keys.
+      keys: The keys to make values for.
+      key_jsons: The corresponding list of JSON keys.
+    Returns:
+      The expiration time of the new values and a list of their pickles.
+    """
+    values = self._CallMakeValue(make_values, keys)
+    value_pickles = [self.codec.Dumps(value) for value in values]
+    expiration = time.time() + self.ttl
+    self._MemcacheSetMulti(
+        {key_json: (expiration, value_pickle)
+         for key_json, value_pickle in zip(key_jsons, value_pickles)},
+        self.ttl)
+    return expiration, value_pickles
+
+  def _SetLocalCacheForMemcacheValue(self, key_json, now, expiration,
+                                     value_pickle):
+    """Stores a value obtained from memcache in the local cache.
+
+    Returns:
+      The unpickled value.
+    """
+    # Set expiration in the local cache such that entities expire by
+    # cooling_time to trigger an attempt to rewarm the cached value
+    local_cache_exp = (
+        min(now + self.ull, self.GetCoolingTime(expiration), expiration))
+    return self._LoadLocalValue(
+        self._SetLocalCache(key_json, local_cache_exp, value_pickle))
+
+  def _SetLocalCache(self, key_json, expiration, value_pickle):
+    """Stores a value in the local cache.
+
+    Returns:
+      The item stored in the local cache: the unpickled value if this cache
+      is immutable, otherwise the pickle itself.
+    """
+    local_value = (
+        self.codec.Loads(value_pickle) if self.immutable else value_pickle)
+    LOCAL_CACHE.Set(self.name, key_json, expiration, local_value,
+                    len(key_json) + len(value_pickle))
+    return local_value
+
+  def _LoadLocalValue(self, local_value):
+    """Gets the value to return for an item found in the local cache."""
+    if self.immutable:
+      return local_value  # the live object, shared by all callers
+    return self.codec.Loads(local_value)
+
+  def _MemcacheGet(self, key_json):
+    """Gets an (expiration, value_pickle) pair from memcache.
+
+    Returns:
+      The (expiration, value_pickle) pair, or (0, None) if there is none.
+    """
+    return self._MemcacheGetMulti([key_json]).get(key_json) or (0, None)
+
+  def _MemcacheGetMulti(self, key_jsons):
+    """Gets (expiration, value_pickle) pairs for several keys from memcache.
+
+    Args:
+      key_jsons: A list of fully qualified keys.
+    Returns:
+      A dictionary mapping the keys that were found to their
+      (expiration, value_pickle) pairs.
+    """
+    results = {}
+    manifests = {}  # key_json => (expiration, number of chunks, digest)
+    for key_json, (expiration, data) in self._MemcacheGetMultiTimed(
+        key_jsons).iteritems():
+      if data[:1] == CHUNKED_FORMAT:
+        num_chunks, digest = data[1:].split(':')
+        manifests[key_json] = (expiration, int(num_chunks), digest)
+      else:
+        results[key_json] = (expiration, self.codec.Unpack(data))
+
+    if manifests:
+      # Fetch the chunks for all the chunked values in one round trip.
+      chunk_keys = {key_json: self._GetChunkKeys(key_json, num_chunks, digest)
+                    for key_json, (_, num_chunks, digest)
+                    in manifests.iteritems()}
+      chunks = self._MemcacheGetMultiTimed(sum(chunk_keys.values(), []))
+      for key_json, (expiration, _, digest) in manifests.iteritems():
+        parts = [chunks.get(chunk_key) for chunk_key in chunk_keys[key_json]]
+        if None not in parts:
+          data = ''.join(parts)
+          if hashlib.sha1(data).hexdigest() == digest:
+            results[key_json] = (expiration, self.codec.Unpack(data))
+        # If a chunk has been evicted, the whole value is a cache miss.
+
+    return {key_json: pair for key_json, pair in results.iteritems() if pair[1]}
+
+  def _MemcacheGetMultiTimed(self, key_jsons):
+    """Calls memcache.get_multi(), recording the latency in self.stats."""
+    start = time.time()
+    try:
+      return memcache.get_multi(key_jsons)
+    finally:
+      self.stats.memcache_latency.Add(time.time() - start)
+
+  def _CallMakeValue(self, make_value, *args):
+    """Calls a make_value function, recording its latency in self.stats."""
+    self.stats.make_value_calls += 1
+    start = time.time()
+    try:
+      return make_value(*args)
+    except Exception:
+      self.stats.make_value_errors += 1
+      raise
+    finally:
+      self.stats.make_value_latency.Add(time.time() - start)
+
+  def _MemcacheSetMulti(self, mapping, memcache_time, add=False):
+    """Stores (expiration, value_pickle) pairs for several keys in memcache.
+
+    Args:
+      mapping: A dictionary mapping fully qualified keys to
+          (expiration, value_pickle) pairs.
+      memcache_time: The memcache expiration time, as for memcache.set().
+      add: If True, store each value only if its key is not already set.
+    Returns:
+      The list of keys that were not stored.
+    """
+    items = {}
+    chunks = {}
+    for key_json, (expiration, value_pickle) in mapping.iteritems():
+      data = self.codec.Pack(value_pickle)
+      if len(data) > CHUNK_BYTES:
+        num_chunks = (len(data) + CHUNK_BYTES - 1) // CHUNK_BYTES
+        digest = hashlib.sha1(data).hexdigest()
+        for i, chunk_key in enumerate(
+            self._GetChunkKeys(key_json, num_chunks, digest)):
+          chunks[chunk_key] = data[i * CHUNK_BYTES:(i + 1) * CHUNK_BYTES]
+        data = CHUNKED_FORMAT + '%d:%s' % (num_chunks, digest)
+      items[key_json] = (expiration, data)
+
+    # Chunks are stored before the values that refer to them, so that readers
+    # never see a value whose chunks haven't been stored yet.
+    if chunks:
+      memcache.set_multi(chunks, time=memcache_time)
+    if add:
+      return memcache.add_multi(items, time=memcache_time)
+    return memcache.set_multi(items, time=memcache_time)
+
+  def _GetChunkKeys(self, key_json, num_chunks, digest):
+    """Gets the memcache keys for the chunks of a large value."""
+    # The digest is part of each chunk's key, so that chunks from different
+    # versions of a value never get mixed up.
+    return [json.dumps(['cache.chunk', key_json, digest, i])
+            for i in range(num_chunks)]
 
   def GetCoolingTime(self, expiration):
     return expiration - self.ttl + self.ttc
 
   def TryUpdatingValueInMemcache(self, key, key_json, make_value,
-                                 old_expiration, old_value_pickle):
+                                 old_expiration, old_value_pickle,
+                                 in_background=False):
     """Tries updating value in memcache using make_value function.
 
     Updates/sets the value for a given key in memcache by first trying to
@@ -287,10 +1090,14 @@ class Cache(object):
           or None if memcache has no value for the key
       old_value_pickle: Current memcache value pickle for the key
           or None if memcache has no value for the key
+      in_background: If True, once the lock is acquired, the new value is
+          made outside this request (see schedule_refresh), and this
+          function returns None.  Only allowed when old_value_pickle is set.
     Returns:
       Newly cached value with its expiration timestamp, or None if the lock
       couldn't be acquired (or in case of old_value_pickle != None there
-      were failures on make_value call).
+      were failures on make_value call, or the value is being made outside
+      this request).
     """
     if not self.AcquireMakeValueLock(key):
       return None
@@ -300,18 +1107,56 @@ class Cache(object):
       # (by 10% of the original cooling time), so other requests don't try to
       # rewarm cold entries for the time being. Load tests showed this has a
       # nontrivial performance benefit.
-      memcache.set(key_json,
-                   (old_expiration + self.ttc * 0.1, old_value_pickle),
-                   time=old_expiration)
+      self._MemcacheSetMulti(
+          {key_json: (old_expiration + self.ttc * 0.1, old_value_pickle)},
+          old_expiration)
 
-    # Acquired the lock, so call make_value
+    if in_background:
+      self._ScheduleRefresh(key)
+      return None
+    return self._UpdateValueInMemcache(key_json, make_value, old_value_pickle)
+
+  def _ScheduleRefresh(self, key):
+    """Calls schedule_refresh for a key, logging errors instead of raising."""
     try:
-      value_pickle = pickle.dumps(make_value())
+      self.schedule_refresh(key)
+    except Exception:  # pylint:disable=broad-except
+      logging.warning('Error scheduling a refresh for key %r in %s. Ignoring '
+                      'the error.', key, self.name, exc_info=True)
+
+  def Refresh(self, key, make_value):
+    """Makes a new value for a key and stores it, whatever is cached now.
+
+    This is meant to be called outside user requests, by whatever was
+    arranged by schedule_refresh; errors are raised so that it can be retried.
+
+    Args:
+      key: The cache key.  Can be any JSON-serializable value.
+      make_value: A function to produce the value.
+    """
+    key_json, = self._GetKeyJsons([key])
+    self._UpdateValueInMemcache(key_json, make_value, None)
+
+  def _UpdateValueInMemcache(self, key_json, make_value, old_value_pickle):
+    """Calls make_value and stores the new value in memcache.
+
+    Args:
+      key_json: JSON for the key that we're generating a value for
+      make_value: A function to produce the value.
+      old_value_pickle: Current memcache value pickle for the key
+          or None if memcache has no value for the key
+    Returns:
+      Newly cached value with its expiration timestamp, or None if
+      old_value_pickle is set and there was a failure on make_value call.
+    """
+    try:
+      value_pickle = self.codec.Dumps(self._CallMakeValue(make_value))
 
       # Update/set new value in memcache
       now = time.time()
       expiration = now + self.ttl
-      memcache.set(key_json, (expiration, value_pickle), time=self.ttl)
+      self._MemcacheSetMulti({key_json: (expiration, value_pickle)},
+                             self.ttl)
       return expiration, value_pickle
     except Exception:  # pylint:disable=broad-except
       if old_value_pickle:
@@ -345,7 +1190,10 @@ class Cache(object):
     lock_key_json = json.dumps(['cache.make_lock', [self.name, key]],
                                sort_keys=True)
     lock_timeout = 1. / self.make_rate_limit
-    return memcache.add(lock_key_json, now + lock_timeout, time=lock_timeout)
+    if memcache.add(lock_key_json, now + lock_timeout, time=lock_timeout):
+      return True
+    self.stats.lock_failures += 1
+    return False
 
   def Set(self, key, value):
     """Sets a key's value in the cache.
@@ -354,12 +1202,31 @@ class Cache(object):
       key: The cache key.  Can be any JSON-serializable value.
       value: The value to store in the cache.  Must be picklable.
     """
-    key_json = self.KeyToJson(key)
-    value_pickle = pickle.dumps(value)
+    key_json, = self._GetKeyJsons([key])
+    value_pickle = self.codec.Dumps(value)
     now = time.time()
 
-    memcache.set(key_json, (now + self.ttl, value_pickle), time=self.ttl)
-    _SetLocalCache(key_json, now + self.ull, value_pickle)
+    self._MemcacheSetMulti({key_json: (now + self.ttl, value_pickle)},
+                           self.ttl)
+    self._SetLocalCache(key_json, now + self.ull, value_pickle)
+
+  def SetMulti(self, mapping):
+    """Sets the values of several keys with a single memcache round trip.
+
+    Args:
+      mapping: A dictionary mapping cache keys to values.  The keys can be
+          any hashable JSON-serializable values; the values must be picklable.
+    """
+    now = time.time()
+    keys = mapping.keys()
+    value_pickles = {key_json: self.codec.Dumps(mapping[key])
+                     for key, key_json in zip(keys, self._GetKeyJsons(keys))}
+    self._MemcacheSetMulti(
+        {key_json: (now + self.ttl, value_pickle)
+         for key_json, value_pickle in value_pickles.iteritems()},
+        self.ttl)
+    for key_json, value_pickle in value_pickles.iteritems():
+      self._SetLocalCache(key_json, now + self.ull, value_pickle)
 
   def Add(self, key, value):
     """Atomically sets a key's value only if it's not already set.
@@ -372,10 +1239,11 @@ class Cache(object):
     Returns:
       True if this key was not previously set and was updated.
     """
-    key_json = self.KeyToJson(key)
-    value_pickle = pickle.dumps(value)
+    key_json, = self._GetKeyJsons([key])
+    value_pickle = self.codec.Dumps(value)
     now = time.time()
-    return memcache.add(key_json, (now + self.ttl, value_pickle), time=self.ttl)
+    return not self._MemcacheSetMulti(
+        {key_json: (now + self.ttl, value_pickle)}, self.ttl, add=True)
 
   def Delete(self, key):
     """Deletes a key from the cache.
@@ -383,6 +1251,6 @@ class Cache(object):
     Args:
       key: The cache key.  Can be any JSON-serializable value.
     """
-    key_json = self.KeyToJson(key)
+    key_json, = self._GetKeyJsons([key])
     memcache.delete(key_json)
-    LOCAL_CACHE.pop(key_json, None)
+    LOCAL_CACHE.Pop(key_json)
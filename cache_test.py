@@ -0,0 +1,449 @@
+#!/usr/bin/python
+# Copyright 2014 Google Inc.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at: http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distrib-
+# uted under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+# OR CONDITIONS OF ANY KIND, either express or implied.  See the License for
+# specific language governing permissions and limitations under the License.
+
+"""Tests for cache.py."""
+
+import hashlib
+import json
+import pickle
+import threading
+import time
+
+import cache
+import test_utils
+
+from google.appengine.api import memcache
+
+
+class LocalCacheTest(test_utils.BaseTest):
+  """Tests the LocalCache class."""
+
+  def testGetSetPop(self):
+    self.SetTime(1000)
+    local = cache.LocalCache(1000)
+    self.assertEquals((0, None), local.Get('a'))
+    local.Set('x', 'a', 1010, 'value')
+    self.assertEquals((1010, 'value'), local.Get('a'))
+    local.Pop('a')
+    self.assertEquals((0, None), local.Get('a'))
+    self.assertEquals(0, local.GetStats()['resident_bytes'])
+
+  def testLruEviction(self):
+    self.SetTime(1000)
+    local = cache.LocalCache(30)  # room for three 10-byte items
+    for key in ['a', 'b', 'c']:
+      local.Set('x', key, 2000, '123456789')
+    local.Get('a')  # 'b' is now the least recently used item
+    local.Set('x', 'd', 2000, '123456789')
+    self.assertEquals((0, None), local.Get('b'))
+    self.assertEquals((2000, '123456789'), local.Get('a'))
+    stats = local.GetStats()
+    self.assertEquals(1, stats['evictions'])
+    self.assertEquals(30, stats['resident_bytes'])
+    self.assertEquals({'x': 30}, stats['bytes_by_name'])
+
+    # Items larger than the whole budget are not stored at all.
+    local.Set('x', 'e', 2000, '0' * 100)
+    self.assertEquals((0, None), local.Get('e'))
+
+  def testQuota(self):
+    self.SetTime(1000)
+    local = cache.LocalCache(1000)
+    local.SetQuota('small', 20)
+    local.Set('big', 'a', 2000, '123456789')
+    for key in ['b', 'c', 'd']:
+      local.Set('small', key, 2000, '123456789')
+    # Only the oldest item belonging to 'small' should have been evicted.
+    self.assertEquals((0, None), local.Get('b'))
+    self.assertEquals((2000, '123456789'), local.Get('a'))
+    self.assertEquals({'big': 10, 'small': 20},
+                      local.GetStats()['bytes_by_name'])
+
+  def testExpiration(self):
+    self.SetTime(1000)
+    local = cache.LocalCache(1000)
+    local.Set('x', 'a', 1010, 'value')
+    local.Set('x', 'b', 1020, 'value')
+    local.Set('x', 'c', 1000, 'value')  # already expired; not stored
+    self.assertEquals(2, local.GetStats()['items'])
+
+    # Expired items are removed on the next Set().
+    self.SetTime(1015)
+    local.Set('x', 'd', 1030, 'value')
+    self.assertEquals((0, None), local.Get('a'))
+    self.assertEquals((1020, 'value'), local.Get('b'))
+    self.assertEquals(1, local.GetStats()['expirations'])
+
+
+class CodecTest(test_utils.BaseTest):
+  """Tests the Codec class."""
+
+  def testRoundTrip(self):
+    codec = cache.Codec()
+    for value in [None, 0, 'abc', [1, {'a': 2}], 'x' * 100000]:
+      data = codec.Pack(codec.Dumps(value))
+      self.assertEquals(value, codec.Loads(codec.Unpack(data)))
+
+  def testCompression(self):
+    codec = cache.Codec(compress_threshold=1000)
+    self.assertEquals(cache.PICKLE_FORMAT, codec.Pack('x' * 999)[0])
+    data = codec.Pack('x' * 1000)
+    self.assertEquals(cache.ZLIB_PICKLE_FORMAT, data[0])
+    self.assertLess(len(data), 100)
+    self.assertEquals('x' * 1000, codec.Unpack(data))
+
+    # Compression can be turned off.
+    codec = cache.Codec(compress_threshold=None)
+    self.assertEquals(cache.PICKLE_FORMAT, codec.Pack('x' * 100000)[0])
+
+  def testOtherFormats(self):
+    codec = cache.Codec()
+    # Unknown formats are treated as missing values.
+    self.assertEquals(None, codec.Unpack('\x1fabc'))
+    self.assertEquals(None, codec.Unpack('\x80\x02N.'))
+
+
+class CacheTest(test_utils.BaseTest):
+  """Tests the Cache class."""
+
+  def testGetMulti(self):
+    c = cache.Cache('test', 60)
+    c.Set('a', 1)
+    c.Set('b', [2])
+    self.assertEquals([1, [2], None], c.GetMulti(['a', 'b', 'c']))
+    self.assertEquals([], c.GetMulti([]))
+
+  def testGetMultiUsesOneMemcacheCall(self):
+    c = cache.Cache('test', 60, 0)  # ULL of 0 disables the local cache
+    c.SetMulti({'a': 1, 'b': 2, 'c': 3})
+    calls = []
+    original_get_multi = memcache.get_multi
+    self.SetForTest(memcache, 'get_multi',
+                    lambda keys: calls.append(keys) or original_get_multi(keys))
+    self.assertEquals([3, 1, 2], c.GetMulti(['c', 'a', 'b']))
+    self.assertEquals(1, len(calls))
+
+  def testGetMultiMakeValues(self):
+    c = cache.Cache('test', 60)
+    c.Set('a', 1)
+    made = []
+
+    def MakeValues(keys):
+      made.append(keys)
+      return [key * 2 for key in keys]
+
+    self.assertEquals([1, 'bb', 'cc'], c.GetMulti(['a', 'b', 'c'], MakeValues))
+    self.assertEquals([['b', 'c']], made)  # one batch for all the misses
+
+    # The made values should now be cached.
+    self.assertEquals([1, 'bb', 'cc'], c.GetMulti(['a', 'b', 'c'], MakeValues))
+    self.assertEquals(1, len(made))
+    self.assertEquals('cc', c.Get('c'))
+
+  def testGetMultiRewarmsCoolingEntries(self):
+    self.SetTime(1000)
+    c = cache.Cache('test', 100, 0)
+    c.SetMulti({'a': 'old', 'b': 'old'})
+
+    # Past the cooling time, both entries are rewarmed with one make_values().
+    self.SetTime(1090)
+    made = []
+    self.assertEquals(
+        ['new', 'new'],
+        c.GetMulti(['a', 'b'], lambda keys: made.append(keys) or ['new'] * 2))
+    self.assertEquals([['a', 'b']], made)
+
+  def testImmutable(self):
+    c = cache.Cache('test', 60, 60, immutable=True)
+    value = {'a': [1, 2]}
+    c.Set('x', value)
+    value['a'].append(3)  # the cache should have kept a copy
+    self.assertEquals({'a': [1, 2]}, c.Get('x'))
+    # Local cache hits should return the same object without unpickling.
+    self.assertIs(c.Get('x'), c.Get('x'))
+    self.assertEquals([{'a': [1, 2]}], c.GetMulti(['x']))
+
+    # Values loaded from memcache should also be kept unpickled locally.
+    cache.Reset()
+    self.assertEquals({'a': [1, 2]}, c.Get('x'))
+    self.assertIs(c.Get('x'), c.Get('x'))
+
+  def testImmutableWithSubsecondUll(self):
+    self.SetTime(1000)
+    c = cache.Cache('test', 300, 0.5, immutable=True)
+    self.assertTrue(0.25 <= c.ull <= 0.5)
+    c.Set('x', [1, 2])
+
+    # Within the ULL, the value should come from the local cache.
+    calls = []
+    original_get_multi = memcache.get_multi
+    self.SetForTest(memcache, 'get_multi',
+                    lambda keys: calls.append(keys) or original_get_multi(keys))
+    self.assertIs(c.Get('x'), c.Get('x'))
+    self.assertEquals([], calls)
+    self.assertEquals(2, cache.GetStats()['caches']['test']['local_hits'])
+
+  def testMutable(self):
+    c = cache.Cache('test', 60, 60)
+    c.Set('x', [1, 2])
+    c.Get('x').append(3)
+    self.assertEquals([1, 2], c.Get('x'))
+    self.assertIsNot(c.Get('x'), c.Get('x'))
+
+  def testLargeValues(self):
+    c = cache.Cache('test', 60, 0, codec=cache.Codec(compress_threshold=None))
+    value = ''.join(chr(i % 251) for i in range(3 * cache.CHUNK_BYTES))
+    c.Set('x', value)
+    self.assertEquals(value, c.Get('x'))
+    self.assertEquals([value], c.GetMulti(['x']))
+    self.assertTrue(c.Add('y', value))
+    self.assertFalse(c.Add('y', value))
+    self.assertEquals(value, c.Get('y'))
+
+    # If any chunk goes missing, the value should be treated as missing.
+    data = c.codec.Pack(c.codec.Dumps(value))
+    chunk_keys = c._GetChunkKeys(  # pylint: disable=protected-access
+        c.KeyToJson('x'), 4, hashlib.sha1(data).hexdigest())
+    self.assertTrue(memcache.get(chunk_keys[3]))
+    memcache.delete(chunk_keys[1])
+    self.assertEquals(None, c.Get('x'))
+
+  def testKeysIncludeFormatVersion(self):
+    c = cache.Cache('test', 60, 0)  # ULL of 0 disables the local cache
+    # Older code stored bare pickles under unprefixed keys.  It can't read
+    # the values stored now, so the two must never share keys.
+    old_key_json = json.dumps(['test', 'x'], sort_keys=True)
+    old_item = (time.time() + 60, pickle.dumps('old'))
+    memcache.set(old_key_json, old_item)
+    self.assertEquals(None, c.Get('x'))
+    c.Set('x', 'new')
+    self.assertEquals('new', c.Get('x'))
+    self.assertEquals(old_item, memcache.get(old_key_json))
+    self.assertTrue(c.KeyToJson('x').startswith(cache.MEMCACHE_KEY_PREFIX))
+
+  def testStats(self):
+    self.SetTime(1000)
+    c = cache.Cache('test', 100, 10)
+    self.assertEquals(None, c.Get('x'))
+    self.assertEquals(5, c.Get('x', lambda: 5))
+    self.assertEquals(5, c.Get('x'))
+    cache.LOCAL_CACHE.Clear()
+    self.assertEquals([5, 6], c.GetMulti(['x', 'y'], lambda keys: [6]))
+
+    # Another instance is rewarming 'x', so we should get a stale value.
+    self.SetTime(1090)
+    cache.LOCAL_CACHE.Clear()
+    self.assertTrue(c.AcquireMakeValueLock('x'))
+    self.assertEquals(5, c.Get('x', lambda: 7))
+
+    stats = cache.GetStats()['caches']['test']
+    self.assertEquals(1, stats['local_hits'])
+    self.assertEquals(1, stats['memcache_hits'])
+    self.assertEquals(3, stats['misses'])
+    self.assertEquals(1, stats['stale_serves'])
+    self.assertEquals(1, stats['lock_failures'])
+    self.assertEquals(2, stats['make_value_calls'])
+    self.assertEquals(2, stats['make_value_latency']['count'])
+
+  def testScheduleRefresh(self):
+    scheduled = []
+    self.SetTime(1000)
+    c = cache.Cache('test', 100, 0, schedule_refresh=scheduled.append)
+
+    # With no value cached, make_value has to be called right away.
+    self.assertEquals('old', c.Get('x', lambda: 'old'))
+    self.assertEquals(['old', 'old'],
+                      c.GetMulti(['y', 'z'], lambda keys: ['old'] * 2))
+    self.assertEquals([], scheduled)
+
+    # Past the cooling time, stale values are returned and refreshes are
+    # scheduled instead of calling make_value.
+    self.SetTime(1090)
+    self.assertEquals('old', c.Get('x', lambda: 'new'))
+    self.assertEquals(['old', 'old'],
+                      c.GetMulti(['y', 'z'], lambda keys: ['new'] * 2))
+    self.assertEquals(['x', 'y', 'z'], scheduled)
+    for key in scheduled:
+      c.Refresh(key, lambda: 'new')
+    self.assertEquals('new', c.Get('x', lambda: 'newer'))
+    self.assertEquals(['new', 'new'],
+                      c.GetMulti(['y', 'z'], lambda keys: ['newer'] * 2))
+
+    # Errors in schedule_refresh are logged, and the stale value is served.
+    def FailToSchedule(unused_key):
+      raise ValueError('queue is full')
+    c = cache.Cache('test2', 100, 0, schedule_refresh=FailToSchedule)
+    self.assertEquals('old', c.Get('x', lambda: 'old'))
+    self.SetTime(1180)
+    self.assertEquals('old', c.Get('x', lambda: 'new'))
+    self.assertEquals(1, cache.GetStats()['caches']['test2']['stale_serves'])
+
+  def testCoalescing(self):
+    c = cache.Cache('test', 60)
+    make_value_started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def MakeValue():
+      calls.append(1)
+      make_value_started.set()
+      release.wait()
+      return [1, 2]
+
+    results = []
+    leader = threading.Thread(
+        target=lambda: results.append(c.Get('x', MakeValue)))
+    leader.start()
+    make_value_started.wait()
+    followers = [threading.Thread(
+        target=lambda: results.append(c.Get('x', MakeValue)))
+                 for _ in range(5)]
+    for thread in followers:
+      thread.start()
+    # Wait until all the followers are waiting on the leader's attempt.
+    while cache.GetStats()['caches']['test']['coalesced_waits'] < 5:
+      time.sleep(0.001)
+    release.set()
+    for thread in [leader] + followers:
+      thread.join()
+
+    # make_value should have been called just once, and all threads should
+    # have gotten their own copies of the value.
+    self.assertEquals(1, len(calls))
+    self.assertEquals([[1, 2]] * 6, results)
+    self.assertEquals(6, len(set(map(id, results))))
+    self.assertEquals(5, cache.GetStats()['caches']['test']['coalesced_waits'])
+    self.assertEquals({}, cache.FLIGHTS)
+
+  def testCoalescingError(self):
+    c = cache.Cache('test', 60)
+    # Simulate another thread that has already failed to make the value.
+    flight = cache._Flight()  # pylint: disable=protected-access
+    cache.FLIGHTS[c.KeyToJson('x')] = flight
+    flight.error = ValueError('oops')
+    flight.done.set()
+    self.assertRaises(ValueError, c.Get, 'x', lambda: 1)
+
+  def testBackoff(self):
+    self.SetTime(1000)
+    sleeps = []
+
+    def FakeSleep(seconds):
+      sleeps.append(seconds)
+      self.SetTime(time.time() + seconds)
+    self.SetForTest(time, 'sleep', FakeSleep)
+
+    # Another instance holds the lock for 1 second, and never stores a value.
+    c = cache.Cache('test', 60, make_rate_limit=1)
+    self.assertTrue(c.AcquireMakeValueLock('x'))
+    self.assertEquals(5, c.Get('x', lambda: 5))
+
+    # We should have polled with increasing intervals until the lock expired.
+    self.assertGreaterEqual(sum(sleeps), 1)
+    self.assertLess(len(sleeps), 10)
+    for previous, current in zip(sleeps, sleeps[1:]):
+      self.assertLess(previous / 2, current)
+    self.AssertBetween(cache.RETRY_INTERVAL_SEC / 2, cache.RETRY_INTERVAL_SEC,
+                       sleeps[0])
+
+  def testTimeout(self):
+    self.SetTime(1000)
+    self.SetForTest(time, 'sleep', lambda seconds: self.SetTime(
+        time.time() + seconds))
+    c = cache.Cache('test', 60, get_timeout=2, make_rate_limit=0.1)
+    self.assertTrue(c.AcquireMakeValueLock('x'))  # held for 10 seconds
+    self.assertRaises(RuntimeError, c.Get, 'x', lambda: 5)
+    self.assertEquals({}, cache.FLIGHTS)
+
+  def testSetMulti(self):
+    c = cache.Cache('test', 60)
+    c.SetMulti({'a': 1, 'b': 2})
+    self.assertEquals(1, c.Get('a'))
+    self.assertEquals(2, c.Get('b'))
+    cache.Reset()  # values should be in memcache, not just the local cache
+    self.assertEquals(1, c.Get('a'))
+    self.assertEquals(2, c.Get('b'))
+
+  def testInvalidateTag(self):
+    self.SetTime(1000)
+    c = cache.Cache('test', 60, 10, tags=lambda key: [['map', key[0]]])
+    d = cache.Cache('other', 60, 10, tags=lambda key: [['map', key, 'layer']])
+    c.Set(['abc', 1], 'a')
+    c.Set(['xyz', 1], 'x')
+    d.Set('abc', 'd')
+
+    # Invalidation applies to tags in all caches, and to longer tags.
+    cache.InvalidateTag(['map', 'abc'])
+    self.assertEquals(None, c.Get(['abc', 1]))
+    self.assertEquals(None, d.Get('abc'))
+    self.assertEquals('x', c.Get(['xyz', 1]))
+
+    # Values set after invalidation are visible.
+    c.Set(['abc', 1], 'b')
+    self.assertEquals('b', c.Get(['abc', 1]))
+
+    # Prefixes of tags invalidate everything under them.
+    cache.InvalidateTag(['map'])
+    self.assertEquals(None, c.Get(['abc', 1]))
+    self.assertEquals(None, c.Get(['xyz', 1]))
+
+  def testInvalidateTagInOtherInstance(self):
+    self.SetTime(1000)
+    c = cache.Cache('test', 60, 10, tags=lambda key: [['map', key]])
+    c.Set('abc', 'a')
+    cache.LOCAL_CACHE.Clear()  # simulate another app instance
+    self.assertEquals('a', c.Get('abc'))
+    memcache.incr('["cache.tag", ["map", "abc"]]')
+    # The old entry and generation number are still cached locally for a bit.
+    self.assertEquals('a', c.Get('abc'))
+    self.SetTime(1011)
+    self.assertEquals(None, c.Get('abc'))
+
+  def testTagGenerationsCachedLocally(self):
+    self.SetTime(1000)
+    c = cache.Cache('test', 60, 0.1, tags=lambda key: [['map', key]])
+    c.Set('abc', 'a')
+    calls = []
+    original_get_multi = memcache.get_multi
+    self.SetForTest(memcache, 'get_multi',
+                    lambda keys: calls.append(keys) or original_get_multi(keys))
+
+    # Within the ULL, a Get should need no memcache calls at all.
+    self.assertEquals('a', c.Get('abc'))
+    self.assertEquals([], calls)
+
+    # Past the ULL, the entry comes from memcache, but the tag generation
+    # should still come from the local cache.
+    self.SetTime(1000.5)
+    self.assertEquals('a', c.Get('abc'))
+    self.assertEquals(1, len(calls))
+
+    # Once the generation expires locally, it is looked up again as well.
+    self.SetTime(1000 + cache.TAG_GENERATION_LOCAL_TTL_SECONDS + 0.5)
+    self.assertEquals('a', c.Get('abc'))
+    self.assertEquals(3, len(calls))
+
+  def testEvictedTagGeneration(self):
+    self.SetTime(1000)
+    c = cache.Cache('test', 60, 0, tags=lambda key: [['map', key]])
+    c.Set('abc', 'a')
+    cache.InvalidateTag(['map', 'abc'])
+    self.SetTime(1001)
+    c.Set('abc', 'b')
+    # If the generation number is evicted, older entries must not come back.
+    memcache.delete('["cache.tag", ["map", "abc"]]')
+    self.SetTime(1002)
+    self.assertEquals(None, c.Get('abc'))
+
+
+if __name__ == '__main__':
+  test_utils.main()
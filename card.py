@@ -13,11 +13,21 @@
 """Displays a card containing a list of nearby features for a given topic."""
 
 import cgi
+import contextlib
+import copy
 import datetime
+import email.utils
+import hashlib
+import heapq
 import json
 import logging
 import math
+import operator
+import random
 import re
+import StringIO
+import threading
+import time
 import urllib
 import urlparse
 
@@ -28,28 +38,64 @@ import kmlify
 import maproot
 import model
 import utils
+import xml_utils
 
+from google.appengine.api import taskqueue
 from google.appengine.api import urlfetch
 from google.appengine.ext import ndb  # just for GeoPt
 
-# A cache of Feature list representing points from XML, keyed by
-# [url, map_id, map_version_id, layer_id]
-XML_FEATURES_CACHE = cache.Cache('card_features.xml', 300)
+# A cache of FeatureIndex objects containing the points from XML, keyed by
+# [url, map_id, map_version_id, layer_id].  Refreshing these entries requires
+# fetching from external servers, so stale entries are refreshed by tasks (see
+# CacheRefresh) while requests go on using them.  Layers can have many
+# thousands of features, so the indexes are kept unpickled in the local cache;
+# FeatureIndex.GetNearby() returns copies that are safe to modify.  (The cache
+# name differs from that of the older cache of Feature lists so that the two
+# kinds of values never share memcache keys.)
+XML_FEATURES_CACHE = cache.Cache(
+    'card_feature_index', 300, local_max_bytes=8 * 1024 * 1024, immutable=True,
+    schedule_refresh=lambda key: ScheduleCacheRefresh(
+        'card_feature_index', key))
 
 # Fetched strings of Google Places API JSON results, keyed by request URL.
-JSON_PLACES_API_CACHE = cache.Cache('card.places', 300)
+# Stale entries are refreshed by tasks, as for XML_FEATURES_CACHE.
+JSON_PLACES_API_CACHE = cache.Cache(
+    'card.places', 300,
+    schedule_refresh=lambda key: ScheduleCacheRefresh('card.places', key))
 
 # Lists of Feature objects, keyed by [map_id, map_version_id, topic_id,
-# geolocation_rounded_to_10m, radius, max_count].
-FILTERED_FEATURES_CACHE = cache.Cache('card.filtered_features', 60)
-
-# Key: [map_id, map_version_id, topic_id, geolocation_rounded_to_10m, radius].
+# center_key, radius, max_count], where center_key is a grid cell ID (for
+# entries shared by all the centers in a cell; see GetFilteredFeatures) or
+# the geolocation rounded to 10 m.
+FILTERED_FEATURES_CACHE = cache.Cache('card.filtered_features', 60,
+                                      local_max_bytes=4 * 1024 * 1024)
+
+# Key: [map_id, topic_id, geolocation_rounded_to_10m, radius].
+# Tags: ['card.reports', map_id, topic_id, geolocation_rounded_to_10m], so
+# that InvalidateReportCache can drop the entries for all radii at once.
 # Value: 3-tuple of (latest_answers, answer_times, report_dicts) where
 #   - latest_answers is a dictionary {qid: latest_answer_to_that_question}
 #   - answer_times is a dictionary {qid: effective_time_of_latest_answer}
 #   - report_dicts contains the last REPORTS_PER_FEATURE reports, as a list
 #     of dicts [{qid: answer, '_effective': time, '_id': report_id}]
-REPORT_CACHE = cache.Cache('card.reports', 15)
+REPORT_CACHE = cache.Cache('card.reports', 15,
+                           tags=lambda key: [['card.reports'] + key[:3]])
+
+# Fully rendered cards, keyed by [map_id, map_version_id, topic_id, host_url,
+# path, lang, unit, center rounded to 10 m, sorted_query_params].
+# Tags: ['card.output', map_id, topic_id], so that InvalidateReportCache can
+# drop every card for a topic when a new report might change its answers.
+# Value: a dict with 'headers' (a dict of CARD_OUTPUT_HEADERS), 'body' (a
+# string), 'etag' (a quoted hash of the body) and 'last_modified' (the time
+# the card was rendered, in seconds since the epoch).
+CARD_OUTPUT_CACHE = cache.Cache('card.output', 15,
+                                local_max_bytes=4 * 1024 * 1024,
+                                tags=lambda key: [['card.output', key[0],
+                                                   key[2]]])
+
+# Response headers that are set while rendering a card and cached with it.
+CARD_OUTPUT_HEADERS = ['Content-Type', 'Content-Disposition',
+                       'X-Content-Type-Options']
 
 # Number of crowd reports to cache and return per feature.
 REPORTS_PER_FEATURE = 5
@@ -58,19 +104,76 @@ MAX_ANSWER_AGE = datetime.timedelta(days=7)  # ignore answers older than 7 days
 GOOGLE_SPREADSHEET_CSV_URL = (
     'https://docs.google.com/spreadsheet/pub?key=$key&output=csv')
 DEGREES = 3.14159265358979/180
+EARTH_RADIUS = 6378000  # metres
+FEATURE_INDEX_CELL_DEGREES = 0.5  # size of the cells in a FeatureIndex grid
+# Size of the grid cells (about 1 km) whose centers share cached features.
+FILTERED_FEATURES_CELL_DEGREES = 0.01
 DEADLINE = 10
+# Places details are fetched in parallel for all the features shown on a card;
+# a place whose details take longer than this is shown without them.
+PLACE_DETAILS_DEADLINE = 5
+# Maximum time to spend fetching the features of the layers in a topic during
+# a card request.  This must be well below DEADLINE: layers that take longer
+# are left out of the card and fetched again by a task with the full DEADLINE
+# (see ScheduleCacheRefresh), so that one slow source doesn't hold up cards.
+LAYERS_DEADLINE = 3
+# Elements that are converted to Features by GetFeaturesFromXml, in order.
+XML_ITEM_TAGS = ('Placemark', 'entry', 'item')
+# Fraction of card requests whose per-stage timings are logged and returned in
+# a Server-Timing header.  Can be overridden by the 'card_timing_sample_rate'
+# config setting.
+CARD_TIMING_SAMPLE_RATE = 0.01
 PLACES_API_SEARCH_URL = (
     'https://maps.googleapis.com/maps/api/place/nearbysearch/json?')
 PLACES_API_DETAILS_URL = (
     'https://maps.googleapis.com/maps/api/place/details/json?')
 
 
+# The utils.StageTimer for the card request being handled in each thread, if
+# the request was sampled for timing.
+REQUEST_TIMER = threading.local()
+
+
 def RoundGeoPt(point):
   return '%.4f,%.4f' % (point.lat, point.lon)  # 10-m resolution
 
 
+@contextlib.contextmanager
+def TimeStage(stage):
+  """Times a stage of the card request being handled, if it's being timed."""
+  timer = getattr(REQUEST_TIMER, 'timer', None)
+  if timer:
+    with timer.Time(stage):
+      yield
+  else:
+    yield
+
+
+def WithRequestTimer(function):
+  """Wraps a function so it times stages for this thread's card request.
+
+  Use this on functions that will be called in other threads, such as by
+  utils.CallInParallel, so that their stages are included in the timings.
+  """
+  timer = getattr(REQUEST_TIMER, 'timer', None)
+  def Call():
+    REQUEST_TIMER.timer = timer
+    try:
+      return function()
+    finally:
+      REQUEST_TIMER.timer = None
+  return Call
+
+
 class Feature(object):
   """A feature (map item) from a source data layer."""
+  # Layers can have thousands of features, and whole lists of them are cached,
+  # so we use __slots__ and pickle just a tuple of the values to keep them
+  # small and quick to unpickle.
+  __slots__ = ['name', 'layer_id', 'location', 'description_html',
+               'html_attrs', 'layer_type', 'gplace_id', 'distance',
+               'status_color', 'answer_text', 'answer_time', 'answer_source',
+               'answers', 'reports']
 
   def __init__(self, name, description_html, location, layer_id=None,
                layer_type=None, gplace_id=None, html_attrs=None):
@@ -93,7 +196,21 @@ class Feature(object):
     return self.distance < other.distance
 
   def __eq__(self, other):
-    return self.__dict__ == other.__dict__
+    return (isinstance(other, Feature) and
+            self.__getstate__() == other.__getstate__())
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __getstate__(self):
+    return tuple(getattr(self, name) for name in self.__slots__)
+
+  def __setstate__(self, state):
+    if isinstance(state, dict):
+      # Features pickled before __slots__ was added carry their __dict__.
+      state = tuple(state.get(name) for name in self.__slots__)
+    for name, value in zip(self.__slots__, state):
+      setattr(self, name, value)
 
   distance_km = property(lambda self: self.distance and self.distance/1000.0)
   distance_mi = property(lambda self: self.distance and self.distance/1609.344)
@@ -109,7 +226,89 @@ def EarthDistance(a, b):
   y = sqrt(pow(cos(lat2)*sin(dlon), 2) +
            pow(cos(lat1)*sin(lat2) - sin(lat1)*cos(lat2)*cos(dlon), 2))
   x = sin(lat1)*sin(lat2) + cos(lat1)*cos(lat2)*cos(dlon)
-  return 6378000*atan2(y, x)
+  return EARTH_RADIUS*atan2(y, x)
+
+
+def EarthDistances(center, locations):
+  """Great circle distances in metres from one point to each of many points.
+
+  This gives the same results as calling EarthDistance for each point, but
+  computes the trigonometric functions of the center only once and avoids
+  repeated attribute lookups, which makes it about twice as fast.
+  """
+  atan2, cos, sin, sqrt = math.atan2, math.cos, math.sin, math.sqrt
+  lat1, lon1 = center.lat*DEGREES, center.lon*DEGREES
+  sin_lat1, cos_lat1 = sin(lat1), cos(lat1)
+  distances = []
+  for location in locations:
+    lat2, dlon = location.lat*DEGREES, location.lon*DEGREES - lon1
+    sin_lat2, cos_lat2, cos_dlon = sin(lat2), cos(lat2), cos(dlon)
+    a = cos_lat2*sin(dlon)
+    b = cos_lat1*sin_lat2 - sin_lat1*cos_lat2*cos_dlon
+    distances.append(EARTH_RADIUS*atan2(
+        sqrt(a*a + b*b), sin_lat1*sin_lat2 + cos_lat1*cos_lat2*cos_dlon))
+  return distances
+
+
+class FeatureIndex(object):
+  """A list of Feature objects, bucketed into a grid of lat/lon cells.
+
+  This lets us find the features near a point by looking only at the cells
+  that overlap the search circle, instead of measuring the distance to every
+  feature in a layer.
+  """
+
+  def __init__(self, features, cell_degrees=FEATURE_INDEX_CELL_DEGREES):
+    self.features = features
+    self.cell_degrees = cell_degrees
+    self.cells = {}  # (lat_index, lon_index) => list of Feature objects
+    for f in features:
+      self.cells.setdefault(self.GetCell(f.location.lat, f.location.lon),
+                            []).append(f)
+
+  def GetCell(self, lat, lon):
+    """Gets the (lat_index, lon_index) of the cell containing a point."""
+    lon_cells = int(round(360 / self.cell_degrees))
+    return (int(math.floor(lat / self.cell_degrees)),
+            int(math.floor((lon + 180) / self.cell_degrees)) % lon_cells)
+
+  def GetNearby(self, center, radius):
+    """Gets copies of the features that might be within a circle.
+
+    Args:
+      center: The center of the circle, as an ndb.GeoPt.
+      radius: The radius of the circle, in metres.
+    Returns:
+      A list of copies of all the features within the circle, and possibly
+      some features slightly outside it.  The copies can be modified without
+      affecting the index.
+    """
+    dlat = radius / (EARTH_RADIUS * DEGREES)
+    lat_min, lat_max = max(center.lat - dlat, -90), min(center.lat + dlat, 90)
+    # Meridians converge towards the poles, so the circle spans more degrees
+    # of longitude there; near a pole, it can cover every longitude.
+    dlon = 180
+    if -90 < lat_min and lat_max < 90:
+      cos = min(math.cos(lat_min * DEGREES), math.cos(lat_max * DEGREES))
+      dlon = dlat / cos
+    if dlon >= 180:
+      lon_min, lon_max = -180, 180 - self.cell_degrees
+    else:
+      lon_min, lon_max = center.lon - dlon, center.lon + dlon
+
+    i_min, j_min = self.GetCell(lat_min, lon_min)
+    i_max, _ = self.GetCell(lat_max, lon_max)
+    lon_cells = int(round(360 / self.cell_degrees))
+    num_j = min(int(math.floor((lon_max - lon_min) / self.cell_degrees)) + 2,
+                lon_cells)
+    if (i_max - i_min + 1) * num_j >= len(self.cells):
+      # The circle covers more cells than are occupied; just check them all.
+      cells = [cell for (i, j), cell in self.cells.iteritems()
+               if i_min <= i <= i_max and (j - j_min) % lon_cells < num_j]
+    else:
+      cells = [self.cells.get((i, (j_min + dj) % lon_cells), [])
+               for i in range(i_min, i_max + 1) for dj in range(num_j)]
+    return [copy.copy(f) for cell in cells for f in cell]
 
 
 def GetText(element):
@@ -117,29 +316,78 @@ def GetText(element):
 
 
 def GetFeaturesFromXml(xml_content, layer_id=None):
-  """Extracts a list of Feature objects from KML, GeoRSS, or Atom content."""
-  root = kmlify.ParseXml(xml_content)
-  for element in root.getiterator():
-    element.tag = element.tag.split('}')[-1]  # remove XML namespaces
-  features = []
-  for item in (root.findall('.//Placemark') +
-               root.findall('.//entry') + root.findall('.//item')):
-    location = GetLocationFromXmlItem(item)
-    if not location:
+  """Extracts a list of Feature objects from KML, GeoRSS, or Atom content.
+
+  The features from all the <Placemark> elements come first, then those from
+  all the <entry> elements, then those from all the <item> elements; each
+  group is in document order.
+  """
+  xml = xml_content.replace('\r', '\n')  # as in kmlify.ParseXml
+  try:
+    return ExtractFeaturesFromXml(xml, layer_id)
+  except SyntaxError:
+    try:  # in case there's no root element, try adding one
+      return ExtractFeaturesFromXml('<_>' + xml + '</_>', layer_id)
+    except SyntaxError:
+      kmlify.ParseXml(xml_content)  # logs details about the error and raises
+      raise
+
+
+def ExtractFeaturesFromXml(xml, layer_id=None):
+  """Extracts Feature objects from XML without building the whole tree.
+
+  The XML is parsed incrementally, and each item (a <Placemark>, <entry>, or
+  <item> element) is dropped from the tree as soon as its Feature has been
+  made, so large feeds never need to be held in memory all at once.
+
+  Args:
+    xml: The XML content, as a string.
+    layer_id: The layer ID to set on the Features.
+  Returns:
+    A list of Feature objects, ordered as described in GetFeaturesFromXml.
+  Raises:
+    SyntaxError: The XML is not well-formed.
+  """
+  features = {tag: [] for tag in XML_ITEM_TAGS}  # tag => [(index, Feature)]
+  stack = []  # (element, index, is_item) for each element that is open
+  num_started = open_items = 0
+  for event, element in xml_utils.ElementTree.iterparse(
+      StringIO.StringIO(xml), ('start', 'end')):
+    if event == 'start':
+      # As with findall('.//...'), the root element itself is never an item.
+      is_item = bool(stack) and element.tag.split('}')[-1] in XML_ITEM_TAGS
+      stack.append((element, num_started, is_item))
+      num_started += 1
+      open_items += is_item
       continue
-    texts = {child.tag: GetText(child) for child in item.getchildren()}
-    # For now strip description of all the html tags to prevent XSS
-    # vulnerabilities except some basic text formatting tags
-    # TODO(user): sanitization should move closer to render time
-    # (revisit this once iframed version goes away) - b/17374443
-    description_html = (texts.get('description') or
-                        texts.get('content') or
-                        texts.get('summary') or '')
-    description_escaped = utils.StripHtmlTags(
-        description_html, tag_whitelist=['b', 'u', 'i', 'br'])
-    features.append(Feature(texts.get('title') or texts.get('name'),
-                            description_escaped, location, layer_id))
-  return features
+    element.tag = element.tag.split('}')[-1]  # remove XML namespaces
+    _, index, is_item = stack.pop()
+    if is_item:
+      open_items -= 1
+      location = GetLocationFromXmlItem(element)
+      if location:
+        features[element.tag].append(
+            (index, GetFeatureFromXmlItem(element, location, layer_id)))
+      if not open_items:
+        stack[-1][0].remove(element)  # we're done with this subtree
+  return [feature for tag in XML_ITEM_TAGS
+          for _, feature in sorted(features[tag], key=lambda pair: pair[0])]
+
+
+def GetFeatureFromXmlItem(item, location, layer_id=None):
+  """Makes a Feature from a <Placemark>, <entry>, or <item> element."""
+  texts = {child.tag: GetText(child) for child in item.getchildren()}
+  # For now strip description of all the html tags to prevent XSS
+  # vulnerabilities except some basic text formatting tags
+  # TODO(user): sanitization should move closer to render time
+  # (revisit this once iframed version goes away) - b/17374443
+  description_html = (texts.get('description') or
+                      texts.get('content') or
+                      texts.get('summary') or '')
+  description_escaped = utils.StripHtmlTags(
+      description_html, tag_whitelist=['b', 'u', 'i', 'br'])
+  return Feature(texts.get('title') or texts.get('name'),
+                 description_escaped, location, layer_id)
 
 
 def GetLocationFromXmlItem(item):
@@ -210,12 +458,13 @@ def GetGeoPt(place):
   return ndb.GeoPt(location['lat'], location['lng'])
 
 
-def GetFeaturesFromPlacesLayer(layer, location):
+def GetFeaturesFromPlacesLayer(layer, location, deadline=DEADLINE):
   """Builds a list of Feature objects for the Places layer near given location.
 
   Args:
     layer: Places layer that defines the criteria for places query
     location: db.GeoPt around which to retrieve places
+    deadline: Maximum number of seconds to wait for the Places API
   Returns:
     A list of Feature objects representing Google Places.
   """
@@ -227,8 +476,9 @@ def GetFeaturesFromPlacesLayer(layer, location):
       ('keyword', places_layer.get('keyword')),
       ('name', places_layer.get('name')),
       ('types', places_layer.get('types'))]
-  place_results = GetPlacesApiResults(PLACES_API_SEARCH_URL, request_params,
-                                      'results')
+  with TimeStage('places_search'):
+    place_results = GetPlacesApiResults(PLACES_API_SEARCH_URL, request_params,
+                                        'results', deadline)
 
   # Convert Places API results to Feature objects
   features = []
@@ -242,8 +492,9 @@ def GetFeaturesFromPlacesLayer(layer, location):
   return features
 
 
-def GetGooglePlaceDetails(place_id):
-  return GetPlacesApiResults(PLACES_API_DETAILS_URL, [('placeid', place_id)])
+def GetGooglePlaceDetails(place_id, deadline=DEADLINE):
+  return GetPlacesApiResults(PLACES_API_DETAILS_URL, [('placeid', place_id)],
+                             deadline=deadline)
 
 
 def GetGooglePlaceDescriptionHtml(place_details):
@@ -258,7 +509,8 @@ def GetGooglePlaceHtmlAttributions(place_details):
   return place_details.get('html_attributions', [])
 
 
-def GetPlacesApiResults(base_url, request_params, result_key_name=None):
+def GetPlacesApiResults(base_url, request_params, result_key_name=None,
+                        deadline=DEADLINE):
   """Fetches results from Places API given base_url and request params.
 
   Args:
@@ -266,6 +518,7 @@ def GetPlacesApiResults(base_url, request_params, result_key_name=None):
     request_params: An array of key and value pairs for the request
     result_key_name: Name of the results field in the Places API response
         or None if the whole response should be returned
+    deadline: Maximum number of seconds to wait for the Places API
   Returns:
     Value for the result_key_name in the Places API response or all of the
     response if result_key_name is None
@@ -278,8 +531,13 @@ def GetPlacesApiResults(base_url, request_params, result_key_name=None):
   url = base_url + urllib.urlencode([(k, v) for k, v in request_params if v])
 
   # Call Places API if cache doesn't have a corresponding entry for the url
-  response = JSON_PLACES_API_CACHE.Get(
-      url, lambda: urlfetch.fetch(url=url, deadline=DEADLINE))
+  try:
+    response = JSON_PLACES_API_CACHE.Get(
+        url, lambda: urlfetch.fetch(url=url, deadline=deadline))
+  except urlfetch.DeadlineExceededError:
+    # Fetch it with the full DEADLINE for later requests.
+    ScheduleCacheRefresh(JSON_PLACES_API_CACHE.name, url)
+    raise
 
   # Parse JSON results
   response_content = json.loads(response.content)
@@ -300,64 +558,159 @@ def GetLayer(root, layer_id):
   return {layer['id']: layer for layer in root['layers']}.get(layer_id)
 
 
-def GetFeatures(map_root, map_version_id, topic_id, request, location_center):
+def GetFeatures(map_root, map_version_id, topic_id, request, location_center,
+                radius=None):
   """Gets a list of Feature objects for a given topic.
 
+  The layers of the topic are fetched in parallel, each with a deadline of
+  LAYERS_DEADLINE.  Layers that fail or time out are left out of the results,
+  so one slow source doesn't hold up the whole card; the fetches that time
+  out are retried by tasks with a longer deadline, to fill the caches for
+  later requests.
+
   Args:
     map_root: A dictionary with all the topics and layers information
     map_version_id: ID of the map version
     topic_id: ID of the crowd report topic; features are retrieved from the
         layers associated with this topic
     request: Original card request
-    location_center: db.GeoPt around which to retrieve features. So far only
-        Places layer uses this to narrow results according to the
-        distance from this location. All other layers ignore this for now
-        and just return all features. Note that Places layer doesn't have a set
-        radius around location_center, it just tries to find features
-        as close as possible to location_center.
+    location_center: db.GeoPt around which to retrieve features.  Places
+        layers use this to narrow results according to the distance from
+        this location.  Note that Places layers don't have a set radius
+        around location_center, they just try to find features as close as
+        possible to location_center.
+    radius: Optional radius in metres.  If this and location_center are given,
+        features from other layers that are certainly farther than this from
+        location_center are left out.
 
   Returns:
     A list of Feature objects associated with layers of a given topic in a given
-    map.
+    map, in the order of the topic's layers.
   """
   topic = GetTopic(map_root, topic_id) or {}
+  layers = [GetLayer(map_root, layer_id) or {}
+            for layer_id in topic.get('layer_ids', [])]
+  with TimeStage('layers'):
+    results = utils.CallInParallel(
+        [WithRequestTimer(lambda layer=layer: GetLayerFeatures(
+            map_root, map_version_id, layer, request, location_center, radius))
+         for layer in layers], timeout=LAYERS_DEADLINE + 1)
   features = []
-  for layer_id in topic.get('layer_ids', []):
-    layer = GetLayer(map_root, layer_id)
-    if layer.get('type') == maproot.LayerType.GOOGLE_PLACES:
-      features += GetFeaturesFromPlacesLayer(layer, location_center)
-    else:
-      url = GetKmlUrl(request.root_url, layer or {})
-      if url:
-        try:
-          def GetXmlFeatures():
-            content = kmlify.FetchData(url, request.host)
-            return GetFeaturesFromXml(content, layer_id)
-          features += XML_FEATURES_CACHE.Get(
-              [url, map_root['id'], map_version_id, layer_id], GetXmlFeatures)
-        except (SyntaxError, urlfetch.DownloadError):
-          pass
+  for layer, layer_features in zip(layers, results):
+    if layer_features is None:
+      logging.warning('No features from layer %s in time', layer.get('id'))
+    features += layer_features or []
   return features
 
 
+def GetLayerFeatures(map_root, map_version_id, layer, request,
+                     location_center, radius=None):
+  """Gets a list of Feature objects for one layer.  See GetFeatures."""
+  if layer.get('type') == maproot.LayerType.GOOGLE_PLACES:
+    return GetFeaturesFromPlacesLayer(layer, location_center, LAYERS_DEADLINE)
+  url = GetKmlUrl(request.root_url, layer)
+  if not url:
+    return []
+  layer_id = layer.get('id')
+  key = [url, map_root['id'], map_version_id, layer_id]
+  try:
+    index = XML_FEATURES_CACHE.Get(key, lambda: GetFeatureIndexFromUrl(
+        url, layer_id, request.host, LAYERS_DEADLINE))
+  except urlfetch.DeadlineExceededError:
+    ScheduleCacheRefresh(XML_FEATURES_CACHE.name, key)
+    return []
+  except (SyntaxError, urlfetch.DownloadError):
+    return []
+  if location_center and radius is not None:
+    return index.GetNearby(location_center, radius)
+  return map(copy.copy, index.features)
+
+
+def GetFeatureIndexFromUrl(url, layer_id, host, deadline=DEADLINE):
+  """Fetches an XML layer and makes a FeatureIndex of its features."""
+  with TimeStage('xml_fetch'):
+    content = kmlify.FetchData(url, host, deadline)
+  with TimeStage('xml_parse'):
+    return FeatureIndex(GetFeaturesFromXml(content, layer_id))
+
+
+def ScheduleCacheRefresh(cache_name, key):
+  """Adds a task to refresh an entry in a cache of fetched data.
+
+  Args:
+    cache_name: The name of XML_FEATURES_CACHE or JSON_PLACES_API_CACHE.
+    key: The cache key of the entry.
+  """
+  taskqueue.add(
+      queue_name='card_cache_refresh', method='GET',
+      url=(config.Get('root_path') or '') + '/.card_cache_refresh',
+      params={'cache': cache_name, 'key': json.dumps(key)})
+
+
 def SetDistanceOnFeatures(features, center):
-  for f in features:
-    f.distance = EarthDistance(center, f.location)
+  with TimeStage('distance'):
+    for f, distance in zip(
+        features, EarthDistances(center, [f.location for f in features])):
+      f.distance = distance
 
 
 def FilterFeatures(features, radius, max_count):
-  # TODO(kpy): A top-k selection algorithm could be faster than O(n log n)
-  # sort.  It seems likely to me that the gain would be small enough that it's
-  # not worth the code complexity, but it wouldn't hurt to check my hunch.
-  features.sort()  # sorts by distance; see Feature.__cmp__
-  features[:] = [f for f in features[:max_count] if f.distance < radius]
+  """Keeps the max_count features nearest the center within the radius."""
+  # Selecting the top k with a heap takes O(n log k) instead of the O(n log n)
+  # of a full sort, and dropping the features outside the radius first makes
+  # n smaller.  tools/card_filter_benchmark.py measured this at about 10x
+  # faster than sorting for k = 5 (0.15 vs 1.6 ms for 1000 features, 1.3 vs
+  # 25 ms for 10k).  Like sort(), nsmallest() is stable.
+  with TimeStage('distance'):
+    features[:] = heapq.nsmallest(
+        max_count, [f for f in features if f.distance < radius],
+        key=operator.attrgetter('distance'))
 
 
 def GetFilteredFeatures(map_root, map_version_id, topic_id, request,
                         center, radius, max_count):
-  """Gets a list of the Feature objects for a topic within the given circle."""
+  """Gets a list of the Feature objects for a topic within the given circle.
+
+  Centers only 10 m apart rarely share a cache entry, so when there's a center
+  and the topic has no Places layers (whose results depend on the exact
+  center), the features are cached for a grid cell of size
+  FILTERED_FEATURES_CELL_DEGREES instead.  Each such entry holds every feature
+  that could be among the nearest max_count for some center in the cell, and
+  the features for the exact center are picked from those.
+  """
+  topic = GetTopic(map_root, topic_id) or {}
+  layer_types = [(GetLayer(map_root, layer_id) or {}).get('type')
+                 for layer_id in topic.get('layer_ids', [])]
+  if (center and FILTERED_FEATURES_CELL_DEGREES and
+      maproot.LayerType.GOOGLE_PLACES not in layer_types):
+    cell_id, cell_center, cell_radius = GetFeatureCell(
+        center, FILTERED_FEATURES_CELL_DEGREES)
+    def GetCandidates():
+      features = GetFeatures(map_root, map_version_id, topic_id, request,
+                             cell_center, radius + cell_radius)
+      SetDistanceOnFeatures(features, cell_center)
+      # The features within the radius of any point p in the cell are within
+      # radius + cell_radius of the cell center c.  Also, the max_count
+      # nearest features to c are within d + cell_radius of p, where d is the
+      # distance from c to the farthest of them; so the max_count nearest
+      # features to p are all within d + 2 * cell_radius of c.
+      nearest = heapq.nsmallest(max_count, [f.distance for f in features])
+      limit = radius + cell_radius
+      if len(nearest) == max_count and nearest:
+        limit = min(limit, nearest[-1] + 2 * cell_radius)
+      return [f for f in features if f.distance <= limit]
+
+    features = FILTERED_FEATURES_CACHE.Get(
+        [map_root['id'], map_version_id, topic_id, 'cell:' + cell_id, radius,
+         max_count], GetCandidates)
+    SetDistanceOnFeatures(features, center)
+    FilterFeatures(features, radius, max_count)
+    SetDetailsOnFilteredFeatures(features)
+    return features
+
   def GetFromDatastore():
-    features = GetFeatures(map_root, map_version_id, topic_id, request, center)
+    features = GetFeatures(map_root, map_version_id, topic_id, request, center,
+                           radius)
     if center:
       SetDistanceOnFeatures(features, center)
     FilterFeatures(features, radius, max_count)
@@ -371,13 +724,51 @@ def GetFilteredFeatures(map_root, map_version_id, topic_id, request,
        center and RoundGeoPt(center), radius, max_count], GetFromDatastore)
 
 
+def GetFeatureCell(point, cell_degrees):
+  """Finds the grid cell that contains a point.
+
+  Args:
+    point: An ndb.GeoPt.
+    cell_degrees: The size of the grid cells, in degrees.
+  Returns:
+    A 3-tuple (cell_id, cell_center, cell_radius) where cell_id is a string
+    that identifies the cell, cell_center is the center of the cell as an
+    ndb.GeoPt, and cell_radius is the distance in metres from the center to
+    the farthest point in the cell.
+  """
+  i = int(math.floor(point.lat / cell_degrees))
+  j = int(math.floor(point.lon / cell_degrees))
+  cell_center = ndb.GeoPt(min((i + 0.5) * cell_degrees, 90),
+                          min((j + 0.5) * cell_degrees, 180))
+  # The corner on the side nearer the equator is the farthest from the center.
+  corner_lat = (i + 1 if i < 0 else i) * cell_degrees
+  cell_radius = EarthDistance(
+      cell_center, ndb.GeoPt(max(-90, min(corner_lat, 90)), j * cell_degrees))
+  return '%d,%d' % (i, j), cell_center, cell_radius
+
+
 def SetDetailsOnFilteredFeatures(features):
-  # TODO(user): consider fetching details for each feature in parallel
-  for f in features:
-    if f.layer_type == maproot.LayerType.GOOGLE_PLACES:
-      place_details = GetGooglePlaceDetails(f.gplace_id)
-      f.description_html = GetGooglePlaceDescriptionHtml(place_details)
-      f.html_attrs = GetGooglePlaceHtmlAttributions(place_details)
+  """Fetches the details for all the Places features in parallel.
+
+  Features whose details can't be fetched within PLACE_DETAILS_DEADLINE are
+  left without a description.
+  """
+  def GetDetails(place_id):
+    place_details = GetGooglePlaceDetails(place_id, PLACE_DETAILS_DEADLINE)
+    return (GetGooglePlaceDescriptionHtml(place_details),
+            GetGooglePlaceHtmlAttributions(place_details))
+
+  places = [f for f in features
+            if f.layer_type == maproot.LayerType.GOOGLE_PLACES]
+  with TimeStage('places_details'):
+    details = utils.CallInParallel(
+        [lambda f=f: GetDetails(f.gplace_id) for f in places],
+        timeout=PLACE_DETAILS_DEADLINE + 1)
+  for f, place_details in zip(places, details):
+    if place_details:
+      f.description_html, f.html_attrs = place_details
+    else:
+      logging.warning('No details for place %s', f.gplace_id)
 
 
 def GetAnswersAndReports(map_id, topic_id, location, radius):
@@ -399,12 +790,71 @@ def GetAnswersAndReports(map_id, topic_id, location, radius):
     for the report ID.
   """
   full_topic_id = map_id + '.' + topic_id
-  answers, answer_times, report_dicts = {}, {}, []
-  now = datetime.datetime.utcnow()
   # Assume that all the most recently effective still-relevant answers are
   # contained among the 100 most recently updated CrowdReport entities.
-  for report in model.CrowdReport.GetByLocation(
-      location, {full_topic_id: radius}, 100, hidden=False):
+  return SummarizeReports(full_topic_id, model.CrowdReport.GetByLocation(
+      location, {full_topic_id: radius}, 100, hidden=False))
+
+
+def GetAnswersAndReportsForLocations(map_id, topic_id, locations, radius):
+  """Gets information on recent crowd reports for several locations at once.
+
+  The reports are read from the summaries kept by the CrowdReport model for
+  the grid cells near the locations or, if those would cover too large an
+  area, found with a single search within a circle covering all the
+  locations.  Each report is assigned to the nearest location within the
+  radius.
+
+  Args:
+    map_id: The map ID.
+    topic_id: The topic ID.
+    locations: A list of ndb.GeoPt objects.
+    radius: Radius in metres.
+  Returns:
+    A list of 3-tuples (latest_answers, answer_times, report_dicts), one for
+    each location, as described for GetAnswersAndReports.
+  """
+  if not locations:
+    return []
+  full_topic_id = map_id + '.' + topic_id
+  reports = model.CrowdReport.GetSummarizedByLocation(
+      full_topic_id, locations, radius)
+  if reports is None:
+    lats = [location.lat for location in locations]
+    lons = [location.lon for location in locations]
+    center = locations[0]
+    if max(lons) - min(lons) < 180:  # otherwise, the box spans the antimeridian
+      center = ndb.GeoPt((min(lats) + max(lats))/2.0,
+                         (min(lons) + max(lons))/2.0)
+    covering_radius = max(EarthDistances(center, locations)) + radius
+    reports = model.CrowdReport.GetByLocation(
+        center, {full_topic_id: covering_radius},
+        min(100 * len(locations), 1000), hidden=False)
+
+  reports_by_location = [[] for _ in locations]
+  for report in reports:
+    if report.location:
+      distance, i = min((distance, i) for i, distance in
+                        enumerate(EarthDistances(report.location, locations)))
+      if distance < radius:
+        reports_by_location[i].append(report)
+  return [SummarizeReports(full_topic_id, reports)
+          for reports in reports_by_location]
+
+
+def SummarizeReports(full_topic_id, reports):
+  """Gets the latest answers and reports for a topic from a list of reports.
+
+  Args:
+    full_topic_id: The topic ID, in the form map_id + '.' + topic_id.
+    reports: An iterable of CrowdReport objects.
+  Returns:
+    A 3-tuple (latest_answers, answer_times, report_dicts), as described for
+    GetAnswersAndReports.
+  """
+  answers, answer_times, report_dicts = {}, {}, []
+  now = datetime.datetime.utcnow()
+  for report in reports:
     if now - report.effective < MAX_ANSWER_AGE:
       report_dict = {}
       # The report's overall comment is stored under the special qid '_text'.
@@ -482,18 +932,21 @@ def SetAnswersAndReportsOnFeatures(features, map_root, topic_id, qids):
       return choice and choice.get('color')
 
   if topic.get('crowd_enabled') and qids:
+    # Find the reports for all the features with one search; the results
+    # are still cached separately for each feature location.
+    locations_by_key = {RoundGeoPt(f.location): f.location for f in features}
+    rounded_locations = locations_by_key.keys()
+    def MakeValues(keys):
+      # Search only around the locations whose entries are missing.
+      return GetAnswersAndReportsForLocations(
+          map_id, topic_id, [locations_by_key[key[2]] for key in keys], radius)
+
+    values_by_key = dict(zip(rounded_locations, REPORT_CACHE.GetMulti(
+        [[map_id, topic_id, rounded_location, radius]
+         for rounded_location in rounded_locations], MakeValues)))
     for f in features:
-      # Even though we use the radius to get the latest answers, the cache key
-      # omits radius so that InvalidateReportCache can quickly delete cache
-      # entries without fetching from the datastore.  So, when a cluster radius
-      # is changed and its map is republished, affected entries in the answer
-      # cache will be stale until they expire.  This seems like a good tradeoff
-      # because (a) changing a cluster radius in a published map is rare (less
-      # than once per map); (b) the answer cache has a short TTL (15 s); and
-      # (c) posting crowd reports is frequent (many times per day).
-      answers, answer_times, report_dicts = REPORT_CACHE.Get(
-          [map_id, topic_id, RoundGeoPt(f.location)],
-          lambda: GetAnswersAndReports(map_id, topic_id, f.location, radius))
+      answers, answer_times, report_dicts = values_by_key[
+          RoundGeoPt(f.location)]
       f.answers = answers
       f.answer_text = FormatAnswers(answers)
       if answer_times:
@@ -512,11 +965,15 @@ def SetAnswersAndReportsOnFeatures(features, map_root, topic_id, qids):
 
 
 def InvalidateReportCache(full_topic_ids, location):
-  """Deletes cached answers affected by a new report at a given location."""
+  """Deletes cached answers and cards affected by a new report at a location."""
   for full_topic_id in full_topic_ids:
     if '.' in full_topic_id:
       map_id, topic_id = full_topic_id.split('.')
-      REPORT_CACHE.Delete([map_id, topic_id, RoundGeoPt(location)])
+      cache.InvalidateTag(
+          ['card.reports', map_id, topic_id, RoundGeoPt(location)])
+      # A report can show up on any card whose radius covers it, so all the
+      # rendered cards for the topic are dropped.
+      cache.InvalidateTag(['card.output', map_id, topic_id])
 
 
 def RemoveParamsFromUrl(url, *params):
@@ -629,12 +1086,37 @@ class CardBase(base_handler.BaseHandler):
   def GetForMap(self, map_root, map_version_id, topic_id, map_label=None):
     """Renders the card for a particular map and topic.
 
+    A sample of requests (see CARD_TIMING_SAMPLE_RATE) is timed: the time
+    spent in each stage of rendering the card is logged and returned in a
+    Server-Timing header.
+
     Args:
       map_root: The MapRoot dictionary for the map.
       map_version_id: The version ID of the MapVersionModel (for a cache key).
       topic_id: The topic ID.
       map_label: The label of the published map (for analytics).
     """
+    timer = None
+    if random.random() < config.Get('card_timing_sample_rate',
+                                    CARD_TIMING_SAMPLE_RATE):
+      timer = REQUEST_TIMER.timer = utils.StageTimer()
+    try:
+      with TimeStage('total'):
+        self.WriteCard(map_root, map_version_id, topic_id, map_label)
+    finally:
+      REQUEST_TIMER.timer = None
+      if timer:
+        self.response.headers['Server-Timing'] = timer.GetServerTiming()
+        logging.info('Card timing: %s', json.dumps({
+            'map_id': map_root.get('id'),
+            'map_label': map_label,
+            'topic_id': topic_id,
+            'url': self.request.url,
+            'stages_ms': timer.GetMilliseconds()
+        }, sort_keys=True))
+
+  def WriteCard(self, map_root, map_version_id, topic_id, map_label=None):
+    """Writes out the card for a particular map and topic; see GetForMap."""
     topic = GetTopic(map_root, topic_id)
     if not topic:
       raise base_handler.Error(404, 'No such topic.')
@@ -684,13 +1166,14 @@ class CardBase(base_handler.BaseHandler):
       except (KeyError, TypeError, ValueError):
         logging.error('Could not extract center for ?place=%s', place_id)
 
-    try:
+    def RenderOutput():
       # Find POIs associated with the topic layers
       features = GetFilteredFeatures(
           map_root, map_version_id, topic_id, self.request,
           center, radius, max_count)
       html_attrs = GetFeatureAttributions(features)
-      SetAnswersAndReportsOnFeatures(features, map_root, topic_id, qids)
+      with TimeStage('reports'):
+        SetAnswersAndReportsOnFeatures(features, map_root, topic_id, qids)
       geojson = GetGeoJson(features, include_descriptions)
       geojson['properties'] = {
           'map_id': map_root.get('id'),
@@ -698,32 +1181,77 @@ class CardBase(base_handler.BaseHandler):
           'html_attrs': html_attrs,
           'unit': unit
       }
-      if output == 'json':
-        self.WriteJson(geojson)
-      else:
-        self.response.out.write(self.RenderTemplate('card.html', {
-            'features': geojson['features'],
-            'title': topic.get('title', ''),
-            'unit': unit,
-            'lang': lang,
-            'url_no_unit': RemoveParamsFromUrl(self.request.url, 'unit'),
-            'place': place,
-            'config_json': json.dumps({
-                'url_no_loc': RemoveParamsFromUrl(
-                    self.request.url, 'll', 'place'),
-                'place': place,
-                'location_unavailable': bool(location_unavailable),
-                'map_id': map_root.get('id', ''),
-                'topic_id': topic_id,
-                'map_label': map_label or '',
-                'topic_title': topic.get('title', '')
-            }),
-            'places_json': json.dumps(places),
-            'footer_html': RenderFooter(footer or [], html_attrs)
-        }))
+      with TimeStage('render'):
+        if output == 'json':
+          self.WriteJson(geojson)
+        else:
+          self.response.out.write(self.RenderTemplate('card.html', {
+              'features': geojson['features'],
+              'title': topic.get('title', ''),
+              'unit': unit,
+              'lang': lang,
+              'url_no_unit': RemoveParamsFromUrl(self.request.url, 'unit'),
+              'place': place,
+              'config_json': json.dumps({
+                  'url_no_loc': RemoveParamsFromUrl(
+                      self.request.url, 'll', 'place'),
+                  'place': place,
+                  'location_unavailable': bool(location_unavailable),
+                  'map_id': map_root.get('id', ''),
+                  'topic_id': topic_id,
+                  'map_label': map_label or '',
+                  'topic_title': topic.get('title', '')
+              }),
+              'places_json': json.dumps(places),
+              'footer_html': RenderFooter(footer or [], html_attrs)
+          }))
+      return {
+          'headers': {name: self.response.headers[name]
+                      for name in CARD_OUTPUT_HEADERS
+                      if name in self.response.headers},
+          'body': self.response.body,
+          'etag': '"%s"' % hashlib.sha1(self.response.body).hexdigest(),
+          'last_modified': int(time.time())
+      }
 
+    # The rendered card depends only on the map version, the request URL
+    # (which it embeds in links, so the host and exact parameters matter),
+    # the center, and the language and unit, which can also come from the
+    # request headers.
+    params = sorted(self.request.params.items())
+    key = [map_root.get('id'), map_version_id, topic_id, self.request.host_url,
+           self.request.path, lang, unit, center and RoundGeoPt(center), params]
+    try:
+      card_output = CARD_OUTPUT_CACHE.Get(key, RenderOutput)
     except Exception, e:  # pylint:disable=broad-except
       logging.exception(e)
+      return
+    self.WriteCachedOutput(card_output)
+
+  def WriteCachedOutput(self, output):
+    """Writes out a cached card, or a 304 response if the client has it.
+
+    Args:
+      output: A dictionary as stored in CARD_OUTPUT_CACHE.
+    """
+    self.response.clear()
+    self.response.headers.update(output['headers'])
+    self.response.headers['ETag'] = output['etag']
+    self.response.headers['Last-Modified'] = email.utils.formatdate(
+        output['last_modified'], usegmt=True)
+    if_none_match = self.request.headers.get('If-None-Match')
+    if_modified_since = email.utils.parsedate_tz(
+        self.request.headers.get('If-Modified-Since', ''))
+    if if_none_match is not None:
+      not_modified = (if_none_match.strip() == '*' or output['etag'] in [
+          tag.strip() for tag in if_none_match.split(',')])
+    else:
+      not_modified = bool(if_modified_since and email.utils.mktime_tz(
+          if_modified_since) >= output['last_modified'])
+    if not_modified:
+      self.response.set_status(304)
+    else:
+      self.response.out.write(output['body'])
 
   def GetDistanceUnitForCountry(self):
     unit = self.request.get('unit', '')
@@ -735,6 +1263,28 @@ class CardBase(base_handler.BaseHandler):
     return utils.GetDistanceUnitsForCountry(country_code)
 
 
+class CacheRefresh(base_handler.BaseHandler):
+  """Refreshes a stale entry in a cache of fetched data."""
+
+  def Get(self):
+    """Fetches the data for the entry; errors cause the task to be retried."""
+    # This handler fetches URLs given in the request, so it must only be run
+    # by tasks.  App Engine removes this header from external requests.
+    if 'X-AppEngine-QueueName' not in self.request.headers:
+      raise base_handler.Error(403, 'Only tasks can refresh cache entries.')
+    name = self.request.get('cache')
+    key = json.loads(self.request.get('key'))
+    if name == XML_FEATURES_CACHE.name:
+      url, _, _, layer_id = key
+      XML_FEATURES_CACHE.Refresh(key, lambda: GetFeatureIndexFromUrl(
+          url, layer_id, self.request.host))
+    elif name == JSON_PLACES_API_CACHE.name:
+      JSON_PLACES_API_CACHE.Refresh(
+          key, lambda: urlfetch.fetch(url=key, deadline=DEADLINE))
+    else:
+      raise base_handler.Error(400, 'No such cache.')
+
+
 class CardByIdAndTopic(CardBase):
   """Produces a card given a map ID and topic ID."""
 
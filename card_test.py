@@ -14,7 +14,10 @@
 
 import datetime
 import json
+import pickle
+import threading
 
+import cache
 import card
 import config
 import kmlify
@@ -212,6 +215,34 @@ class CardTest(test_utils.BaseTest):
     self.assertEquals(1.0, f1.distance_km)
     self.assertEquals(1000/1609.344, f1.distance_mi)
 
+  def testFeaturePickle(self):
+    f = card.Feature('1', 'one', ndb.GeoPt(1, 2), 'layer1', html_attrs=['x'])
+    f.distance = 1000
+    f.answers = {'q1': 'a1'}
+    self.assertFalse(hasattr(f, '__dict__'))
+    self.assertEquals(f, pickle.loads(pickle.dumps(f, pickle.HIGHEST_PROTOCOL)))
+    self.assertNotEquals(f, card.Feature('1', 'one', ndb.GeoPt(1, 2)))
+
+  def testFeatureUnpickleDict(self):
+    f = card.Feature('1', 'one', ndb.GeoPt(1, 2), 'layer1', 'KML')
+    f.answers = {'q1': 'a1'}
+
+    # Features pickled before Feature had __slots__ carry their __dict__.
+    class Feature(object):
+      pass
+    Feature.__module__ = 'card'
+    old = Feature()
+    old.__dict__ = dict(zip(card.Feature.__slots__, f.__getstate__()))
+    self.SetForTest(card, 'Feature', Feature)
+    old_pickles = [pickle.dumps(old), pickle.dumps(old, 2)]
+    card.Feature = type(f)  # unpickle with the current class
+
+    for old_pickle in old_pickles:
+      unpickled = pickle.loads(old_pickle)
+      self.assertEquals('1', unpickled.name)
+      self.assertEquals('KML', unpickled.layer_type)
+      self.assertEquals(f, unpickled)
+
   def testEarthDistance(self):
     def Distance(lat1, lon1, lat2, lon2):
       return card.EarthDistance(ndb.GeoPt(lat1, lon1), ndb.GeoPt(lat2, lon2))
@@ -221,9 +252,38 @@ class CardTest(test_utils.BaseTest):
     self.assertTrue(abs(Distance(0, 0, 0, 90) - 10018538) < 1)
     self.assertTrue(abs(Distance(45, 0, 45, 90) - 6679025) < 1)
 
+  def testFeatureIndex(self):
+    features = [card.Feature('a', '', ndb.GeoPt(10, 20)),
+                card.Feature('b', '', ndb.GeoPt(10.1, 20.1)),
+                card.Feature('c', '', ndb.GeoPt(12, 20)),
+                card.Feature('d', '', ndb.GeoPt(10, -179.9)),
+                card.Feature('e', '', ndb.GeoPt(89.9, 0))]
+    index = card.FeatureIndex(features)
+    nearby = lambda lat, lon, radius: sorted(
+        f.name for f in index.GetNearby(ndb.GeoPt(lat, lon), radius))
+    self.assertEquals(['a', 'b'], nearby(10, 20, 20000))
+    self.assertEquals(['a', 'b', 'c'], nearby(10, 20, 300000))
+    # Searches should wrap around the antimeridian and cover the poles.
+    self.assertEquals(['d'], nearby(10, 179.9, 30000))
+    self.assertEquals(['e'], nearby(89.9, 180, 30000))
+    self.assertEquals(['a', 'b', 'c', 'd', 'e'], nearby(0, 0, 2e7))
+
   def testInvalidContent(self):
     self.assertEquals([], card.GetFeaturesFromXml('xyz'))
 
+  def testGetFeaturesFromMixedXml(self):
+    # Placemarks come first, then entries, then items, even when nested.
+    xml = '''<doc>
+      <item><title>i1</title><point>1 1</point></item>
+      <Placemark><name>p1</name><coordinates>2,2</coordinates>
+        <entry><title>e1</title><point>3 3</point></entry>
+      </Placemark>
+      <Placemark><name>p2</name><coordinates>4,4</coordinates></Placemark>
+      <Placemark><name>no location</name></Placemark>
+    </doc>'''
+    self.assertEquals(['p1', 'p2', 'e1', 'i1'],
+                      [f.name for f in card.GetFeaturesFromXml(xml)])
+
   def testGetFeaturesFromKml(self):
     feature_fields = [(f.name, f.description_html, f.location)
                       for f in card.GetFeaturesFromXml(KML_DATA)]
@@ -441,28 +501,76 @@ class CardTest(test_utils.BaseTest):
                       [(f.name, f.description_html, f.html_attrs)
                        for f in features])
 
+  def testSetDetailsOnFilteredFeaturesWithFailedFetch(self):
+    config.Set('google_api_server_key', 'someFakeApiKey')
+
+    # One place's details can't be fetched; the other should still be set.
+    def FetchButSometimesFail(url, **unused_kwargs):
+      if 'placeId1' in url:
+        raise urlfetch.DownloadError
+      return utils.Struct(content=json.dumps({
+          'status': 'OK',
+          'html_attributions': ['attribution2'],
+          'result': {'formatted_address': 'Street2'}
+      }))
+    self.mox.stubs.Set(urlfetch, 'fetch', FetchButSometimesFail)
+
+    features = [
+        card.Feature('Helsinki', None, ndb.GeoPt(60, 25), 'layer4',
+                     gplace_id='placeId1', layer_type='GOOGLE_PLACES'),
+        card.Feature('Columbus', None, ndb.GeoPt(40, -83), 'layer4',
+                     gplace_id='placeId2', layer_type='GOOGLE_PLACES')
+    ]
+    card.SetDetailsOnFilteredFeatures(features)
+    self.assertEquals([('Helsinki', None, []),
+                       ('Columbus', '<div>Street2</div><div></div>',
+                        ['attribution2'])],
+                      [(f.name, f.description_html, f.html_attrs)
+                       for f in features])
+
   def testGetFeatures(self):
     # Try getting features for a topic with two layers.
-    self.SetForTest(kmlify, 'FetchData', lambda url, host: 'data from ' + url)
-    self.SetForTest(card, 'GetFeaturesFromXml',
-                    lambda data, layer: ['parsed ' + data + ' for ' + layer])
+    self.SetForTest(kmlify, 'FetchData', lambda url, *_: 'data from ' + url)
+    self.SetForTest(card, 'GetFeaturesFromXml', lambda data, layer: [
+        card.Feature('parsed %s for %s' % (data, layer), '', ndb.GeoPt(20, 50))
+    ])
     self.assertEquals(
         ['parsed data from http://example.com/one.kml for layer1',
          'parsed data from http://example.com/three.kml for layer3'],
-        card.GetFeatures(MAP_ROOT, 'm1', 't1', self.request, ndb.GeoPt(20, 50)))
+        [f.name for f in card.GetFeatures(
+            MAP_ROOT, 'm1', 't1', self.request, ndb.GeoPt(20, 50))])
+
+  def testGetFeaturesWithinRadius(self):
+    # Features that are far from the center should be left out.
+    self.SetForTest(kmlify, 'FetchData', lambda url, *_: 'data from ' + url)
+    self.SetForTest(card, 'GetFeaturesFromXml', lambda data, layer: [
+        card.Feature('near ' + layer, '', ndb.GeoPt(20, 50)),
+        card.Feature('far ' + layer, '', ndb.GeoPt(-20, 50))])
+    self.assertEquals(
+        ['near layer1', 'near layer3'],
+        [f.name for f in card.GetFeatures(
+            MAP_ROOT, 'm1', 't1', self.request, ndb.GeoPt(20, 50), 1000)])
+
+    # The features returned should be copies of the cached ones.
+    features = card.GetFeatures(MAP_ROOT, 'm1', 't1', self.request,
+                                ndb.GeoPt(20, 50))
+    features[0].distance = 5
+    self.assertEquals(None, card.GetFeatures(
+        MAP_ROOT, 'm1', 't1', self.request, ndb.GeoPt(20, 50))[0].distance)
 
   def testGetFeaturesWithFailedFetches(self):
     # Even if some fetches fail, we should get features from the others.
-    def FetchButSometimesFail(url, unused_host):
+    def FetchButSometimesFail(url, *unused_args):
       if 'one.kml' in url:
         raise urlfetch.DownloadError
       return 'data from ' + url
     self.SetForTest(kmlify, 'FetchData', FetchButSometimesFail)
-    self.SetForTest(card, 'GetFeaturesFromXml',
-                    lambda data, layer: ['parsed ' + data])
+    self.SetForTest(card, 'GetFeaturesFromXml', lambda data, layer: [
+        card.Feature('parsed ' + data, '', ndb.GeoPt(20, 50))])
     self.assertEquals(['parsed data from http://example.com/three.kml'],
-                      card.GetFeatures(MAP_ROOT, 'm1', 't1', self.request,
-                                       ndb.GeoPt(20, 50)))
+                      [f.name for f in card.GetFeatures(
+                          MAP_ROOT, 'm1', 't1', self.request,
+                          ndb.GeoPt(20, 50))])
 
   def testGetFeaturesWithFailedParsing(self):
     # Even if some files don't parse, we should get features from the others.
@@ -471,12 +579,94 @@ class CardTest(test_utils.BaseTest):
         return
       if 'three.kml' in data:
         raise SyntaxError
-      return ['parsed ' + data]
-    self.SetForTest(kmlify, 'FetchData', lambda url, host: 'data from ' + url)
+      return [card.Feature('parsed ' + data, '', ndb.GeoPt(20, 50))]
+    self.SetForTest(kmlify, 'FetchData', lambda url, *_: 'data from ' + url)
     self.SetForTest(card, 'GetFeaturesFromXml', ParseButSometimesFail)
     self.assertEquals(['parsed data from http://example.com/one.kml'],
-                      card.GetFeatures(MAP_ROOT, 'm1', 't1', self.request,
-                                       ndb.GeoPt(20, 50)))
+                      [f.name for f in card.GetFeatures(
+                          MAP_ROOT, 'm1', 't1', self.request,
+                          ndb.GeoPt(20, 50))])
+
+  def testGetFeaturesWithSlowLayer(self):
+    # A layer that takes too long should be left out, not hold up the others.
+    release = threading.Event()
+    def FetchButSometimesStall(url, *unused_args):
+      if 'one.kml' in url:
+        release.wait(10)
+      return 'data from ' + url
+    self.SetForTest(kmlify, 'FetchData', FetchButSometimesStall)
+    self.SetForTest(card, 'GetFeaturesFromXml', lambda data, layer: [
+        card.Feature('parsed ' + data, '', ndb.GeoPt(20, 50))])
+    self.SetForTest(card, 'LAYERS_DEADLINE', 0.1)
+    try:
+      self.assertEquals(['parsed data from http://example.com/three.kml'],
+                        [f.name for f in card.GetFeatures(
+                            MAP_ROOT, 'm1', 't1', self.request,
+                            ndb.GeoPt(20, 50))])
+    finally:
+      release.set()
+
+  def testGetFeaturesWithTimedOutLayer(self):
+    # A layer that times out should be left out, and fetched again in a task
+    # with a longer deadline.
+    deadlines = []
+    def FetchButSometimesTimeOut(url, unused_host, deadline):
+      deadlines.append(deadline)
+      if 'one.kml' in url and deadline < card.DEADLINE:
+        raise urlfetch.DeadlineExceededError
+      return 'data from ' + url
+    self.SetForTest(kmlify, 'FetchData', FetchButSometimesTimeOut)
+    self.SetForTest(card, 'GetFeaturesFromXml', lambda data, layer: [
+        card.Feature('parsed ' + data, '', ndb.GeoPt(20, 50))])
+
+    def GetNames():
+      return [f.name for f in card.GetFeatures(
+          MAP_ROOT, 'm1', 't1', self.request, ndb.GeoPt(20, 50))]
+
+    self.assertEquals(['parsed data from http://example.com/three.kml'],
+                      GetNames())
+    self.assertEquals([card.LAYERS_DEADLINE] * 2, deadlines)
+    task, = self.PopTasks('card_cache_refresh')
+    self.DoGet(task['url'][len(test_utils.ROOT_PATH):],
+               headers={'X-AppEngine-QueueName': 'card_cache_refresh'})
+    self.assertEquals(card.DEADLINE, deadlines[-1])
+    self.assertEquals(['parsed data from http://example.com/one.kml',
+                       'parsed data from http://example.com/three.kml'],
+                      GetNames())
+
+  def testGetFeaturesWithStaleLayers(self):
+    # Stale layers should be used right away and refreshed later by tasks.
+    fetches = []
+    def Fetch(url, *unused_args):
+      fetches.append(url)
+      return 'data %d' % len(fetches)
+    self.SetForTest(kmlify, 'FetchData', Fetch)
+    self.SetForTest(card, 'GetFeaturesFromXml', lambda data, layer: [
+        card.Feature(data, '', ndb.GeoPt(20, 50))])
+
+    def GetNames():
+      return sorted(f.name for f in card.GetFeatures(
+          MAP_ROOT, 'm1', 't1', self.request, ndb.GeoPt(20, 50)))
+
+    self.SetTime(1000)
+    self.assertEquals(['data 1', 'data 2'], GetNames())
+    self.assertEquals([], self.PopTasks('card_cache_refresh'))
+
+    self.SetTime(1290)  # past the cooling time
+    cache.LOCAL_CACHE.Clear()  # as in another app instance
+    self.assertEquals(['data 1', 'data 2'], GetNames())
+    self.assertEquals(2, len(fetches))
+    paths = [task['url'][len(test_utils.ROOT_PATH):]
+             for task in self.PopTasks('card_cache_refresh')]
+    self.assertEquals(2, len(paths))
+
+    # The refresh handler fetches URLs, so it should only be run by tasks.
+    self.DoGet(paths[0], 403)
+    for path in paths:
+      self.DoGet(path, headers={'X-AppEngine-QueueName': 'card_cache_refresh'})
+    self.assertEquals(4, len(fetches))
+    cache.LOCAL_CACHE.Clear()
+    self.assertEquals(['data 3', 'data 4'], GetNames())
 
   def testGetFeaturesWithInvalidTopicId(self):
     # GetFeatures should accept a nonexistent topic without raising exceptions.
@@ -511,6 +701,47 @@ class CardTest(test_utils.BaseTest):
            '_text': 'goodbye'}]),
         card.GetAnswersAndReports('m1', 't1', 'location', 100))
 
+  def testGetAnswersAndReportsForLocations(self):
+    now = datetime.datetime.utcnow()
+    reports = [
+        model.CrowdReport(answers_json='{"m1.t1.q1": "a1"}', id='r1', text='',
+                          effective=now, location=ndb.GeoPt(1, 1.0001)),
+        model.CrowdReport(answers_json='{"m1.t1.q1": "a2"}', id='r2', text='',
+                          effective=now, location=ndb.GeoPt(1, 1.0009)),
+        # Too far from any of the locations.
+        model.CrowdReport(answers_json='{"m1.t1.q1": "a3"}', id='r3', text='',
+                          effective=now, location=ndb.GeoPt(1, 1.01))
+    ]
+    summaries, searches = [], []
+    def FakeGetSummarizedByLocation(topic_id, centers, radius):
+      summaries.append((topic_id, centers, radius))
+      return reports if radius < 1000 else None
+    def FakeGetByLocation(center, topic_radii, *unused_args, **unused_kwargs):
+      searches.append((center, topic_radii))
+      return reports
+    self.SetForTest(model.CrowdReport, 'GetSummarizedByLocation',
+                    staticmethod(FakeGetSummarizedByLocation))
+    self.SetForTest(model.CrowdReport, 'GetByLocation',
+                    staticmethod(FakeGetByLocation))
+    locations = [ndb.GeoPt(1, 1), ndb.GeoPt(1, 1.001), ndb.GeoPt(2, 2)]
+    results = card.GetAnswersAndReportsForLocations('m1', 't1', locations, 100)
+    # The reports for all the locations are read from the summaries at once.
+    self.assertEquals([('m1.t1', locations, 100)], summaries)
+    self.assertEquals([], searches)
+    # Each report goes to the nearest location.
+    self.assertEquals([{'q1': 'a1'}, {'q1': 'a2'}, {}],
+                      [answers for answers, _, _ in results])
+    self.assertEquals([['r1'], ['r2'], []],
+                      [[r['_id'] for r in report_dicts]
+                       for _, _, report_dicts in results])
+
+    # For large radii, one search covers all the locations.
+    card.GetAnswersAndReportsForLocations('m1', 't1', locations, 1000)
+    self.assertEquals(1, len(searches))
+    center, topic_radii = searches[0]
+    self.assertTrue(all(card.EarthDistance(center, location) + 1000 <=
+                        topic_radii['m1.t1'] for location in locations))
+
   def testGetLegibleTextColor(self):
     # Black on a light background; white on a dark background
     self.assertEquals('#000', card.GetLegibleTextColor('#999'))
@@ -524,7 +755,8 @@ class CardTest(test_utils.BaseTest):
     features = [card.Feature('title1', 'description1', ndb.GeoPt(1, 1)),
                 card.Feature('title2', 'description2', ndb.GeoPt(2, 2))]
     now = datetime.datetime.utcnow()
-    def FakeGetAnswersAndReports(unused_1, unused_2, location, unused_3):
+    calls = []
+    def FakeGetAnswersAndReports(location):
       if location.lat < 1.5:
         return ({'q1': 'a1', '_text': 'hello'},
                 {'q1': now, '_text': now},
@@ -535,7 +767,12 @@ class CardTest(test_utils.BaseTest):
                 {'q1': now, 'q2': now, '_text': now},
                 [{'_id': 'r2', '_effective': now,
                   'q1': 'a2', 'q2': 3, '_text': 'goodbye'}])
-    self.SetForTest(card, 'GetAnswersAndReports', FakeGetAnswersAndReports)
+    def FakeGetAnswersAndReportsForLocations(
+        unused_map_id, unused_topic_id, locations, unused_radius):
+      calls.append(locations)
+      return map(FakeGetAnswersAndReports, locations)
+    self.SetForTest(card, 'GetAnswersAndReportsForLocations',
+                    FakeGetAnswersAndReportsForLocations)
     card.SetAnswersAndReportsOnFeatures(
         features, MAP_ROOT, 't1', ['q1', 'q2', '_text'])
     self.assertEquals('Green.', features[0].answer_text)
@@ -550,6 +787,43 @@ class CardTest(test_utils.BaseTest):
         [{'answer_summary': 'Red. Qux: 3.', 'effective': 'just now',
           'id': 'r2', 'text': 'goodbye', 'status_color': '#f00'}],
         features[1].reports)
+    # Reports for both features were found with a single search.
+    self.assertEquals(1, len(calls))
+
+    # With one feature's reports cached, only the other location is searched.
+    features.append(card.Feature('title3', 'description3', ndb.GeoPt(3, 3)))
+    card.SetAnswersAndReportsOnFeatures(
+        features, MAP_ROOT, 't1', ['q1', 'q2', '_text'])
+    self.assertEquals([ndb.GeoPt(3, 3)], calls[1])
+    self.assertEquals(2, len(calls))
+
+  def testGetFilteredFeaturesSharedByCell(self):
+    calls = []
+    def FakeGetFeatures(unused_map_root, unused_map_version_id,
+                        unused_topic_id, unused_request, center, radius):
+      calls.append((center, radius))
+      return [card.Feature('f%d' % i, '', ndb.GeoPt(20 + i * 0.001, 50))
+              for i in range(20)]
+    self.SetForTest(card, 'GetFeatures', FakeGetFeatures)
+
+    # Nearby centers in the same grid cell share one cache entry, but each
+    # gets the features nearest to itself.
+    features = card.GetFilteredFeatures(
+        MAP_ROOT, 'm1', 't1', self.request, ndb.GeoPt(20.0012, 50.001), 500, 3)
+    self.assertEquals(['f1', 'f2', 'f0'], [f.name for f in features])
+    features = card.GetFilteredFeatures(
+        MAP_ROOT, 'm1', 't1', self.request, ndb.GeoPt(20.0082, 50.001), 500, 3)
+    self.assertEquals(['f8', 'f9', 'f7'], [f.name for f in features])
+    self.assertEquals(1, len(calls))
+    cell_id, cell_center, cell_radius = card.GetFeatureCell(
+        ndb.GeoPt(20.001, 50.001), card.FILTERED_FEATURES_CELL_DEGREES)
+    self.assertEquals('2000,5000', cell_id)
+    self.assertEquals([(cell_center, 500 + cell_radius)], calls)
+
+    # Topics with Places layers are cached for the exact center.
+    card.GetFilteredFeatures(
+        MAP_ROOT, 'm1', 't3', self.request, ndb.GeoPt(20.001, 50.001), 500, 3)
+    self.assertEquals((ndb.GeoPt(20.001, 50.001), 500), calls[-1])
 
   def testSetDistanceOnFeatures(self):
     features = [card.Feature('title1', 'description1', ndb.GeoPt(1, 1)),
@@ -617,7 +891,7 @@ class CardHandlerTest(test_utils.BaseTest):
       model.CatalogEntry.Create('xyz.com', 'foo', map_object)
 
   def testGetCardByIdAndTopic(self):
-    self.SetForTest(kmlify, 'FetchData', lambda url, host: KML_DATA)
+    self.SetForTest(kmlify, 'FetchData', lambda url, *_: KML_DATA)
     with test_utils.RootLogin():
       response = self.DoGet('/.card/%s.t1' % self.map_id)
     self.assertTrue('Topic 1' in response.body)
@@ -625,7 +899,7 @@ class CardHandlerTest(test_utils.BaseTest):
     self.assertTrue('Columbus' in response.body)
 
   def testGetCardByLabelAndTopic(self):
-    self.SetForTest(kmlify, 'FetchData', lambda url, host: KML_DATA)
+    self.SetForTest(kmlify, 'FetchData', lambda url, *_: KML_DATA)
     response = self.DoGet('/xyz.com/.card/foo/t1')
     self.assertTrue('Topic 1' in response.body)
     self.assertTrue('Helsinki' in response.body)
@@ -635,7 +909,7 @@ class CardHandlerTest(test_utils.BaseTest):
     self.assertFalse('description' in response.body)
 
   def testGetCardByLabelAndTopicWithDescriptionsEnabled(self):
-    self.SetForTest(kmlify, 'FetchData', lambda url, host: KML_DATA)
+    self.SetForTest(kmlify, 'FetchData', lambda url, *_: KML_DATA)
     # Enable descriptions with show_desc=1 param in the request
     response = self.DoGet('/xyz.com/.card/foo/t1?show_desc=1')
     self.assertTrue('Topic 1' in response.body)
@@ -660,7 +934,7 @@ class CardHandlerTest(test_utils.BaseTest):
           </Document>
         </kml>
         '''
-    self.SetForTest(kmlify, 'FetchData', lambda url, host: kml_data_with_xss)
+    self.SetForTest(kmlify, 'FetchData', lambda url, *_: kml_data_with_xss)
     # Enable descriptions with show_desc=1 param in the request
     response = self.DoGet('/xyz.com/.card/foo/t1?show_desc=1')
     self.assertTrue('Paris' in response.body)
@@ -669,25 +943,76 @@ class CardHandlerTest(test_utils.BaseTest):
     self.assertFalse('<script>EvilScript</script>' in response.body)
 
   def testPostByLabelAndTopic(self):
-    self.SetForTest(kmlify, 'FetchData', lambda url, host: KML_DATA)
+    self.SetForTest(kmlify, 'FetchData', lambda url, *_: KML_DATA)
     response = self.DoPost('/xyz.com/.card/foo/t1', 'll=60,25&n=1&r=100')
     self.assertTrue('Topic 1' in response.body)
     self.assertTrue('Helsinki' in response.body)
     self.assertFalse('Columbus' in response.body)
 
+  def testCardOutputCache(self):
+    self.SetForTest(kmlify, 'FetchData', lambda url, *_: KML_DATA)
+    calls = []
+    def FakeSetAnswersAndReportsOnFeatures(*unused_args):
+      calls.append(1)
+    self.SetForTest(card, 'SetAnswersAndReportsOnFeatures',
+                    FakeSetAnswersAndReportsOnFeatures)
+    url = '/xyz.com/.card/foo/t1?ll=60,25'
+    response = self.DoGet(url)
+    self.assertTrue('Helsinki' in response.body)
+    etag = response.headers['ETag']
+    last_modified = response.headers['Last-Modified']
+    self.assertEquals(1, len(calls))
+
+    # A repeated request is served from the cache.
+    self.assertEquals(response.body, self.DoGet(url).body)
+    self.assertEquals(1, len(calls))
+
+    # Clients that already have the card get a 304.
+    response = self.DoGet(url, 304, headers={'If-None-Match': etag})
+    self.assertEquals('', response.body)
+    self.DoGet(url, 304, headers={'If-Modified-Since': last_modified})
+    self.DoGet(url, 200, headers={'If-None-Match': '"other"'})
+
+    # A new report for the topic invalidates the cached card.
+    card.InvalidateReportCache(['%s.t1' % self.map_id], ndb.GeoPt(1, 2))
+    self.DoGet(url)
+    self.assertEquals(2, len(calls))
+
+    # The card's links are built from the request URL, so requests with a
+    # different scheme or an unrounded location don't share its entry.
+    self.DoGet(url, https=True)
+    self.assertEquals(3, len(calls))
+    self.DoGet('/xyz.com/.card/foo/t1?ll=60.00001,25')
+    self.assertEquals(4, len(calls))
+
+  def testCardTiming(self):
+    self.SetForTest(kmlify, 'FetchData', lambda url, *_: KML_DATA)
+    self.SetForTest(card, 'CARD_TIMING_SAMPLE_RATE', 1)
+    response = self.DoGet('/xyz.com/.card/foo/t1?ll=60,25')
+    stages = [item.split(';')[0]
+              for item in response.headers['Server-Timing'].split(', ')]
+    for stage in ['layers', 'xml_fetch', 'xml_parse', 'distance', 'reports',
+                  'render', 'total']:
+      self.assertTrue(stage in stages, stage)
+
+    # Sampling can be turned off in the config.
+    config.Set('card_timing_sample_rate', 0)
+    response = self.DoGet('/xyz.com/.card/foo/t1?ll=60,25')
+    self.assertFalse('Server-Timing' in response.headers)
+
   def testGetCardByTopic(self):
     response = self.DoGet('/xyz.com/.card/foo')
     self.assertEquals('foo/t1', response.headers['Location'])
 
   def testPlacesMenu(self):
-    self.SetForTest(kmlify, 'FetchData', lambda url, host: KML_DATA)
+    self.SetForTest(kmlify, 'FetchData', lambda url, *_: KML_DATA)
     response = self.DoGet('/xyz.com/.card/foo/t2?places=' + json.dumps(
         [{'id': 'x', 'name': 'Place Foo'}, {'id': 'y', 'name': 'Place Bar'}]))
     self.assertTrue('Place Foo' in response.body)
     self.assertTrue('Place Bar' in response.body)
 
   def testGetJsonByLabelAndTopic(self):
-    self.SetForTest(kmlify, 'FetchData', lambda url, host: KML_DATA)
+    self.SetForTest(kmlify, 'FetchData', lambda url, *_: KML_DATA)
     response = self.DoGet('/xyz.com/.card/foo/t2?output=json')
     geojson = json.loads(response.body)
     self.assertEquals('FeatureCollection', geojson['type'])
@@ -708,7 +1033,7 @@ class CardHandlerTest(test_utils.BaseTest):
                           ['Listing by <a href="google.com">Google</a>']))
 
   def testFeatureDistanceUnits(self):
-    self.SetForTest(kmlify, 'FetchData', lambda url, host: KML_DATA)
+    self.SetForTest(kmlify, 'FetchData', lambda url, *_: KML_DATA)
 
     # Default: no units in the request, no auto-detected country
     self.AssertUnitsInResponseTo('km', '/xyz.com/.card/foo/t1?output=json')
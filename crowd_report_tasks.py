@@ -62,3 +62,12 @@ class Cleanup(base_handler.BaseHandler):
 
     count = self.FetchAndDelete(query)
     logging.info('Deleted %d expired CrowdReportModel entries', count)
+
+
+class UpdateSummary(base_handler.BaseHandler):
+  """Retries a failed update to a crowd report summary."""
+
+  def Get(self):
+    """Updates one report's item in one summary; errors cause a retry."""
+    model.CrowdReport.UpdateSummary(self.request.get('summary_id'),
+                                    self.request.get('report_id'))
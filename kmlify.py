@@ -18,15 +18,18 @@ __author__ = 'kpy@google.com (Ka-Ping Yee)'
 import base_handler
 
 import StringIO
-import collections
 import csv
+import hashlib
+import itertools
 import json
 import logging
 import re
 import string
+import struct
 import urllib
 import xml_utils
 import zipfile
+import zlib
 
 import cache
 
@@ -52,7 +55,20 @@ OPERATORS = {
     '>=': lambda x, y: x >= y,
 }
 CACHE_TTL_SECONDS = 60
-CACHE = cache.Cache('kmlify', CACHE_TTL_SECONDS)
+# KMZ blobs are large, and already compressed, so they get a local RAM budget
+# of their own and are stored in memcache without further compression.
+CACHE = cache.Cache('kmlify', CACHE_TTL_SECONDS,
+                    local_max_bytes=8 * 1024 * 1024,
+                    codec=cache.Codec(compress_threshold=None))
+
+# Join tables, as (fieldnames, rows) pairs from Kmlifier.ReadJoinTable, keyed
+# by [join_url, SHA-1 hash of the join data, join_field, sorted fields], so
+# that conversions using the same table share one parsed copy.  The hash
+# ensures that a changed table is never served stale, so entries can live
+# long.  The values are kept unpickled in the local cache (see immutable in
+# cache.Cache), so they must be treated as read-only.
+JOIN_CACHE = cache.Cache('kmlify.join', 3600,
+                         local_max_bytes=8 * 1024 * 1024, immutable=True)
 
 
 def Stringify(text, html=False):
@@ -131,16 +147,83 @@ def UnzipData(data, preferred_filename_regex='.*'):
   return ''  # zip archive contains no entries, return ''
 
 
+def Crc32Combine(crc1, crc2, length2):
+  """Gets the CRC-32 of a + b, given the CRC-32s of a and b and len(b)."""
+  # The CRC is affine in its starting value, so running crc1 through length2
+  # zero bytes and cancelling the constant part gives the effect of a on the
+  # CRC of a + b.  zlib.crc32 does this in C, without needing a or b.
+  zeros = '\0' * min(length2, 65536)
+  shifted_crc1, zeros_crc = crc1, 0
+  while length2 > 0:
+    chunk = zeros[:length2]
+    shifted_crc1 = zlib.crc32(chunk, shifted_crc1)
+    zeros_crc = zlib.crc32(chunk, zeros_crc)
+    length2 -= len(chunk)
+  return (shifted_crc1 ^ zeros_crc ^ crc2) & 0xffffffff
+
+
+class KmzWriter(object):
+  """Builds a KMZ file whose doc.kml is compressed as it is written.
+
+  Only the compressed data is kept in memory.  Because KML styles have to
+  come before the placemarks that use them, but aren't all known until the
+  last placemark has been seen, Finish() can also insert a prefix at the
+  start of doc.kml after everything else has been written.
+  """
+
+  def __init__(self):
+    self.compressor = zlib.compressobj(
+        zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    self.chunks = []  # compressed data
+    self.crc = 0
+    self.size = 0
+
+  def Write(self, data):
+    """Appends a string to doc.kml."""
+    self.crc = zlib.crc32(data, self.crc)
+    self.size += len(data)
+    self.chunks.append(self.compressor.compress(data))
+
+  def Finish(self, prefix=''):
+    """Returns the KMZ file, with the given prefix at the start of doc.kml."""
+    # A raw deflate stream that ends with a full flush (rather than a final
+    # block) can be followed directly by another deflate stream.
+    prefix_compressor = zlib.compressobj(
+        zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = ''.join([prefix_compressor.compress(prefix),
+                    prefix_compressor.flush(zlib.Z_FULL_FLUSH)] +
+                   self.chunks + [self.compressor.flush()])
+    crc = Crc32Combine(zlib.crc32(prefix), self.crc, self.size)
+    size = len(prefix) + self.size
+
+    # Write the zip file structures by hand; see section 4.3 of
+    # https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT
+    name = 'doc.kml'
+    version = 20  # 2.0, the first version with deflate compression
+    dos_time, dos_date = 0, (0 << 9) | (1 << 5) | 1  # 1980-01-01 00:00:00
+    common = struct.pack('<5H3L', version, 0, zipfile.ZIP_DEFLATED, dos_time,
+                         dos_date, crc, len(data), size)
+    local_header = 'PK\x03\x04' + common + struct.pack('<2H', len(name), 0)
+    central_directory = ''.join([
+        'PK\x01\x02', struct.pack('<H', (3 << 8) | version),  # made by Unix
+        common, struct.pack('<5HL', len(name), 0, 0, 0, 0, 0644 << 16),
+        struct.pack('<L', 0), name])  # offset of the local header
+    end = 'PK\x05\x06' + struct.pack(
+        '<4H2LH', 0, 0, 1, 1, len(central_directory),
+        len(local_header) + len(name) + len(data), 0)
+    return local_header + name + data + central_directory + end
+
+
 def MakeKmz(kml):
   """Packs a KML document into a KMZ file."""
-  output_buffer = StringIO.StringIO()
-  archive = zipfile.ZipFile(output_buffer, 'w')
-  info = zipfile.ZipInfo('doc.kml')
-  info.external_attr = 0644 << 16L  # Unix permission bits
-  info.compress_type = zipfile.ZIP_DEFLATED
-  archive.writestr(info, kml)
-  archive.close()
-  return output_buffer.getvalue()
+  writer = KmzWriter()
+  writer.Write(kml)
+  return writer.Finish()
+
+
+def SerializeChild(element):
+  """Serializes an element as an indented child of the root element."""
+  return '  ' + xml_utils.Serialize(element, level=1) + '\n'
 
 
 def Compare(op, lhs, rhs):
@@ -162,10 +245,6 @@ def NormalizeFieldName(name):
   return '_'.join(re.sub(r'[^/\w.@#]', ' ', name).split())
 
 
-def NormalizeRecord(record):
-  return {NormalizeFieldName(key): record[key].strip() for key in record}
-
-
 def Decode(s, encoding):
   try:
     return s.decode(encoding)
@@ -173,21 +252,17 @@ def Decode(s, encoding):
     return s.decode('latin-1')
 
 
-def DecodeRecord(record, encoding):
-  return {Decode(key, encoding): Decode(value, encoding)
-          for key, value in record.items()}
-
-
 def GetText(element):
   return (element.text or '') + ''.join(
       GetText(child) + (child.tail or '') for child in element.getchildren())
 
 
-def FetchData(url, referer=None):
+def FetchData(url, referer=None, deadline=10):
   headers = referer and {'Referer': referer} or {}
   logging.info('fetching %s', url)
   data = urlfetch.fetch(
-      url, headers=headers, validate_certificate=False, deadline=10).content
+      url, headers=headers, validate_certificate=False,
+      deadline=deadline).content
   logging.info('retrieved %d bytes', len(data))
   return UnzipData(data, r'.*\.[kx]ml')
 
@@ -276,8 +351,46 @@ def KmlColorFromJson(color, opacity=1):
 
 
 class Template(string.Template):
+  """A string.Template that is parsed once, for applying to many records."""
   idpattern = r'/?\w[\w.@#]*'
 
+  def __init__(self, template):
+    string.Template.__init__(self, template)
+    # The template is split into len(self.names) + 1 runs of literal text,
+    # with a placeholder named by self.names[i] after self.literals[i].
+    self.names = []
+    self.literals = []
+    literal, start = '', 0
+    for match in self.pattern.finditer(template):
+      literal += template[start:match.start()]
+      start = match.end()
+      name = match.group('named') or match.group('braced')
+      if name is not None:
+        self.names.append(name)
+        self.literals.append(literal)
+        literal = ''
+      elif match.group('escaped') is not None:
+        literal += self.delimiter
+      else:
+        self._invalid(match)  # raises ValueError, as substitute() would
+    self.literals.append(literal + template[start:])
+
+  def Format(self, get_value):
+    """Fills in the template, like substitute() but without a regex pass.
+
+    Args:
+      get_value: A function that takes a placeholder name and returns the
+          value to substitute for it.  It is called only for the names that
+          appear in the template.
+    Returns:
+      The filled-in string.
+    """
+    parts = [self.literals[0]]
+    for name, literal in zip(self.names, self.literals[1:]):
+      parts.append('%s' % (get_value(name),))
+      parts.append(literal)
+    return ''.join(parts)
+
 
 class Kmlifier(object):
   """A converter for CSV/XML/GeoJSON to KML."""
@@ -285,7 +398,8 @@ class Kmlifier(object):
   def __init__(self, root_url, name_template, description_template,
                location_fields, id_template, icon_url_template=None,
                color_template=None, hotspot_template=None,
-               join_field=None, join_data=None, conditions=None):
+               join_field=None, join_data=None, conditions=None,
+               join_url=None):
     """Sets up a record extractor and KML emitter.
 
     Args:
@@ -328,6 +442,7 @@ class Kmlifier(object):
           operator can be one of ['==', '!=', '<', '<=', '>', '>='].  Values
           are compared as numbers if the value is parseable as a float;
           otherwise values are compared as strings.
+      join_url: The URL that join_data came from, for caching the join table.
     """
     self.root_url = root_url
     self.name_template = Template(name_template)
@@ -338,21 +453,14 @@ class Kmlifier(object):
     self.color_template = Template(color_template or 'ffffffff')
     self.hotspot_template = Template(hotspot_template or 'mc')
     self.join_field = join_field or ''
-    self.join_records = {}
-    if join_data:
-      self.join_records = {
-          record[join_field]: record
-          for record in self.RecordsFromCsv(join_data, header_fields_hint=[])}
+    self.template_style_keys = {}  # (color, icon_url, hotspot) => style key
 
     # Gather the set of all fields mentioned in templates or conditions.
     self.fields = set()
-    def Gather(match):
-      name = match.group('named') or match.group('braced')
-      if name:
-        self.fields.add(str(name).lstrip('_'))
-    self.name_template.pattern.sub(Gather, name_template)
-    self.description_template.pattern.sub(Gather, description_template)
-    self.id_template.pattern.sub(Gather, id_template)
+    for template in [self.name_template, self.description_template,
+                     self.id_template, self.icon_url_template,
+                     self.color_template, self.hotspot_template]:
+      self.fields.update(str(name).lstrip('_') for name in template.names)
     for field in location_fields:
       if field.startswith('^'):
         field = field[1:]
@@ -377,28 +485,53 @@ class Kmlifier(object):
           self.conditions.append((field, op, value))
           self.fields.add(field)
 
+    # The join table is read after self.fields is complete, so that only the
+    # columns that could be used are kept.
+    self.join_fieldnames = ()
+    self.join_rows = {}  # join_field value => tuple of join table values
+    if join_data:
+      key = [join_url, hashlib.sha1(join_data).hexdigest(), join_field,
+             sorted(self.fields)]
+      self.join_fieldnames, self.join_rows = JOIN_CACHE.Get(
+          key, lambda: self.ReadJoinTable(join_field, join_data))
+
+  def ReadJoinTable(self, join_field, join_data):
+    """Reads the columns of a join table that could be used in the output.
+
+    Args:
+      join_field: The name of the field to join on.
+      join_data: The join table, as a string of CSV data.
+    Returns:
+      A pair (fieldnames, rows), where fieldnames is a tuple of the names of
+      the columns that were read, and rows is a dictionary that maps each
+      value of join_field to a tuple of the corresponding values in its row.
+    """
+    fieldnames, rows = self.ReadCsvColumns(join_data, header_fields_hint=[])
+    if join_field not in fieldnames:
+      raise ValueError('join field %r is not in the join table' % join_field)
+    key_index = fieldnames.index(join_field)
+    return fieldnames, {row[key_index]: row for row in rows}
+
   def RecordsFromGeoJson(self, geojson_data):
     """Extracts records from a GeoJSON string.
 
     Args:
       geojson_data: A GeoJSON object, serialized as a string.  See
           http://geojson.org/geojson-spec.html#geojson-objects for details.
-    Returns:
-      The records, as a list of dictionaries containing KML Geometry and Style
-      elements in their '__geometry__' and '__style__' keys, respectively.
+    Yields:
+      The records, as dictionaries containing KML Geometry and Style elements
+      in their '__geometry__' and '__style__' keys, respectively.
     """
     obj = json.loads(geojson_data)
     if obj['type'] not in ['Feature', 'FeatureCollection']:
       obj = {'type': 'Feature', 'geometry': obj}
-    records = []
     for feature in obj.get('features', [obj]):
       if feature.get('type') == 'Feature':
         geometry = KmlGeometryFromJson(feature.get('geometry', {}))
         props = feature.get('properties', {})
         style = KmlStyleFromJson(props, self.root_url)
         if geometry:
-          records.append(dict(props, __geometry__=geometry, __style__=style))
-    return records
+          yield dict(props, __geometry__=geometry, __style__=style)
 
   def RecordsFromCsv(self, csv_data, encoding='utf-8', header_fields_hint=None):
     """Extracts records from a string of CSV data.
@@ -411,15 +544,53 @@ class Kmlifier(object):
           If empty, use the first row as the header.
           If None, use self.location_fields_cleaned.
     Returns:
-      The records, as a list of dictionaries.
+      An iterator over the records, as dictionaries containing only the
+      fields that appear in self.fields.
+    """
+    fieldnames, rows = self.ReadCsvColumns(
+        csv_data, encoding, header_fields_hint)
+    return (dict(zip(fieldnames, row)) for row in rows)
+
+  def ReadCsvColumns(self, csv_data, encoding='utf-8',
+                     header_fields_hint=None):
+    """Reads the columns of CSV data that could be used in the output.
+
+    Spreadsheet exports often have dozens of columns that no template,
+    location or condition refers to, so only the columns for fields in
+    self.fields are decoded, and each row is kept as a tuple.
+
+    Args:
+      csv_data: The CSV data, as a string.  See RecordsFromCsv.
+      encoding: The string encoding of csv_data, e.g. 'utf-8'.
+      header_fields_hint: See RecordsFromCsv.
+    Returns:
+      A pair (fieldnames, rows), where fieldnames is a tuple of the names of
+      the columns that were read, and rows is an iterator over tuples of the
+      corresponding values (decoded and stripped) in each row.
     """
     csv_file = StringIO.StringIO(csv_data)
     if header_fields_hint is None:
       header_fields_hint = self.location_fields_cleaned
     fieldnames = self.FindCsvFieldnames(csv_file, encoding, header_fields_hint)
     logging.info('CSV fieldnames: %s', fieldnames)
-    return [NormalizeRecord(DecodeRecord(record, encoding))
-            for record in csv.DictReader(csv_file, fieldnames=fieldnames)]
+
+    # Templates refer to the raw value of field "foo" as $_foo, so a column
+    # named "_foo" might be wanted too.  If a name appears in more than one
+    # column, the last column wins, as it did with csv.DictReader.
+    indexes_by_name = {name: index for index, name in enumerate(fieldnames)
+                       if name.lstrip('_') in self.fields}
+    columns = sorted((index, name) for name, index in indexes_by_name.items())
+    indexes = [index for index, _ in columns]
+    width = indexes and indexes[-1] + 1
+
+    def ReadRows():
+      for row in csv.reader(csv_file):
+        if row:  # skip blank lines, as csv.DictReader does
+          if len(row) < width:
+            row += [''] * (width - len(row))
+          yield tuple(Decode(row[index], encoding).strip()
+                      for index in indexes)
+    return tuple(name for _, name in columns), ReadRows()
 
   def FindCsvFieldnames(self, csv_file, encoding, header_fields_hint):
     """Finds a suitable set of fieldnames to map fields to CSV columns.
@@ -485,8 +656,8 @@ class Kmlifier(object):
       xml_wrapper_tag: An XML tag name.  If this is specified, it is assumed
           that all the records have been serialized as XML text in the text
           content of XML elements with this tag name.
-    Returns:
-      The records, as a list of dictionaries.
+    Yields:
+      The records, as dictionaries.
     """
     if xml_wrapper_tag:
       root = ParseXml(xml_data)
@@ -512,73 +683,148 @@ class Kmlifier(object):
       ExtractField(field_prefix + '#' + element.get('id', '').strip(), text)
       ExtractField(field_prefix + '#' + element.get('name', '').strip(), text)
 
-    # We walk over the the whole document looking for the record_tag XML tag;
-    # for each record tag, we scan all elements and attributes within, pulling
-    # out their values into records only if they are specified in self.fields.
-    records = []
+    # We walk over the the whole document looking for the record_tag XML tag.
     # global_fields collects fields outside of record tags, so that if, for
     # example, there is a single <title> for the whole XML document, it can
-    # be referenced in templates as $/title.
+    # be referenced in templates as $/title.  Every record gets the global
+    # fields, so they have to be collected before any records are yielded.
+    record_elements = []
     global_fields = {}
     for element in root.getiterator():
       if element.tag == record_tag:
-        record = {}
-        for child in element.getiterator():
-          ExtractFields(child.tag, child, record)
-          if (child.tag in 'Point LineString Polygon MultiGeometry'.split() and
-              child.find('.//coordinates') is not None):
-            record['__geometry__'] = child  # preserve KML geometry
-        style = element.find('.//Style')
-        style_url = element.find('.//styleUrl')
-        if style is not None:
-          record['__style__'] = style  # preserve KML style
-        elif style_url is not None and style_url.text.startswith('#'):
-          record['__style__'] = styles.get(style_url.text.lstrip('#'))
-        records.append(record)
+        record_elements.append(element)
       else:
         ExtractFields('/' + element.tag, element, global_fields)
 
-    def OverlayDictionaries(base, overlay):
-      result = base.copy()
-      result.update(overlay)
-      return result
-    return [OverlayDictionaries(global_fields, record) for record in records]
+    # For each record tag, we scan all elements and attributes within, pulling
+    # out their values into records only if they are specified in self.fields.
+    for element in record_elements:
+      record = {}
+      for child in element.getiterator():
+        ExtractFields(child.tag, child, record)
+        if (child.tag in 'Point LineString Polygon MultiGeometry'.split() and
+            child.find('.//coordinates') is not None):
+          record['__geometry__'] = child  # preserve KML geometry
+      style = element.find('.//Style')
+      style_url = element.find('.//styleUrl')
+      if style is not None:
+        record['__style__'] = style  # preserve KML style
+      elif style_url is not None and style_url.text.startswith('#'):
+        record['__style__'] = styles.get(style_url.text.lstrip('#'))
+      record_with_globals = global_fields.copy()
+      record_with_globals.update(record)
+      yield record_with_globals
 
   def FilterRecords(self, records):
-    """Filters the given a list of records by the specified conditions."""
-    return [record for record in records
+    """Filters an iterable of records by the specified conditions."""
+    return (record for record in records
             if all(Compare(op, record.get(field, None), value)
-                   for field, op, value in self.conditions)]
+                   for field, op, value in self.conditions))
 
   def RecordsToKmlDocument(self, records):
     """Turns a list of records into a KML Document element of placemarks."""
-    xml = xml_utils.Xml
-    placemarks = []
-    styles = []
     style_ids = {}
+    placemarks = list(self.RecordsToPlacemarks(records, style_ids))
+    return xml_utils.Xml(
+        'Document', *(self.GetStyles(style_ids) + placemarks))
+
+  def RecordsToKmz(self, records):
+    """Turns records into a KMZ file, one placemark at a time.
+
+    Each placemark is serialized and compressed as soon as it is made, so
+    memory use doesn't grow with the number of records, only with the number
+    of distinct styles.
+
+    Args:
+      records: An iterable of records.
+    Returns:
+      The KMZ file, as a string.
+    """
+    kml_start, kml_end = KML_DOCUMENT_TEMPLATE.split('%s')
+    writer = KmzWriter()
+    style_ids = {}
+    count = 0
+    for placemark in self.RecordsToPlacemarks(records, style_ids):
+      writer.Write(SerializeChild(placemark))
+      count += 1
+    logging.info('wrote %d placemarks', count)
+    if not count and not style_ids:
+      return MakeKmz(KML_DOCUMENT_TEMPLATE % '<Document />')
+    writer.Write('</Document>' + kml_end)
+    return writer.Finish(kml_start + '<Document>\n' + ''.join(
+        SerializeChild(style) for style in self.GetStyles(style_ids)))
+
+  def GetStyles(self, style_ids):
+    """Makes the KML Style elements for RecordsToPlacemarks, sorted by key."""
+    return [xml_utils.Xml('Style', *xml_utils.Parse(key).getchildren(),
+                          id=style_id)
+            for key, style_id in sorted(style_ids.items())]
+
+  def GetTemplateStyleKey(self, color, icon_url, hotspot):
+    """Gets the key for a style made from the color, icon, hotspot templates.
+
+    Style keys are serialized Style elements, but many records usually share
+    the same template values, so the serialization is done once per distinct
+    combination of values.
+
+    Args:
+      color: The color, from self.color_template.
+      icon_url: The icon URL, from self.icon_url_template.
+      hotspot: The hotspot specification, from self.hotspot_template.
+    Returns:
+      The serialized KML Style element.
+    """
+    values = (color, icon_url, hotspot)
+    if values not in self.template_style_keys:
+      xml = xml_utils.Xml
+      self.template_style_keys[values] = xml_utils.Serialize(
+          xml('Style',
+              xml('IconStyle',
+                  xml('color', color),
+                  xml('Icon', xml('href', icon_url)),
+                  CreateHotspotElement(hotspot))))
+    return self.template_style_keys[values]
+
+  def RecordsToPlacemarks(self, records, style_ids):
+    """Turns records into KML Placemark elements, yielding them one by one.
+
+    Args:
+      records: An iterable of records.
+      style_ids: A dictionary mapping serialized KML Style elements to style
+          IDs.  Styles seen in the records are added to it as they are found;
+          the caller should add the Style elements (see GetStyles) to the
+          Document after consuming all the placemarks.
+    Yields:
+      KML Placemark elements, whose styleUrls refer to IDs in style_ids.
+    """
+    xml = xml_utils.Xml
     for record in records:
       geometry = record.pop('__geometry__', None)
       style = record.pop('__style__', None)
 
       # Join with the join_data, if any.
       if self.join_field:
-        join_record = self.join_records.get(record[self.join_field])
-        if join_record:
-          record.update(join_record)
+        join_row = self.join_rows.get(record[self.join_field])
+        if join_row:
+          record.update(zip(self.join_fieldnames, join_row))
 
       # Substitute raw values into templates.
-      values = collections.defaultdict(lambda: '', record)
-      name = self.name_template.substitute(values)
-      id_value = self.id_template.substitute(values)
-      icon_url = self.icon_url_template.substitute(values)
-      color = self.color_template.substitute(values)
-      hotspot = self.hotspot_template.substitute(values)
+      def GetRawValue(name, record=record):
+        return record.get(name, '')
+      name = self.name_template.Format(GetRawValue)
+      id_value = self.id_template.Format(GetRawValue)
 
       # Substitute escaped or quoted values into the description template.
-      values.update({key: HtmlEscape(record[key]) for key in record})
-      values.update({'_' + key: record[key] for key in record})
-      values.update({'__' + key: UrlQuote(record[key]) for key in record})
-      description = self.description_template.substitute(values)
+      def GetDescriptionValue(name, record=record):
+        """Gets $foo HTML-escaped, $_foo raw, or $__foo URL-quoted."""
+        if name.startswith('__') and name[2:] in record:
+          return UrlQuote(record[name[2:]])
+        if name.startswith('_') and name[1:] in record:
+          return record[name[1:]]
+        if name in record:
+          return HtmlEscape(record[name])
+        return ''
+      description = self.description_template.Format(GetDescriptionValue)
 
       # Get geometry information.
       if not geometry:
@@ -618,29 +864,24 @@ class Kmlifier(object):
           continue
 
       # Get style information.
-      if not style:
-        style = xml('Style',
-                    xml('IconStyle',
-                        xml('color', color),
-                        xml('Icon', xml('href', icon_url)),
-                        CreateHotspotElement(hotspot)))
-      key = xml_utils.Serialize(style)
+      if style:
+        key = xml_utils.Serialize(style)
+      else:
+        key = self.GetTemplateStyleKey(
+            self.color_template.Format(GetRawValue),
+            self.icon_url_template.Format(GetRawValue),
+            self.hotspot_template.Format(GetRawValue))
       if key not in style_ids:
         style_ids[key] = 'style%d' % (len(style_ids) + 1)
 
-      # Add a placemark.
+      # Yield a placemark.
       if geometry:
-        placemarks.append(
-            xml('Placemark',
-                id_value and {'id': id_value} or None,
-                xml('name', name),
-                xml('description', description),
-                geometry,
-                xml('styleUrl', '#' + style_ids[key])))
-
-    styles = [xml('Style', *xml_utils.Parse(key).getchildren(), id=style_id)
-              for key, style_id in sorted(style_ids.items())]
-    return xml('Document', *(styles + placemarks))
+        yield xml('Placemark',
+                  id_value and {'id': id_value} or None,
+                  xml('name', name),
+                  xml('description', description),
+                  geometry,
+                  xml('styleUrl', '#' + style_ids[key]))
 
 
 class Kmlify(base_handler.BaseHandler):
@@ -687,7 +928,7 @@ class Kmlify(base_handler.BaseHandler):
       # Fetch the source data.
       data = FetchData(url, self.request.host)
 
-      join_field = join_data = None
+      join_field = join_data = join_url = None
       if join:
         join_field, join_url = join.split(',', 1)
         join_data = FetchData(join_url)
@@ -696,7 +937,7 @@ class Kmlify(base_handler.BaseHandler):
       kmlifier = Kmlifier(
           self.request.root_url, name_template, description_template,
           location_fields, id_template, icon_url_template, color_template,
-          hotspot_template, join_field, join_data, conditions)
+          hotspot_template, join_field, join_data, conditions, join_url)
       if data_type == 'xml':
         records = kmlifier.RecordsFromXml(data, record_tag, xml_wrapper_tag)
       elif data_type == 'csv':
@@ -706,18 +947,18 @@ class Kmlify(base_handler.BaseHandler):
       else:
         raise ValueError(
             'type is %r, but should be "xml", "csv", or "geojson"' % data_type)
-      logging.info('extracted %d records', len(records))
+      # The records are streamed through the filter and the skip/limit
+      # slice into the KMZ file, so they are never all in memory at once.
       records = kmlifier.FilterRecords(records)
-      logging.info('conditions were met by %d records', len(records))
-      records = records[skip:skip + limit]
-      document = kmlifier.RecordsToKmlDocument(records)
+      records = itertools.islice(records, max(0, skip), max(0, skip + limit))
+      kmz = kmlifier.RecordsToKmz(records)
     except Exception, e:  # pylint:disable=broad-except
       # Even if conversion fails, always cache something.  We don't want an
       # error to trigger a spike of urlfetch requests to the remote server.
       document = xml_utils.Xml(
           'Document', xml_utils.Xml('name', 'Conversion failed: %r' %  e))
       logging.exception(e)
-    kmz = MakeKmz(KML_DOCUMENT_TEMPLATE % xml_utils.Serialize(document))
+      kmz = MakeKmz(KML_DOCUMENT_TEMPLATE % xml_utils.Serialize(document))
     CACHE.Set(cache_key, kmz)
     self.RespondWithKmz(kmz)
 
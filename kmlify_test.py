@@ -59,6 +59,61 @@ class KmlifyTests(test_utils.BaseTest):
     self.assertEquals("<type 'list'>", kmlify.Stringify(list))
     self.assertEquals("&lt;type 'list'&gt;", kmlify.Stringify(list, True))
 
+  def testTemplateFormat(self):
+    template = kmlify.Template('$a, ${b}c $$$/d $missing')
+    self.assertEquals(['a', 'b', '/d', 'missing'], template.names)
+    values = {'a': 1, 'b': 'B', '/d': u'\xe9'}
+    self.assertEquals(u'1, Bc $\xe9 ',
+                      template.Format(lambda name: values.get(name, '')))
+    self.assertRaises(ValueError, kmlify.Template, 'a $ b')
+
+  def testRecordsFromCsv(self):
+    kmlifier = kmlify.Kmlifier('http://app.com/', '$name', '$_desc',
+                               ['lat,lon'], '', color_template='$color')
+    csv_data = ('x,name,lat,lon,y,desc,color,z\n'
+                '1, A ,10,20,2,\xc3\xa9,ff00ff00,3\n'
+                '\n'
+                '4,B,30,40\n')
+    # Only the columns named in templates or location fields should be read.
+    self.assertEquals(
+        [{'name': 'A', 'lat': '10', 'lon': '20', 'desc': u'\xe9',
+          'color': 'ff00ff00'},
+         {'name': 'B', 'lat': '30', 'lon': '40', 'desc': '', 'color': ''}],
+        list(kmlifier.RecordsFromCsv(csv_data)))
+
+  def testJoinTableCache(self):
+    def MakeKmlifier(name_template, join_data):
+      return kmlify.Kmlifier(
+          'http://app.com/', name_template, '', ['lat,lon'], '',
+          join_field='code', join_data=join_data,
+          join_url='http://example.com/join.csv')
+    join_data = 'code,label,other\na,Apple,x\nb,Banana,y\n'
+    kmlifier = MakeKmlifier('$label', join_data)
+    self.assertEquals(('code', 'label'), kmlifier.join_fieldnames)
+    self.assertEquals({'a': ('a', 'Apple'), 'b': ('b', 'Banana')},
+                      kmlifier.join_rows)
+
+    # Another conversion with the same table should reuse the parsed rows.
+    self.assertTrue(
+        MakeKmlifier('$label', join_data).join_rows is kmlifier.join_rows)
+
+    # The table should be read again if it changes or other columns are used.
+    self.assertEquals({'a': ('a', 'Avocado')}, MakeKmlifier(
+        '$label', 'code,label\na,Avocado\n').join_rows)
+    self.assertEquals(('code', 'other'),
+                      MakeKmlifier('$other', join_data).join_fieldnames)
+
+  def testKmzWriter(self):
+    writer = kmlify.KmzWriter()
+    writer.Write('<Placemark/>\n' * 1000)
+    writer.Write('</Document>\n')
+    kmz = writer.Finish('<Document>\n<Style/>\n')
+    archive = zipfile.ZipFile(StringIO.StringIO(kmz))
+    self.assertEquals(None, archive.testzip())  # checks the CRC
+    self.assertEquals(
+        '<Document>\n<Style/>\n' + '<Placemark/>\n' * 1000 + '</Document>\n',
+        archive.read('doc.kml'))
+
   def testSimpleCsv(self):
     self.DoGoldenFileTest('csv', 'input1.csv', 'output1.kml',
                           {'loc': 'Latitude,Longitude', 'name': '$Name',
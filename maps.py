@@ -269,7 +269,7 @@ def GetConfig(request, map_object=None, catalog_entry=None, xsrf_token=''):
     result['lang'] = base_handler.SelectLanguageForRequest(request, map_root)
     ui_region = map_root.get('region', ui_region)
     cache_key, sources = metadata.CacheSourceAddresses(key, result['map_root'])
-    result['metadata'] = {s: METADATA_CACHE.Get(s) for s in sources}
+    result['metadata'] = dict(zip(sources, METADATA_CACHE.GetMulti(sources)))
     result['metadata_url'] = root + '/.metadata?ck=' + cache_key
     metadata.ActivateSources(sources)
 
@@ -16,8 +16,11 @@ __author__ = 'lschumacher@google.com (Lee Schumacher)'
 
 import datetime
 import json
+import logging
+import math
 
 import cache
+import config
 import domains
 import logs
 import perms
@@ -25,6 +28,7 @@ import users
 import utils
 
 from google.appengine.api import search
+from google.appengine.api import taskqueue
 from google.appengine.ext import db
 from google.appengine.ext import ndb
 
@@ -34,30 +38,54 @@ NEVER = datetime.datetime.utcfromtimestamp(0)
 # A GeoPt value to represent null (the datastore cannot query on None).
 NOWHERE = ndb.GeoPt(90, 90)
 
+# Crowd reports are summarized in grid cells of this size, in degrees, so that
+# the recent reports near a place can be read without a search query.
+REPORT_SUMMARY_CELL_DEGREES = 0.01
+
+# Maximum number of reports kept in each summary, most recently effective first.
+REPORT_SUMMARY_MAX_REPORTS = 100
+
+# Maximum number of summaries to read in one call to GetSummarizedByLocation.
+REPORT_SUMMARY_MAX_CELLS = 100
+
 # Individual CatalogEntries, keyed by domain name and label.  The 500-ms ULL
 # is intended to beat the time it takes to manually navigate to a published
 # map at its label after the label has been updated by clicking Publish.
-CATALOG_ENTRY_CACHE = cache.Cache('model.catalog_entry', 300, 0.5)
+# Entries are tagged ['catalog_entry', domain, label].
+CATALOG_ENTRY_CACHE = cache.Cache(
+    'model.catalog_entry', 300, 0.5,
+    tags=lambda key: [['catalog_entry'] + key])
 
 # Lists of all CatalogEntries in a domain or across all domains, keyed by
 # domain name or '*' for all domains.  The 100-ms ULL is intended to beat the
 # time it takes to redirect back to /.maps after the user hits Publish.
-CATALOG_CACHE = cache.Cache('model.catalog', 300, 0.1)
+# Entries are tagged ['catalog', domain] or ['catalog', '*'].
+CATALOG_CACHE = cache.Cache('model.catalog', 300, 0.1,
+                            tags=lambda domain: [['catalog', domain]])
 
 # Lists of the "listed" CatalogEntries in a domain or across all domains, keyed
 # by domain name or '*' for all domains.  The 500-ms ULL is intended to beat
 # the time it takes to manually navigate to any page with a map picker menu
-# after editing which CatalogEntries are listed.
-LISTED_CATALOG_CACHE = cache.Cache('model.listed_catalog', 300, 0.5)
+# after editing which CatalogEntries are listed.  Tagged like CATALOG_CACHE.
+LISTED_CATALOG_CACHE = cache.Cache('model.listed_catalog', 300, 0.5,
+                                   tags=lambda domain: [['catalog', domain]])
 
 # MapRoot data for published maps, keyed by [domain, label].  The 500-ms ULL
 # is intended to beat the time it takes to manually navigate to a map after
-# the user hits Publish to update the map.
-PUBLISHED_MAP_ROOT_CACHE = cache.Cache('model.published_map_root', 300, 0.5)
+# the user hits Publish to update the map.  MapRoot dictionaries are large and
+# read on every pageview, so we avoid unpickling them on each local cache hit;
+# callers must not modify the MapRoot objects they get from this cache.
+# Tagged like CATALOG_ENTRY_CACHE.
+PUBLISHED_MAP_ROOT_CACHE = cache.Cache(
+    'model.published_map_root', 300, 0.5, immutable=True,
+    tags=lambda key: [['catalog_entry'] + key])
 
 # MapRoot data for maps, keyed by map ID.  The 500-ms ULL is intended to beat
-# the time it takes to manually reload a map page after saving edits.
-MAP_ROOT_CACHE = cache.Cache('model.map_root', 300, 0.5)
+# the time it takes to manually reload a map page after saving edits.  As
+# above, callers must not modify the MapRoot objects they get from this cache.
+# Entries are tagged ['map', map_id].
+MAP_ROOT_CACHE = cache.Cache('model.map_root', 300, 0.5, immutable=True,
+                             tags=lambda map_id: [['map', map_id]])
 
 # Authorization entities are written offline, so users never expect to see
 # immediate effects.  The 1000-ms ULL is intended to beat the time it takes for
@@ -322,17 +350,15 @@ class CatalogEntry(object):
                      catalog_entry_key=domain_name + ':' + label,
                      uid=users.GetCurrent().id)
     cls.FlushCaches(domain_name)
-    CATALOG_ENTRY_CACHE.Delete([domain_name, label])
+    cache.InvalidateTag(['catalog_entry', domain_name, label])
     return CatalogEntry(entry)
 
   @staticmethod
   def FlushCaches(domain_name):
     """Flushes the cached lists of catalog entries for a given domain."""
-    CATALOG_CACHE.Delete(domain_name)
-    LISTED_CATALOG_CACHE.Delete(domain_name)
+    cache.InvalidateTag(['catalog', domain_name])
     # We use '*' as the cache key for the list that includes all domains.
-    CATALOG_CACHE.Delete('*')
-    LISTED_CATALOG_CACHE.Delete('*')
+    cache.InvalidateTag(['catalog', '*'])
 
   @classmethod
   def Delete(cls, domain_name, label, user=None):
@@ -370,7 +396,7 @@ class CatalogEntry(object):
                      map_id=map_id, map_version_key=version_key,
                      catalog_entry_key=entry_key, uid=user.id)
     cls.FlushCaches(domain_name)
-    CATALOG_ENTRY_CACHE.Delete([domain_name, label])
+    cache.InvalidateTag(['catalog_entry', domain_name, label])
 
   # TODO(kpy): Make Delete and DeleteByMapId both take a user argument, and
   # reuse Delete here by calling it with an admin user.
@@ -381,7 +407,7 @@ class CatalogEntry(object):
       domain, label = str(entry.domain), entry.label
       entry = CatalogEntryModel.Get(domain, label)
       entry.delete()
-      CATALOG_ENTRY_CACHE.Delete([domain, label])
+      cache.InvalidateTag(['catalog_entry', domain, label])
       cls.FlushCaches(domain)
 
   is_listed = property(
@@ -447,8 +473,7 @@ class CatalogEntry(object):
                      catalog_entry_key=self.id,
                      uid=users.GetCurrent().id)
     self.FlushCaches(domain_name)
-    PUBLISHED_MAP_ROOT_CACHE.Delete([domain_name, self.label])
-    CATALOG_ENTRY_CACHE.Delete([domain_name, self.label])
+    cache.InvalidateTag(['catalog_entry', domain_name, self.label])
 
 
 class Map(object):
@@ -671,7 +696,7 @@ class Map(object):
       self.model.current_version = new_version.put()
       self.model.put()
     db.run_in_transaction(PutModels)
-    MAP_ROOT_CACHE.Delete(self.id)
+    cache.InvalidateTag(['map', self.id])
     return new_version.key().id()
 
   def GetCurrent(self):
@@ -700,7 +725,7 @@ class Map(object):
     self.model.put()
     logs.RecordEvent(logs.Event.MAP_DELETED, map_id=self.id,
                      uid=self.model.deleter_uid)
-    MAP_ROOT_CACHE.Delete(self.id)
+    cache.InvalidateTag(['map', self.id])
 
   def Undelete(self):
     """Unmarks a map as deleted."""
@@ -710,7 +735,7 @@ class Map(object):
     self.model.put()
     logs.RecordEvent(logs.Event.MAP_UNDELETED, map_id=self.id,
                      uid=users.GetCurrent().id)
-    MAP_ROOT_CACHE.Delete(self.id)
+    cache.InvalidateTag(['map', self.id])
 
   def SetBlocked(self, block):
     """Sets whether a map is blocked (private to one user and unpublishable)."""
@@ -727,7 +752,7 @@ class Map(object):
       logs.RecordEvent(logs.Event.MAP_UNBLOCKED, map_id=self.id,
                        uid=users.GetCurrent().id)
     self.model.put()
-    MAP_ROOT_CACHE.Delete(self.id)
+    cache.InvalidateTag(['map', self.id])
 
   def Wipe(self):
     """Permanently destroys a map."""
@@ -937,6 +962,82 @@ class _CrowdReportModel(ndb.Model):
     return 'CrowdReportModel'  # so we can name the Python class with a _
 
 
+class _CrowdReportSummaryModel(ndb.Model):
+  """The recent reports for a topic in a grid cell.
+
+  Entity id: topic_id + '\x00' + a cell ID from _GetReportSummaryCellId.
+  """
+
+  # A JSON array of up to REPORT_SUMMARY_MAX_REPORTS unhidden reports, most
+  # recently effective first.  Each item is an object with the keys 'id',
+  # 'effective' (a POSIX timestamp), 'text', 'map_id', 'location' (a [lat, lon]
+  # pair), and 'answers' (the report's answers for this topic only).
+  reports_json = ndb.TextProperty()
+
+  @classmethod
+  def _get_kind(cls):  # pylint: disable=g-bad-name
+    return 'CrowdReportSummaryModel'  # so the Python class can start with _
+
+
+def _GetReportSummaryCellId(i, j):
+  """Gets the ID of the grid cell with the given row and column numbers."""
+  columns = int(round(360 / REPORT_SUMMARY_CELL_DEGREES))
+  return '%d,%d' % (i, (j + columns // 2) % columns - columns // 2)
+
+
+def _GetReportSummaryCellsNear(center, radius):
+  """Gets the IDs of all the grid cells within a radius of a point.
+
+  Args:
+    center: An ndb.GeoPt object.
+    radius: A distance in metres.
+
+  Returns:
+    A list of cell IDs, which includes the cell containing the point itself.
+  """
+  lat_span = radius / 111000.0  # a degree of latitude is at least 111 km
+  lon_span = lat_span / max(math.cos(math.radians(center.lat)), 1e-6)
+  columns = int(round(360 / REPORT_SUMMARY_CELL_DEGREES))
+  min_i, max_i, min_j, max_j = [
+      int(math.floor(degrees / REPORT_SUMMARY_CELL_DEGREES)) for degrees in [
+          max(center.lat - lat_span, -90), min(center.lat + lat_span, 90),
+          center.lon - lon_span, center.lon + lon_span]]
+  return [_GetReportSummaryCellId(i, j)
+          for i in range(min_i, max_i + 1)
+          for j in range(min_j, min(max_j, min_j + columns - 1) + 1)]
+
+
+@ndb.transactional
+def _PutReportSummaryItem(summary_id, report_id, item):
+  """Adds, replaces, or removes one report in a report summary.
+
+  Args:
+    summary_id: The entity ID of the _CrowdReportSummaryModel to update.
+    report_id: The ID of the report.
+    item: The new summary item for the report, or None to remove the report.
+  """
+  summary = (_CrowdReportSummaryModel.get_by_id(summary_id) or
+             _CrowdReportSummaryModel(id=summary_id))
+  items = [x for x in json.loads(summary.reports_json or '[]')
+           if x['id'] != report_id] + (item and [item] or [])
+  items.sort(key=lambda x: x['effective'], reverse=True)
+  summary.reports_json = json.dumps(items[:REPORT_SUMMARY_MAX_REPORTS])
+  summary.put()
+
+
+def _ScheduleReportSummaryUpdate(summary_id, report_id):
+  """Schedules a task to bring one report's item in a summary up to date."""
+  try:
+    taskqueue.add(
+        queue_name='crowd_report_summaries', method='GET',
+        url=(config.Get('root_path') or '') + '/.crowd_report_summary_update',
+        params={'summary_id': summary_id, 'report_id': report_id})
+  except Exception, e:  # pylint:disable=broad-except
+    logging.exception('Failed to schedule an update of summary %r for report '
+                      '%r; run tools/rebuild_crowd_report_summaries.py: %s',
+                      summary_id, report_id, e)
+
+
 class CrowdReport(utils.Struct):
   """Application-level object representing a crowd report."""
   index = search.Index('CrowdReport')
@@ -1154,6 +1255,114 @@ class CrowdReport(utils.Struct):
     ids = [ndb.Key(_CrowdReportModel, result.doc_id) for result in results]
     return cls._FilterReports(ndb.get_multi(ids))
 
+  @classmethod
+  def GetSummarizedByLocation(cls, topic_id, centers, radius):
+    """Gets recent reports with a given topic ID near any of several points.
+
+    Unlike GetByLocation, this makes no search query: it reads the summaries
+    kept up to date by Create and UpdateScore for all the grid cells near the
+    given points, with a single batch get.  Summaries contain only unhidden
+    reports, at most REPORT_SUMMARY_MAX_REPORTS per cell, so this is meant
+    for finding the latest reports over small areas.
+
+    Args:
+      topic_id: A string in the form map_id + '.' + topic_id.
+      centers: A list of ndb.GeoPt objects.
+      radius: A distance in metres.
+
+    Returns:
+      An iterator giving CrowdReport objects with just the id, effective, text,
+      map_id, location, topic_ids, and answers_json fields set, for reports in
+      the grid cells that come within the radius of any of the points.  The
+      caller should filter these by distance.  (Reports that the current user
+      cannot see are excluded.)  Returns None if the area would span more than
+      REPORT_SUMMARY_MAX_CELLS cells; use GetByLocation instead in that case.
+    """
+    cells = set()
+    for center in centers:
+      cells.update(_GetReportSummaryCellsNear(center, radius))
+      if len(cells) > REPORT_SUMMARY_MAX_CELLS:
+        return None
+    summaries = ndb.get_multi([
+        ndb.Key(_CrowdReportSummaryModel, topic_id + '\x00' + cell)
+        for cell in sorted(cells)])
+    return cls._FilterReports(
+        _CrowdReportModel(
+            id=item['id'], effective=utils.TimestampToUtc(item['effective']),
+            text=item['text'], map_id=item['map_id'],
+            location=ndb.GeoPt(*item['location']), topic_ids=[topic_id],
+            answers_json=json.dumps(item['answers']))
+        for summary in summaries if summary
+        for item in json.loads(summary.reports_json or '[]'))
+
+  @classmethod
+  def _GetSummaryItem(cls, model, topic_id):
+    """Gets the item for a report in the summary for one of its topics."""
+    answers = json.loads(model.answers_json or '{}')
+    return {
+        'id': model.key.id(),
+        'effective': utils.UtcToTimestamp(model.effective),
+        'text': model.text,
+        'map_id': model.map_id,
+        'location': [model.location.lat, model.location.lon],
+        'answers': {question_id: answer
+                    for question_id, answer in answers.items()
+                    if question_id.startswith(topic_id + '.')}
+    }
+
+  @classmethod
+  def _UpdateSummaries(cls, model, remove=False):
+    """Updates the summaries for a report's topics to reflect the report.
+
+    The report itself has already been stored by the time this is called, so
+    a failure to update a summary (e.g. due to contention from many reports
+    in the same cell) is not raised; otherwise a client would see its report
+    submission fail and might retry it, creating a duplicate.  Instead, the
+    update is retried in a task (see UpdateSummary).
+
+    Args:
+      model: A _CrowdReportModel.
+      remove: If True, remove the report from the summaries (e.g. because it
+          is being deleted).  Hidden reports are always removed.
+    """
+    if not model.location or model.location == NOWHERE:
+      return
+    cell, = _GetReportSummaryCellsNear(model.location, 0)
+    for topic_id in model.topic_ids:
+      summary_id = topic_id + '\x00' + cell
+      item = None if remove or model.hidden else cls._GetSummaryItem(
+          model, topic_id)
+      try:
+        _PutReportSummaryItem(summary_id, model.key.id(), item)
+      except Exception, e:  # pylint:disable=broad-except
+        logging.warning('Failed to update the %r summary for report %r; '
+                        'retrying in a task: %s', topic_id, model.key.id(), e)
+        _ScheduleReportSummaryUpdate(summary_id, model.key.id())
+
+  @classmethod
+  def UpdateSummary(cls, summary_id, report_id):
+    """Brings one report's item in one summary up to date with the report.
+
+    This is run by the task that retries failed summary updates, so it reads
+    the report's current state instead of the state at the time of the
+    failure, and removes the report from the summary if the report has since
+    been deleted, hidden, or moved to another topic or cell.  Errors are
+    raised so that the task is retried.
+
+    Args:
+      summary_id: The entity ID of the _CrowdReportSummaryModel to update.
+      report_id: The ID of the report.
+    """
+    model = _CrowdReportModel.get_by_id(report_id)
+    item = None
+    if (model and not model.hidden and model.location and
+        model.location != NOWHERE):
+      cell, = _GetReportSummaryCellsNear(model.location, 0)
+      for topic_id in model.topic_ids:
+        if summary_id == topic_id + '\x00' + cell:
+          item = cls._GetSummaryItem(model, topic_id)
+    _PutReportSummaryItem(summary_id, report_id, item)
+
   @classmethod
   def Create(cls, source, author, effective, text, topic_ids, answers,
              location, submitted=None, map_id=None, place_id=None,
@@ -1181,6 +1390,7 @@ class CrowdReport(utils.Struct):
     # minimize the possibility that one put() succeeds and the other fails.
     model.put()
     cls.index.put(document)
+    cls._UpdateSummaries(model)
     return report
 
   @classmethod
@@ -1260,15 +1470,19 @@ class CrowdReport(utils.Struct):
              # Reviewer votes count 1000x user votes
              1000 * (reviewer_upvote_count - reviewer_downvote_count))
     hidden = score <= -2  # for now, two downvotes hide a report
-    cls.PutScoreForReport(
+    model = cls.PutScoreForReport(
         report_id, upvote_count + reviewer_upvote_count,
         downvote_count + reviewer_downvote_count, score, hidden)
+    if model:
+      # Summaries are in other entity groups, so they can't be updated in the
+      # same transaction.
+      cls._UpdateSummaries(model)
 
   @classmethod
   @ndb.transactional
   def PutScoreForReport(
       cls, report_id, upvote_count, downvote_count, score, hidden):
-    """Atomically writes the voting stats on a report."""
+    """Atomically writes the voting stats on a report; returns its model."""
     model = _CrowdReportModel.get_by_id(report_id)
     if model:
       model.upvote_count = upvote_count
@@ -1278,6 +1492,7 @@ class CrowdReport(utils.Struct):
       document = cls._CreateSearchDocument(model)
       model.put()
       cls.index.put(document)
+    return model
 
 # Possible types of votes.  Each vote type is associated with a particular
 # weight, and some vote types are only available to privileged users.
@@ -24,6 +24,7 @@ import test_utils
 import users
 import utils
 
+from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
 
 
@@ -997,6 +998,79 @@ class CrowdReportTests(test_utils.BaseTest):
                                              topic_radii={'bar': 10},
                                              hidden=False))
 
+  def testGetSummarizedByLocation(self):
+    """Tests CrowdReport.GetSummarizedByLocation."""
+    cr1 = test_utils.NewCrowdReport(
+        topic_ids=['m.foo', 'm.bar'], answers={'m.foo.q1': 'a', 'm.bar.q2': 1},
+        location=ndb.GeoPt(37, -74))
+    cr2 = test_utils.NewCrowdReport(topic_ids=['m.foo'],
+                                    location=ndb.GeoPt(37.001, -74))
+    test_utils.NewCrowdReport(topic_ids=['m.foo'],  # ~11 km away
+                              location=ndb.GeoPt(37.1, -74))
+    test_utils.NewCrowdReport(topic_ids=['m.foo'])  # no location
+
+    # pylint: disable=g-long-lambda,invalid-name
+    GetIdsByLocation = lambda *args: sorted(
+        x.id for x in model.CrowdReport.GetSummarizedByLocation(*args))
+
+    self.assertEquals(sorted([cr1.id, cr2.id]), GetIdsByLocation(
+        'm.foo', [ndb.GeoPt(37, -74)], 200))
+    self.assertEquals([cr1.id], GetIdsByLocation(
+        'm.bar', [ndb.GeoPt(37, -74)], 200))
+    self.assertEquals([], GetIdsByLocation('m.foo', [ndb.GeoPt(38, -74)], 200))
+
+    # Only the answers for the requested topic are included.
+    report, = model.CrowdReport.GetSummarizedByLocation(
+        'm.bar', [ndb.GeoPt(37, -74)], 200)
+    self.assertEquals({'m.bar.q2': 1}, report.answers)
+    self.assertEquals(ndb.GeoPt(37, -74), report.location)
+
+    # Hidden reports are removed from the summaries, and restored if unhidden.
+    model.CrowdVote.Put(cr2.id, 'voter1', 'ANONYMOUS_DOWN')
+    model.CrowdVote.Put(cr2.id, 'voter2', 'ANONYMOUS_DOWN')
+    self.assertEquals([cr1.id], GetIdsByLocation(
+        'm.foo', [ndb.GeoPt(37, -74)], 200))
+    model.CrowdVote.Put(cr2.id, 'voter2', None)
+    self.assertEquals(sorted([cr1.id, cr2.id]), GetIdsByLocation(
+        'm.foo', [ndb.GeoPt(37, -74)], 200))
+
+    # Too large an area to read from the summaries.
+    self.assertEquals(None, model.CrowdReport.GetSummarizedByLocation(
+        'm.foo', [ndb.GeoPt(37, -74)], 100000))
+
+    # Removing a report (as when it is purged) takes it out of the summaries.
+    model.CrowdReport._UpdateSummaries(  # pylint: disable=protected-access
+        model._CrowdReportModel.get_by_id(cr1.id), remove=True)
+    self.assertEquals([cr2.id], GetIdsByLocation(
+        'm.foo', [ndb.GeoPt(37, -74)], 200))
+
+  def testCreateWithSummaryFailure(self):
+    """A failed summary update shouldn't fail report creation; it's retried."""
+    # pylint: disable=g-long-lambda,invalid-name,protected-access
+    def FailToPut(*unused_args):
+      raise datastore_errors.TransactionFailedError('too much contention')
+    put_report_summary_item = model._PutReportSummaryItem
+    self.SetForTest(model, '_PutReportSummaryItem', FailToPut)
+    cr = test_utils.NewCrowdReport(topic_ids=['m.foo'],
+                                   location=ndb.GeoPt(37, -74))
+    self.assertEquals(cr.id, model.CrowdReport.Get(cr.id).id)
+
+    GetIdsByLocation = lambda: [
+        x.id for x in model.CrowdReport.GetSummarizedByLocation(
+            'm.foo', [ndb.GeoPt(37, -74)], 200)]
+    self.assertEquals([], GetIdsByLocation())
+
+    # The update is retried in a task, which succeeds once contention subsides.
+    task, = self.PopTasks('crowd_report_summaries')
+    model._PutReportSummaryItem = put_report_summary_item
+    self.ExecuteTask(task)
+    self.assertEquals([cr.id], GetIdsByLocation())
+
+    # The task reflects the report's current state, e.g. that it was deleted.
+    model._CrowdReportModel.get_by_id(cr.id).key.delete()
+    self.ExecuteTask(task)
+    self.assertEquals([], GetIdsByLocation())
+
   def testSearch(self):
     """Tests CrowdReport.Search."""
     now = datetime.datetime.utcnow()
@@ -0,0 +1,269 @@
+#!/usr/bin/python
+# Copyright 2014 Google Inc.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at: http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distrib-
+# uted under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+# OR CONDITIONS OF ANY KIND, either express or implied.  See the License for
+# specific language governing permissions and limitations under the License.
+
+"""Load-tests cache.Cache against an in-process stand-in for memcache.
+
+Usage: tools/python tools/cache_load_test.py [options]
+
+Runs many threads that call Cache.Get() on keys drawn from a Zipfian
+distribution, with make_value and memcache calls that take a configurable
+time, and reports throughput, latency percentiles, make_value call counts and
+stampedes (concurrent make_value calls for the same key).  Use it to check
+changes to the TTL, ULL, cooling time or local cache policy for regressions
+before deploying them, e.g.:
+
+    tools/python tools/cache_load_test.py --threads=50 --ttl=2 --ull=0.5
+"""
+
+import bisect
+import json
+import optparse
+import random
+import sys
+import threading
+import time
+
+import cache
+
+
+class FakeMemcache(object):
+  """A thread-safe, in-process stand-in for the memcache API used by cache.
+
+  Every call sleeps for the given latency, so that the cache behaves as it
+  would with a remote memcache server.
+  """
+
+  def __init__(self, latency=0):
+    self.latency = latency
+    self.items = {}  # key => (expiration or 0, value)
+    self.lock = threading.Lock()
+    self.calls = 0
+
+  def _Call(self):
+    self.calls += 1
+    if self.latency:
+      time.sleep(self.latency)
+
+  def _GetLive(self, key, now):
+    expiration, value = self.items.get(key, (0, None))
+    if expiration and expiration <= now:
+      self.items.pop(key, None)
+      return None
+    return value
+
+  def _GetExpiration(self, seconds, now):
+    # As in memcache, times over 30 days are absolute timestamps.
+    if not seconds:
+      return 0
+    return seconds if seconds > 30 * 24 * 3600 else now + seconds
+
+  def get(self, key):  # pylint:disable=invalid-name
+    return self.get_multi([key]).get(key)
+
+  def get_multi(self, keys):  # pylint:disable=invalid-name
+    self._Call()
+    now = time.time()
+    with self.lock:
+      results = {key: self._GetLive(key, now) for key in keys}
+    return {key: value for key, value in results.iteritems()
+            if value is not None}
+
+  # The memcache API takes the expiration time as a keyword argument named
+  # 'time', which would shadow the time module here, hence the **kwargs.
+
+  def set(self, key, value, **kwargs):  # pylint:disable=invalid-name
+    return not self.set_multi({key: value}, **kwargs)
+
+  def set_multi(self, mapping, **kwargs):  # pylint:disable=invalid-name
+    self._Call()
+    expiration = self._GetExpiration(kwargs.get('time', 0), time.time())
+    with self.lock:
+      for key, value in mapping.iteritems():
+        self.items[key] = (expiration, value)
+    return []
+
+  def add(self, key, value, **kwargs):  # pylint:disable=invalid-name
+    return not self.add_multi({key: value}, **kwargs)
+
+  def add_multi(self, mapping, **kwargs):  # pylint:disable=invalid-name
+    self._Call()
+    now = time.time()
+    expiration = self._GetExpiration(kwargs.get('time', 0), now)
+    not_added = []
+    with self.lock:
+      for key, value in mapping.iteritems():
+        if self._GetLive(key, now) is None:
+          self.items[key] = (expiration, value)
+        else:
+          not_added.append(key)
+    return not_added
+
+  def incr(self, key, delta=1):  # pylint:disable=invalid-name
+    self._Call()
+    now = time.time()
+    with self.lock:
+      value = self._GetLive(key, now)
+      if value is None:
+        return None
+      self.items[key] = (self.items[key][0], value + delta)
+      return value + delta
+
+  def delete(self, key):  # pylint:disable=invalid-name
+    self._Call()
+    with self.lock:
+      self.items.pop(key, None)
+    return 2  # memcache.DELETE_SUCCESSFUL
+
+
+class ZipfianKeys(object):
+  """Picks keys 0 to num_keys - 1, where key k has probability ~ 1/(k+1)^s."""
+
+  def __init__(self, num_keys, s):
+    self.totals = []
+    total = 0
+    for k in range(num_keys):
+      total += 1.0 / (k + 1) ** s
+      self.totals.append(total)
+
+  def Pick(self):
+    return bisect.bisect(self.totals, random.random() * self.totals[-1])
+
+
+class MakeValueTracker(object):
+  """Counts make_value calls and detects concurrent calls for the same key."""
+
+  def __init__(self, latency):
+    self.latency = latency
+    self.lock = threading.Lock()
+    self.running = {}  # key => number of make_value calls in progress
+    self.calls = 0
+    self.stampedes = 0  # calls that started while another was in progress
+    self.max_concurrency = 0
+
+  def MakeValue(self, key):
+    with self.lock:
+      self.calls += 1
+      running = self.running[key] = self.running.get(key, 0) + 1
+      if running > 1:
+        self.stampedes += 1
+      self.max_concurrency = max(self.max_concurrency, running)
+    try:
+      time.sleep(self.latency)
+      return {'key': key, 'made': time.time()}
+    finally:
+      with self.lock:
+        self.running[key] -= 1
+
+
+def GetPercentile(sorted_values, fraction):
+  if not sorted_values:
+    return 0
+  return sorted_values[min(int(len(sorted_values) * fraction),
+                           len(sorted_values) - 1)]
+
+
+def Run(options):
+  """Runs the load test and returns a dictionary of results."""
+  fake_memcache = FakeMemcache(options.memcache_latency)
+  cache.memcache = fake_memcache
+  cache.Reset()
+  keys = ZipfianKeys(options.keys, options.zipf_s)
+  tracker = MakeValueTracker(options.make_latency)
+
+  def ScheduleRefresh(key):
+    # Stands in for a task queue: the refresh runs in another thread, and
+    # its latency isn't counted in that of any Get() call.
+    threading.Thread(target=lambda: c.Refresh(
+        key, lambda: tracker.MakeValue(key))).start()
+
+  c = cache.Cache('load_test', options.ttl, options.ull,
+                  get_timeout=options.get_timeout,
+                  make_rate_limit=options.make_rate_limit,
+                  schedule_refresh=(options.schedule_refresh and
+                                    ScheduleRefresh or None))
+
+  latencies = []
+  errors = []
+  deadline = time.time() + options.duration
+
+  def Worker():
+    my_latencies = []
+    while time.time() < deadline:
+      key = keys.Pick()
+      start = time.time()
+      try:
+        c.Get(key, lambda key=key: tracker.MakeValue(key))
+      except RuntimeError as e:
+        errors.append(e)
+      my_latencies.append(time.time() - start)
+    latencies.extend(my_latencies)  # list.extend is atomic
+
+  start = time.time()
+  threads = [threading.Thread(target=Worker) for _ in range(options.threads)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  elapsed = time.time() - start
+  time.sleep(options.make_latency)  # let scheduled refreshes finish
+
+  latencies.sort()
+  return {
+      'requests': len(latencies),
+      'throughput_qps': round(len(latencies) / elapsed, 1),
+      'latency_ms': {
+          'p50': round(GetPercentile(latencies, 0.5) * 1000, 3),
+          'p90': round(GetPercentile(latencies, 0.9) * 1000, 3),
+          'p99': round(GetPercentile(latencies, 0.99) * 1000, 3),
+          'max': round((latencies or [0])[-1] * 1000, 3)
+      },
+      'errors': len(errors),
+      'memcache_calls': fake_memcache.calls,
+      'make_value_calls': tracker.calls,
+      'stampedes': tracker.stampedes,
+      'max_make_value_concurrency': tracker.max_concurrency,
+      'cache_stats': cache.GetStats()['caches']['load_test']
+  }
+
+
+def ParseArgs(args):
+  parser = optparse.OptionParser(usage='%prog [options]')
+  parser.add_option('--threads', type='int', default=20,
+                    help='number of concurrent threads calling Get()')
+  parser.add_option('--duration', type='float', default=10,
+                    help='length of the test, in seconds')
+  parser.add_option('--keys', type='int', default=1000,
+                    help='number of distinct keys')
+  parser.add_option('--zipf_s', type='float', default=1.0,
+                    help='Zipf exponent for key popularity (0 = uniform)')
+  parser.add_option('--ttl', type='float', default=5,
+                    help='cache TTL, in seconds')
+  parser.add_option('--ull', type='float', default=None,
+                    help='cache ULL, in seconds (default: the TTL)')
+  parser.add_option('--get_timeout', type='float', default=None,
+                    help='cache get_timeout, in seconds')
+  parser.add_option('--make_rate_limit', type='float', default=None,
+                    help='cache make_rate_limit, in calls per second')
+  parser.add_option('--schedule_refresh', action='store_true',
+                    help='refresh cooling entries outside of Get() calls')
+  parser.add_option('--memcache_latency', type='float', default=0.001,
+                    help='time taken by each memcache call, in seconds')
+  parser.add_option('--make_latency', type='float', default=0.05,
+                    help='time taken by each make_value call, in seconds')
+  options, args = parser.parse_args(args)
+  if args:
+    parser.error('unexpected arguments: %s' % ' '.join(args))
+  return options
+
+
+if __name__ == '__main__':
+  print json.dumps(Run(ParseArgs(sys.argv[1:])), indent=2, sort_keys=True)
@@ -0,0 +1,65 @@
+#!/usr/bin/python
+# Copyright 2014 Google Inc.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at: http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distrib-
+# uted under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+# OR CONDITIONS OF ANY KIND, either express or implied.  See the License for
+# specific language governing permissions and limitations under the License.
+
+"""Compares ways of finding the nearest features for a card.
+
+Usage: tools/python tools/card_filter_benchmark.py [<max_count>]
+
+For several numbers of randomly placed features, times the per-feature
+EarthDistance loop against the batched card.EarthDistances, and a full sort
+against the top-k selection in card.FilterFeatures.
+"""
+
+import random
+import sys
+import timeit
+
+import card
+
+from google.appengine.ext import ndb
+
+
+def SetDistancesOneByOne(features, center):
+  for f in features:
+    f.distance = card.EarthDistance(center, f.location)
+
+
+def FilterBySorting(features, radius, max_count):
+  features.sort()  # sorts by distance; see Feature.__lt__
+  features[:] = [f for f in features[:max_count] if f.distance < radius]
+
+
+def Time(function, repeat=5):
+  """Gets the best time of several runs of a function, in milliseconds."""
+  return min(timeit.repeat(function, number=1, repeat=repeat)) * 1000
+
+
+def Main(max_count):
+  random.seed(0)
+  center = ndb.GeoPt(37.4, -122.1)
+  radius = 100000
+  print '%8s %14s %14s %10s %10s' % (
+      'features', 'distance loop', 'EarthDistances', 'sort', 'top-k')
+  for n in [100, 1000, 10000, 100000]:
+    features = [card.Feature('f%d' % i, '', ndb.GeoPt(
+        center.lat + random.uniform(-2, 2), center.lon + random.uniform(-2, 2)))
+                for i in range(n)]
+    one_by_one = Time(lambda: SetDistancesOneByOne(features, center))
+    batched = Time(lambda: card.SetDistanceOnFeatures(features, center))
+    sort = Time(lambda: FilterBySorting(features[:], radius, max_count))
+    top_k = Time(lambda: card.FilterFeatures(features[:], radius, max_count))
+    print '%8d %11.2f ms %11.2f ms %7.2f ms %7.2f ms' % (
+        n, one_by_one, batched, sort, top_k)
+
+
+if __name__ == '__main__':
+  Main(int((sys.argv[1:] or [5])[0]))
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# Copyright 2014 Google Inc.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at: http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distrib-
+# uted under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+# OR CONDITIONS OF ANY KIND, either express or implied.  See the License for
+# specific language governing permissions and limitations under the License.
+
+"""Compares the time and memory used to extract card features from XML.
+
+Usage: tools/python tools/card_xml_benchmark.py [<copies>]
+
+For each KML, GeoRSS or Atom file in goldentests/, builds a large feed by
+repeating its first item <copies> times (default 20000), then extracts the
+features with card.GetFeaturesFromXml and with the old approach of parsing
+the whole tree and searching it with findall().  Each extraction runs in a
+forked child process so that its peak memory can be measured on its own.
+"""
+
+import glob
+import os
+import re
+import resource
+import sys
+import time
+
+import card
+import kmlify
+
+
+def GetFeaturesFromTree(xml_content, layer_id=None):
+  """The old implementation of card.GetFeaturesFromXml, for comparison."""
+  root = kmlify.ParseXml(xml_content)
+  for element in root.getiterator():
+    element.tag = element.tag.split('}')[-1]  # remove XML namespaces
+  features = []
+  for item in (root.findall('.//Placemark') +
+               root.findall('.//entry') + root.findall('.//item')):
+    location = card.GetLocationFromXmlItem(item)
+    if location:
+      features.append(card.GetFeatureFromXmlItem(item, location, layer_id))
+  return features
+
+
+def MakeLargeFeed(xml, copies):
+  """Repeats the first item in some XML content, or returns None if none."""
+  match = re.search(r'<(Placemark|entry|item)[ >].*?</\1>', xml, re.S)
+  if match:
+    return xml[:match.start()] + match.group(0) * copies + xml[match.start():]
+
+
+def Measure(function):
+  """Runs a function in a child process; gets its run time and peak memory."""
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if not pid:
+    start = time.time()
+    count = len(function())
+    os.write(write_fd, '%f %d' % (time.time() - start, count))
+    os._exit(0)  # pylint:disable=protected-access
+  _, _, usage = os.wait4(pid, 0)
+  seconds, count = os.read(read_fd, 100).split()
+  os.close(read_fd)
+  os.close(write_fd)
+  return float(seconds), usage.ru_maxrss, int(count)
+
+
+def Main(copies):
+  baseline_rss = Measure(lambda: [])[1]
+  print '%-22s %9s %9s %14s %14s' % (
+      'input', 'MB', 'features', 'tree', 'iterparse')
+  for path in sorted(glob.glob('goldentests/*.kml') +
+                     glob.glob('goldentests/*.xml')):
+    xml = MakeLargeFeed(open(path).read(), copies)
+    if not xml:
+      continue
+    results = []
+    for function in [GetFeaturesFromTree, card.GetFeaturesFromXml]:
+      seconds, rss, count = Measure(lambda: function(xml))
+      results.append('%5.2fs %5.1fMB' % (seconds, (rss - baseline_rss) / 1e3))
+    print '%-22s %9.1f %9d %14s %14s' % (
+        os.path.basename(path), len(xml) / 1e6, count,
+        results[0], results[1])
+
+
+if __name__ == '__main__':
+  Main(int((sys.argv[1:] or [20000])[0]))
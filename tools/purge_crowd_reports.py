@@ -33,6 +33,7 @@ import model
 from google.appengine.ext import ndb
 
 
+# pylint: disable=protected-access
 def Purge(model_name, prop_name, value, is_dry_run):
   model_class = getattr(model, model_name)
   query = model_class.query()
@@ -52,12 +53,14 @@ def Purge(model_name, prop_name, value, is_dry_run):
           len(page), model_name, prop_name, value)
       time.sleep(5)
     count += len(page)
+    if model_class is model._CrowdReportModel:
+      for report in page:  # keep purged reports from showing up on cards
+        model.CrowdReport._UpdateSummaries(report, remove=True)
     ndb.delete_multi([report.key for report in page])
     print 'Purged %d %ss for %s=%s: %s' % (len(page), model_name, prop_name,
                                            value, page)
 
 
-# pylint: disable=protected-access
 def Main():
   """Purges crowd reports and votes depending on flags and stdin."""
   parser = optparse.OptionParser()
@@ -0,0 +1,72 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Rebuilds the crowd report summaries from the recent crowd reports.
+
+To run this:
+tools/console <server_url> rebuild_crowd_report_summaries.py -- [-d <days>] [-n]
+
+The summaries are normally kept up to date as reports are created and voted
+on, with failed updates retried in tasks.  Run this once to create them for
+existing reports, or if retries couldn't be scheduled or have given up (these
+are logged as errors).  All existing summaries are deleted
+and then rebuilt from the reports that became effective in the last <days>
+days (default 7, which is how far back cards look for answers).
+If -n, this is a dry run, and nothing is actually written.
+"""
+
+import datetime
+import optparse
+
+import model
+
+from google.appengine.ext import ndb
+
+
+# pylint: disable=protected-access
+def Rebuild(days, is_dry_run):
+  """Deletes all the report summaries and rebuilds them from recent reports."""
+  summary_keys = model._CrowdReportSummaryModel.query().fetch(keys_only=True)
+  print '%s %d existing summaries.' % (
+      is_dry_run and '[DRY_RUN] Would delete' or 'Deleting', len(summary_keys))
+  if not is_dry_run:
+    ndb.delete_multi(summary_keys)
+
+  min_effective = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+  query = model._CrowdReportModel.query()
+  query = query.filter(model._CrowdReportModel.effective >= min_effective)
+  count = 0
+  cursor = None
+  more = True
+  while more:
+    page, cursor, more = query.fetch_page(100, start_cursor=cursor)
+    if not is_dry_run:
+      for report in page:
+        model.CrowdReport._UpdateSummaries(report)
+    count += len(page)
+    print '%s %d reports so far.' % (
+        is_dry_run and '[DRY_RUN] Would summarize' or 'Summarized', count)
+
+
+def Main():
+  parser = optparse.OptionParser()
+  parser.add_option('-d', dest='days', type='int', default=7,
+                    help='Summarize reports effective in the last DAYS days.')
+  parser.add_option('-n', dest='is_dry_run', action='store_true',
+                    help='Dry run, don\'t actually write anything.')
+  options, _ = parser.parse_args()
+  Rebuild(options.days, options.is_dry_run)
+  print 'Done.'
+
+Main()
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+# Copyright 2014 Google Inc.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at: http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distrib-
+# uted under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+# OR CONDITIONS OF ANY KIND, either express or implied.  See the License for
+# specific language governing permissions and limitations under the License.
+
+"""Compares the time taken to serialize KML with xml_utils.Serialize.
+
+Usage: tools/python tools/xml_serialize_benchmark.py [<copies>]
+
+For each KML output file in goldentests/, builds a large Document by
+repeating its contents <copies> times (default 1000), then serializes it
+with xml_utils.Serialize and with the old approach of copying the tree by
+serializing and reparsing it, then indenting the copy and serializing it
+again.  Also checks that both approaches produce the same output.
+"""
+
+import copy
+import glob
+import os
+import sys
+import timeit
+
+import xml_utils
+
+ElementTree = xml_utils.ElementTree
+
+
+def Indent(element, level=0):
+  """The old xml_utils.Indent, which modifies the tree."""
+  if element:  # True if element has any children
+    if not element.text or not element.text.strip():
+      element.text = '\n' + '  '*(level + 1)
+    for child in element:
+      Indent(child, level + 1)
+      if not child.tail or not child.tail.strip():
+        child.tail = '\n' + '  '*(level + 1)
+    if not element[-1].tail or not element[-1].tail.strip():
+      element[-1].tail = '\n' + '  '*level
+
+
+def SerializeByCopying(root):
+  """The old implementation of xml_utils.Serialize, for comparison."""
+  root_copy = ElementTree.fromstring(ElementTree.tostring(root))
+  Indent(root_copy)
+  return ElementTree.tostring(root_copy)
+
+
+def MakeLargeDocument(kml, copies):
+  """Repeats the children of the Document element in some KML."""
+  document = xml_utils.Parse(kml)[0]
+  children = list(document)
+  for _ in range(copies - 1):
+    document.extend(copy.deepcopy(children))
+  return document
+
+
+def Time(function, repeat=3):
+  """Gets the best time of several runs of a function, in milliseconds."""
+  return min(timeit.repeat(function, number=1, repeat=repeat)) * 1000
+
+
+def Main(copies):
+  print '%-20s %9s %12s %12s %8s' % (
+      'output', 'MB', 'copying', 'one pass', 'speedup')
+  for path in sorted(glob.glob('goldentests/*output*.kml')):
+    document = MakeLargeDocument(open(path).read(), copies)
+    kml = xml_utils.Serialize(document)
+    if kml != SerializeByCopying(document):
+      print '%s: outputs differ!' % path
+    old = Time(lambda: SerializeByCopying(document))
+    new = Time(lambda: xml_utils.Serialize(document))
+    print '%-20s %9.1f %9.0f ms %9.0f ms %7.1fx' % (
+        os.path.basename(path), len(kml) / 1e6, old, new, old / new)
+
+
+if __name__ == '__main__':
+  Main(int((sys.argv[1:] or [1000])[0]))
@@ -14,12 +14,16 @@
 
 import base64
 import calendar
+import contextlib
 import datetime
 from HTMLParser import HTMLParseError
 from HTMLParser import HTMLParser
+import logging
 import os
+import Queue
 import random
 import re
+import threading
 import time
 
 
@@ -160,6 +164,96 @@ def SetAndTest(set_func, test_func, sleep_delta=0.05, num_tries=20):
   return False
 
 
+def CallInParallel(functions, timeout=None, max_threads=10):
+  """Calls several functions concurrently and collects their results.
+
+  The functions are called in at most max_threads threads at once.  This is
+  useful for functions that spend most of their time waiting for I/O, such as
+  urlfetch calls.  A function that raises an exception or doesn't finish in
+  time doesn't hold up the others; its exception is logged and its result is
+  given as None.
+
+  Args:
+    functions: A list of functions that take no arguments.
+    timeout: The maximum number of seconds to wait for all the functions to
+        finish, or None to wait indefinitely.
+    max_threads: The maximum number of threads to use.
+
+  Returns:
+    A list of the results of the functions, in the same order as functions.
+  """
+  results = [None] * len(functions)
+  deadline = None if timeout is None else time.time() + timeout
+  queue = Queue.Queue()
+  for i, function in enumerate(functions):
+    queue.put((i, function))
+
+  def Worker():
+    while deadline is None or time.time() < deadline:
+      try:
+        i, function = queue.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        results[i] = function()
+      except Exception:  # pylint:disable=broad-except
+        logging.warning('Error in parallel call to %r', function, exc_info=True)
+
+  threads = [threading.Thread(target=Worker)
+             for _ in range(min(max_threads, len(functions)))]
+  for thread in threads:
+    thread.daemon = True  # don't keep the process alive for stragglers
+    thread.start()
+  for thread in threads:
+    if deadline is not None:
+      thread.join(max(0, deadline - time.time()))
+    else:
+      thread.join()
+  return results[:]  # don't let stragglers change the results later
+
+
+class StageTimer(object):
+  """Adds up the time spent in named stages of a task, across threads.
+
+  Stages can be nested or run concurrently; each stage's duration is the sum
+  of the times spent in it, so concurrent stages can add up to more than the
+  elapsed time of the whole task.
+  """
+
+  def __init__(self):
+    self.durations = {}  # stage name => total seconds
+    self.stages = []  # stage names, in the order they first finished
+    self.lock = threading.Lock()
+
+  @contextlib.contextmanager
+  def Time(self, stage):
+    """Returns a context manager that adds its duration to a given stage."""
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.Add(stage, time.time() - start)
+
+  def Add(self, stage, seconds):
+    with self.lock:
+      if stage not in self.durations:
+        self.stages.append(stage)
+        self.durations[stage] = 0
+      self.durations[stage] += seconds
+
+  def GetMilliseconds(self):
+    """Gets a dictionary of the stage durations in milliseconds."""
+    with self.lock:
+      return {stage: round(seconds * 1000, 1)
+              for stage, seconds in self.durations.items()}
+
+  def GetServerTiming(self):
+    """Formats the durations as the value of a Server-Timing header."""
+    milliseconds = self.GetMilliseconds()
+    return ', '.join('%s;dur=%.1f' % (stage, milliseconds[stage])
+                     for stage in self.stages)
+
+
 def IsValidEmail(email):
   return re.match(r'^[^@]+@([\w-]+\.)+[\w-]+$', email)
 
@@ -13,6 +13,7 @@
 """Unit tests for utils.py."""
 
 import datetime
+import threading
 import time
 
 import test_utils
@@ -121,5 +122,34 @@ class UtilsSetAndTestTests(test_utils.BaseTest):
     self.assertEqual('2h ago', utils.ShortAge(now - seconds(110 * 60)))
     self.assertEqual('4d ago', utils.ShortAge(now - seconds(4 * 24 * 3500)))
 
+  def testCallInParallel(self):
+    def Fail():
+      raise ValueError
+    self.assertEquals([1, None, 3], utils.CallInParallel(
+        [lambda: 1, Fail, lambda: 3], max_threads=2))
+    self.assertEquals([], utils.CallInParallel([]))
+
+  def testCallInParallelTimeout(self):
+    release = threading.Event()
+    try:
+      self.assertEquals([1, None], utils.CallInParallel(
+          [lambda: 1, lambda: release.wait(10) or 2], timeout=0.1))
+    finally:
+      release.set()
+
+  def testStageTimer(self):
+    timer = utils.StageTimer()
+    self.SetTime(1000)
+    with timer.Time('fetch'):
+      self.SetTime(1000.25)
+    with timer.Time('parse'):
+      self.SetTime(1000.5)
+    with timer.Time('fetch'):
+      self.SetTime(1001)
+    self.assertEquals({'fetch': 750, 'parse': 250}, timer.GetMilliseconds())
+    self.assertEquals('fetch;dur=750.0, parse;dur=250.0',
+                      timer.GetServerTiming())
+
+
 if __name__ == '__main__':
   test_utils.main()
@@ -26,6 +26,10 @@ try:
   import xml.etree.cElementTree as ElementTree
 except ImportError:
   import xml.etree.ElementTree as ElementTree
+# The prefixes that ElementTree assigns to well-known namespaces (and those
+# added by register_namespace) live in the pure-Python module.
+from xml.etree.ElementTree import (  # pylint:disable=protected-access
+    _namespace_map as NAMESPACE_MAP)
 
 
 def Qualify(ns, name):
@@ -95,46 +99,116 @@ def Read(fileobject):
 # ==== Serializing and writing elements ====================================
 
 
-def Indent(element, level=0):
-  """Adds indentation to an element subtree."""
-  # TODO(kpy): Make this non-mutating so we don't have to copy in serialize().
-  if element:  # True if element has any children
-    if not element.text or not element.text.strip():
-      element.text = '\n' + '  '*(level + 1)
-    for child in element:
-      Indent(child, level + 1)
-      if not child.tail or not child.tail.strip():
-        child.tail = '\n' + '  '*(level + 1)
-    if not element[-1].tail or not element[-1].tail.strip():
-      element[-1].tail = '\n' + '  '*level
+def EscapeText(text):
+  """Escapes a string for use as XML character data."""
+  return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
 
 
-def FixName(name, uri_prefixes):
-  """Converts a Clark qualified name into a name with a namespace prefix."""
-  if name[0] == '{':
-    uri, tag = name[1:].split('}')
-    if uri in uri_prefixes:
-      return uri_prefixes[uri] + ':' + tag
-  return name
+def EscapeAttribute(value):
+  """Escapes a string for use as a double-quoted XML attribute value."""
+  return EscapeText(value).replace('"', '&quot;').replace('\n', '&#10;')
 
 
-def SetPrefixes(root, uri_prefixes):
-  """Replaces Clark qualified element names with specific given prefixes."""
-  # TODO(kpy): Make this non-mutating so we don't have to copy in serialize().
-  for uri, prefix in uri_prefixes.items():
-    root.set('xmlns:' + prefix, uri)
+def GetPrefixedNames(root, uri_prefixes):
+  """Converts the Clark qualified names in a tree into prefixed names.
 
+  Namespaces not in uri_prefixes get prefixes the way ElementTree assigns
+  them: from ElementTree.register_namespace, or else ns0, ns1, etc.
+
+  Args:
+    root: The root element.
+    uri_prefixes: A dictionary of namespace URIs to prefixes.
+  Returns:
+    A pair (names, other_prefixes), where names maps each element and
+    attribute name in the tree to its prefixed name, and other_prefixes maps
+    the namespace URIs not in uri_prefixes to their assigned prefixes.
+  """
+  names = {}
+  other_prefixes = {}
   for element in root.getiterator():
-    element.tag = FixName(element.tag, uri_prefixes)
+    for name in [element.tag] + element.keys():
+      if name not in names:
+        names[name] = name
+        if name[:1] == '{':
+          uri, local_name = name[1:].split('}', 1)
+          prefix = uri_prefixes.get(uri) or other_prefixes.get(uri)
+          if not prefix:
+            prefix = NAMESPACE_MAP.get(uri) or 'ns%d' % len(other_prefixes)
+            if prefix != 'xml':  # the xml: prefix is always predeclared
+              other_prefixes[uri] = prefix
+          names[name] = prefix + ':' + local_name
+  return names, other_prefixes
+
+
+def SerializeElement(write, element, names, pretty_print, level,
+                     attributes=None):
+  """Writes an element subtree as XML, in pieces, without modifying it.
 
+  Args:
+    write: A function to call with each piece of XML text.
+    element: The element to serialize.
+    names: A dictionary of element and attribute names to prefixed names.
+    pretty_print: If True, add indentation, replacing any whitespace-only
+        text around child elements.
+    level: The indentation level of the element.
+    attributes: A list of (name, value) pairs to use instead of the
+        element's own attributes.
+  """
+  name = names[element.tag]
+  write('<' + name)
+  if attributes is None:
+    attributes = sorted(element.items())
+  for key, value in attributes:
+    write(' %s="%s"' % (names.get(key, key), EscapeAttribute(value)))
+  text = element.text
+  count = len(element)
+  if pretty_print and count and (not text or not text.strip()):
+    text = '\n' + '  '*(level + 1)
+  if not text and not count:
+    write(' />')
+    return
+  write('>')
+  if text:
+    write(EscapeText(text))
+  for i, child in enumerate(element):
+    SerializeElement(write, child, names, pretty_print, level + 1)
+    tail = child.tail
+    if pretty_print and (not tail or not tail.strip()):
+      tail = '\n' + '  '*(level + (i < count - 1))
+    if tail:
+      write(EscapeText(tail))
+  write('</' + name + '>')
+
+
+def SerializeParts(root, uri_prefixes=None, pretty_print=True, level=0):
+  """Serializes XML to a list of strings, without modifying the tree."""
+  uri_prefixes = uri_prefixes or {}
+  names, other_prefixes = GetPrefixedNames(root, uri_prefixes)
+  # As in ElementTree, the namespace declarations go on the root element,
+  # with the automatically prefixed ones ahead of the other attributes.
+  attributes = sorted(('xmlns:' + prefix, uri)
+                      for uri, prefix in other_prefixes.items())
+  attributes += sorted(root.items() + [
+      ('xmlns:' + prefix, uri) for uri, prefix in uri_prefixes.items()])
+  parts = []
+  SerializeElement(parts.append, root, names, pretty_print, level, attributes)
+  return parts
+
+
+def Serialize(root, uri_prefixes=None, pretty_print=True, level=0):
+  """Serializes XML to a string.
 
-def Serialize(root, uri_prefixes=None, pretty_print=True):
-  """Serializes XML to a string."""
-  root_copy = ElementTree.fromstring(ElementTree.tostring(root))
-  SetPrefixes(root_copy, uri_prefixes or {})
-  if pretty_print:
-    Indent(root_copy)
-  return ElementTree.tostring(root_copy)
+  Args:
+    root: The root element.  It is not modified.
+    uri_prefixes: A dictionary of namespace URIs to prefixes.
+    pretty_print: If True, pretty print the XML (add indentation).
+    level: The indentation level of the root element, for pretty-printing an
+        element that will be placed within another document.
+  Returns:
+    The XML as a string, with non-ASCII characters as character references.
+  """
+  return u''.join(SerializeParts(root, uri_prefixes, pretty_print, level)
+                 ).encode('ascii', 'xmlcharrefreplace')
 
 
 def Write(fileobj, root, uri_prefixes=None, pretty_print=True):
@@ -145,15 +219,12 @@ def Write(fileobj, root, uri_prefixes=None, pretty_print=True):
 
   Args:
     fileobj: The open file object.
-    root: The root element.
-    uri_prefixes: A dictionary of namespace URI to prefixes.
+    root: The root element.  It is not modified.
+    uri_prefixes: A dictionary of namespace URIs to prefixes.
     pretty_print: If True, pretty print the XML (add indentation).
   """
-  root_copy = ElementTree.fromstring(ElementTree.tostring(root))
-  SetPrefixes(root_copy, uri_prefixes or {})
-  if pretty_print:
-    Indent(root_copy)
-  # Setting encoding to 'UTF-8' makes ElementTree write the XML declaration
-  # because 'UTF-8' differs from ElementTree's default, 'utf-8'.  According
-  # to the XML 1.0 specification, 'UTF-8' is also the recommended spelling.
-  ElementTree.ElementTree(root_copy).write(fileobj, encoding='UTF-8')
+  # This is the XML declaration that ElementTree writes for 'UTF-8', which
+  # is the spelling recommended by the XML 1.0 specification.
+  fileobj.write("<?xml version='1.0' encoding='UTF-8'?>\n")
+  fileobj.write(u''.join(SerializeParts(root, uri_prefixes, pretty_print)
+                        ).encode('utf-8'))
@@ -41,6 +41,24 @@ class XmlUtilsTest(unittest.TestCase):
 </ns0:e>\
 """, xml_utils.Serialize(e4))
 
+  def testSerialize(self):
+    root = xml_utils.Parse(
+        '<a xmlns="urn:a" xmlns:b="urn:b"><b:c>\n<d x="1&#10;2"/>  </b:c>'
+        '<e>\xc3\xa9 &amp;</e></a>')
+    original = xml_utils.ElementTree.tostring(root)
+    self.assertEquals("""\
+<a:a xmlns:ns0="urn:b" xmlns:a="urn:a">
+  <ns0:c>
+    <a:d x="1&#10;2" />
+  </ns0:c>
+  <a:e>&#233; &amp;</a:e>
+</a:a>""", xml_utils.Serialize(root, {'urn:a': 'a'}))
+    self.assertEquals(
+        '<a:d x="1&#10;2" xmlns:a="urn:a" />',
+        xml_utils.Serialize(root[0][0], {'urn:a': 'a'}, level=2))
+    # The tree should be unchanged.
+    self.assertEquals(original, xml_utils.ElementTree.tostring(root))
+
 
 if __name__ == '__main__':
   unittest.main()